@@ -1,15 +1,22 @@
 # Original code from: https://github.com/isayev/ReLeaSE
 
+import json
+import math
+import os
+import queue
+import threading
+
 import numpy as np
 import torch
 
-from irelease.utils import read_smi_file, tokenize, read_object_property_file, seq2tensor, pad_sequences
+from irelease.utils import read_smi_file, tokenize, iter_object_property_file, pad_sequences, Vocabulary, \
+    SmilesTokenizer, vocabulary_from_state_dict
 
 
 class GeneratorData(object):
 
     def __init__(self, training_data_path, tokens=None, start_token='<',
-                 end_token='>', pad_symbol=' ', max_len=120, use_cuda=None, seed=None,
+                 end_token='>', pad_symbol=' ', max_len=120, use_cuda=None, seed=None, tokenizer='char',
                  **kwargs):
         """
         Constructor for the GeneratorData object.
@@ -41,6 +48,11 @@ class GeneratorData(object):
             parameter specifying if GPU is used for computations. If left
             unspecified, GPU will be used if available
 
+        tokenizer: str (default 'char')
+            'char' for one token per character or 'regex' for atom-level
+            tokens (e.g. 'Cl', '[nH]', '%10'), see ::class::SmilesTokenizer.
+            With 'regex', the tokens are extracted from data unless given.
+
         kwargs: additional positional arguments
             These include cols_to_read (list, default [0]) specifying which
             column in the file with training data contains training sequences
@@ -59,26 +71,62 @@ class GeneratorData(object):
         if 'tokens_reload' in kwargs:
             self.tokens_reload = kwargs['tokens_reload']
 
-        data = read_object_property_file(training_data_path, **kwargs)
         self.start_token = start_token
         self.end_token = end_token
         self.pad_symbol = pad_symbol
         self.file = []
-        for i in range(len(data)):
-            if len(data[i].strip()) <= max_len:
-                self.file.append(self.start_token + data[i].strip() + self.end_token)
+        if kwargs['cols_to_read']:
+            # The file is streamed in chunks and only the SMILES column is held, already filtered by length.
+            for chunk in iter_object_property_file(training_data_path, max_len=max_len, **kwargs):
+                self.file.extend(self.start_token + sm.strip() + self.end_token for sm in chunk[0])
         self.file_len = len(self.file)
-        self.all_characters, self.char2idx, \
-        self.n_characters = tokenize(self.file, tokens)
-        self.pad_symbol_idx = self.all_characters.index(self.pad_symbol)
+        assert tokenizer in ('char', 'regex'), f'Unknown tokenizer {tokenizer}'
+        self.tokenizer = tokenizer
+        if tokenizer == 'regex':
+            if tokens is None:
+                tokens = SmilesTokenizer.from_smiles(self.file,
+                                                     special_tokens=(pad_symbol, start_token, end_token)).tokens
+            self.all_characters = list(tokens)
+            self.char2idx = dict((token, i) for i, token in enumerate(self.all_characters))
+        else:
+            self.all_characters, self.char2idx, \
+            self.n_characters = tokenize(self.file, tokens)
+        self._build_vocabulary()
+        self.pad_symbol_idx = self.vocab.index(self.pad_symbol)
         self.use_cuda = use_cuda
         if self.use_cuda is None:
             self.use_cuda = torch.cuda.is_available()
 
+    def _build_vocabulary(self):
+        """
+        Freezes the alphabet into a ::class::Vocabulary (or ::class::SmilesTokenizer). Tokens of the data that are
+        missing from the given tokens are appended once here, instead of growing the alphabet while batches are
+        being encoded. With the regex tokenizer, the tokenized sequences are cached as well.
+        """
+        tokens = list(self.all_characters)
+        if self.tokenizer == 'regex':
+            splitter = SmilesTokenizer(tokens)
+            self.file_tokens = [splitter.tokenize(s) for s in self.file]
+            found = set(t for seq in self.file_tokens for t in seq)
+        else:
+            self.file_tokens = None
+            found = set(''.join(self.file))
+        missing = sorted(found - set(tokens))
+        if missing:
+            tokens.extend(missing)
+            self.all_characters = tokens
+            self.char2idx = dict((token, i) for i, token in enumerate(tokens))
+        self.n_characters = len(self.all_characters)
+        self.vocab = SmilesTokenizer(self.all_characters) if self.tokenizer == 'regex' \
+            else Vocabulary(self.all_characters)
+        # number of tokens of each sequence, including the start and end tokens
+        self.lengths = np.array([len(s) for s in (self.file if self.file_tokens is None else self.file_tokens)],
+                                dtype=np.int64)
+
     def load_dictionary(self, tokens, char2idx):
         self.all_characters = tokens
         self.char2idx = char2idx
-        self.n_characters = len(tokens)
+        self._build_vocabulary()
 
     def set_batch_size(self, batch_size):
         self.batch_size = batch_size
@@ -87,10 +135,11 @@ class GeneratorData(object):
         """
         Samples random SMILES string from generator training data set.
         Returns:
-            random_smiles (str).
+            random_smiles (str), or lists of tokens with the regex tokenizer.
         """
         index = np.random.randint(0, self.file_len - 1, batch_size)
-        return [self.file[i][:-1] for i in index], [self.file[i][1:] for i in index]
+        seqs = self.file if self.file_tokens is None else self.file_tokens
+        return [seqs[i][:-1] for i in index], [seqs[i][1:] for i in index]
 
     def random_training_set_smiles(self, batch_size=None):
         if batch_size is None:
@@ -99,22 +148,31 @@ class GeneratorData(object):
         sels = np.random.randint(0, self.file_len - 1, batch_size)
         return [self.file[i][1:-1] for i in sels]
 
+    def batch(self, index):
+        """
+        Encodes the given sequences into padded input and target index arrays.
+
+        :return: tuple
+            [0] (len(index), max_len - 1) int64 inputs: the sequences without their end token
+            [1] targets of the same shape: the sequences without their start token
+            [2] number of input (= target) tokens of each sequence
+        """
+        seqs = self.file if self.file_tokens is None else self.file_tokens
+        inp_padded, inp_seq_len = pad_sequences([seqs[i][:-1] for i in index], pad_symbol=self.pad_symbol)
+        target_padded, _ = pad_sequences([seqs[i][1:] for i in index], pad_symbol=self.pad_symbol)
+        return self.vocab.encode(inp_padded), self.vocab.encode(target_padded), np.array(inp_seq_len)
+
     def random_training_set(self, batch_size=None, return_seq_len=False):
         if batch_size is None:
             batch_size = self.batch_size
         assert (batch_size > 0)
         inp, target = self.random_chunk(batch_size)
         inp_padded, inp_seq_len = pad_sequences(inp)
-        inp_tensor, self.all_characters = seq2tensor(inp_padded,
-                                                     tokens=self.all_characters,
-                                                     flip=False)
+        inp_tensor = self.vocab.encode(inp_padded)
         target_padded, target_seq_len = pad_sequences(target)
-        target_tensor, self.all_characters = seq2tensor(target_padded,
-                                                        tokens=self.all_characters,
-                                                        flip=False)
-        self.n_characters = len(self.all_characters)
-        inp_tensor = torch.tensor(inp_tensor).long()
-        target_tensor = torch.tensor(target_tensor).long()
+        target_tensor = self.vocab.encode(target_padded)
+        inp_tensor = torch.from_numpy(inp_tensor).long()
+        target_tensor = torch.from_numpy(target_tensor).long()
         if self.use_cuda:
             inp_tensor = inp_tensor.cuda()
             target_tensor = target_tensor.cuda()
@@ -129,3 +187,247 @@ class GeneratorData(object):
         self.file, success = read_smi_file(path, unique=True)
         self.file_len = len(self.file)
         assert success
+        self._build_vocabulary()
+
+
+def build_token_corpus(smiles, corpus_dir, vocab, start_token='<', end_token='>', pad_symbol=' ', max_len=120,
+                       chunk_size=100000):
+    """
+    Encodes SMILES into a pre-tokenized corpus that is read by ::class::TokenCorpusData.
+
+    The corpus directory holds a flat uint8 array of token indices (`tokens.bin`, every sequence wrapped in the
+    start and end tokens), the int64 offsets of the sequences in it (`offsets.npy`) and the vocabulary and special
+    tokens (`meta.json`). Sequences are encoded and written chunk by chunk.
+
+    :param smiles: list
+        The (canonical) SMILES. SMILES longer than `max_len` characters are skipped, as in ::class::GeneratorData.
+    :param corpus_dir: str
+        Output directory.
+    :param vocab: Vocabulary or SmilesTokenizer
+        Vocabulary used for encoding. It must contain at most 256 tokens.
+    :return: int
+        Number of sequences in the corpus.
+    """
+    assert len(vocab) <= 256, 'Token indices are stored as uint8'
+    for token in (start_token, end_token, pad_symbol):
+        assert token in vocab, f'{token!r} is missing from the vocabulary'
+    os.makedirs(corpus_dir, exist_ok=True)
+    lengths = []
+    with open(os.path.join(corpus_dir, 'tokens.bin'), 'wb') as f:
+        for i in range(0, len(smiles), chunk_size):
+            seqs = [vocab.tokenize(start_token + sm + end_token) for sm in smiles[i:i + chunk_size]
+                    if len(sm) <= max_len]
+            if len(seqs) == 0:
+                continue
+            seq_lens = np.array([len(s) for s in seqs])
+            indices = vocab.encode(seqs)
+            f.write(indices[np.arange(indices.shape[1])[None, :] < seq_lens[:, None]].astype(np.uint8).tobytes())
+            lengths.append(seq_lens)
+    lengths = np.concatenate(lengths) if lengths else np.zeros((0,), dtype=np.int64)
+    np.save(os.path.join(corpus_dir, 'offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    with open(os.path.join(corpus_dir, 'meta.json'), 'w') as f:
+        json.dump({'vocab': vocab.state_dict(),
+                   'start_token': start_token,
+                   'end_token': end_token,
+                   'pad_symbol': pad_symbol,
+                   'max_len': max_len,
+                   'num_sequences': len(lengths)}, f)
+    return len(lengths)
+
+
+class TokenCorpusData(object):
+    """
+    ::class::GeneratorData-compatible reader of a corpus created with ::func::build_token_corpus.
+
+    The token array is memory-mapped read-only, so processes reading the same corpus share its pages and no
+    per-sequence Python objects are created. Batches are assembled by slicing the mapping into a padded array.
+
+    Arguments:
+    -----------
+    :param corpus_dir: str
+        Directory of the corpus.
+    :param use_cuda: bool
+        Whether batches should be moved to the GPU. Defaults to GPU availability.
+    :param seed: int
+        Seed of the numpy PRNG.
+    :param batch_size: int
+        Default batch size of ::method::random_training_set.
+    """
+
+    def __init__(self, corpus_dir, use_cuda=None, seed=None, batch_size=None):
+        if seed:
+            np.random.seed(seed)
+        with open(os.path.join(corpus_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.vocab = vocabulary_from_state_dict(meta['vocab'])
+        self.tokenizer = meta['vocab']['type']
+        self.start_token = meta['start_token']
+        self.end_token = meta['end_token']
+        self.pad_symbol = meta['pad_symbol']
+        self.all_characters = self.vocab.tokens
+        self.char2idx = dict((token, i) for i, token in enumerate(self.all_characters))
+        self.n_characters = len(self.all_characters)
+        self.pad_symbol_idx = self.vocab.index(self.pad_symbol)
+        self.tokens = np.memmap(os.path.join(corpus_dir, 'tokens.bin'), dtype=np.uint8, mode='r')
+        self.offsets = np.load(os.path.join(corpus_dir, 'offsets.npy'), mmap_mode='r')
+        self.lengths = np.diff(self.offsets)
+        self.file_len = len(self.lengths)
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.use_cuda = use_cuda
+        if self.use_cuda is None:
+            self.use_cuda = torch.cuda.is_available()
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def sequence(self, i):
+        """The i-th sequence, including the start and end tokens."""
+        return ''.join(self.vocab.decode_tokens(self.tokens[self.offsets[i]:self.offsets[i + 1]]))
+
+    def random_chunk(self, batch_size):
+        index = np.random.randint(0, self.file_len, batch_size)
+        seqs = [self.sequence(i) for i in index]
+        return [s[:-len(self.end_token)] for s in seqs], [s[len(self.start_token):] for s in seqs]
+
+    def random_training_set_smiles(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.batch_size
+        assert (batch_size > 0)
+        sels = np.random.randint(0, self.file_len, batch_size)
+        return [self.sequence(i)[len(self.start_token):-len(self.end_token)] for i in sels]
+
+    def batch(self, index):
+        """
+        Slices the given sequences into padded input and target index arrays.
+
+        :return: tuple
+            [0] (len(index), max_len - 1) int64 inputs: the sequences without their end token
+            [1] targets of the same shape: the sequences without their start token
+            [2] number of input (= target) tokens of each sequence
+        """
+        index = np.asarray(index)
+        seq_len = self.lengths[index] - 1
+        width = int(seq_len.max())
+        positions = np.asarray(self.offsets[index])[:, None] + np.arange(width)[None, :]
+        mask = np.arange(width)[None, :] < seq_len[:, None]
+        inp = np.full((len(index), width), self.pad_symbol_idx, dtype=np.int64)
+        target = np.full((len(index), width), self.pad_symbol_idx, dtype=np.int64)
+        inp[mask] = self.tokens[positions[mask]]
+        target[mask] = self.tokens[positions[mask] + 1]
+        return inp, target, seq_len
+
+    def random_training_set(self, batch_size=None, return_seq_len=False):
+        if batch_size is None:
+            batch_size = self.batch_size
+        assert (batch_size > 0)
+        inp, target, seq_len = self.batch(np.random.randint(0, self.file_len, batch_size))
+        inp_tensor = torch.from_numpy(inp)
+        target_tensor = torch.from_numpy(target)
+        if self.use_cuda:
+            inp_tensor = inp_tensor.cuda()
+            target_tensor = target_tensor.cuda()
+        if return_seq_len:
+            return inp_tensor, target_tensor, (seq_len.tolist(), seq_len.tolist())
+        return inp_tensor, target_tensor
+
+
+class BucketBatchSampler(object):
+    """
+    Iterates over (inputs, targets) LongTensor batches of a ::class::GeneratorData or ::class::TokenCorpusData.
+
+    Sequences are grouped into length buckets (length quantiles) so that a batch holds sequences of similar lengths
+    and little padding. Every epoch is a shuffle of the whole data set without replacement: each bucket is shuffled
+    and cut into batches, and the order of the batches is shuffled. Batches are built by a background thread that
+    keeps up to `prefetch` of them ready, so data preparation overlaps the optimization steps.
+
+    Arguments:
+    -----------
+    :param gen_data:
+        Data set providing `lengths`, `batch(index)` and `use_cuda`.
+    :param batch_size: int
+        Maximum number of sequences per batch. Defaults to `gen_data.batch_size`.
+    :param num_buckets: int
+        Number of length buckets.
+    :param prefetch: int
+        Number of ready batches kept in the queue.
+    :param seed: int
+        Seed of the sampler's PRNG.
+    :param return_seq_len: bool
+        Whether the number of tokens of each sequence should be returned as a third element.
+    """
+
+    def __init__(self, gen_data, batch_size=None, num_buckets=10, prefetch=4, seed=None, return_seq_len=False):
+        self.gen_data = gen_data
+        self.batch_size = gen_data.batch_size if batch_size is None else batch_size
+        assert self.batch_size > 0
+        self.return_seq_len = return_seq_len
+        self.rng = np.random.RandomState(seed)
+        lengths = np.asarray(gen_data.lengths)
+        boundaries = np.unique(np.quantile(lengths, np.linspace(0, 1, num_buckets + 1)[1:-1]))
+        bucket_ids = np.searchsorted(boundaries, lengths, side='right')
+        self.buckets = [np.flatnonzero(bucket_ids == b) for b in range(len(boundaries) + 1)]
+        self.buckets = [b for b in self.buckets if len(b) > 0]
+        self.epoch = 0
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    @property
+    def num_batches(self):
+        """Number of batches per epoch."""
+        return sum(int(math.ceil(len(b) / self.batch_size)) for b in self.buckets)
+
+    def _epoch_batches(self):
+        batches = []
+        for bucket in self.buckets:
+            bucket = self.rng.permutation(bucket)
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        return [batches[i] for i in self.rng.permutation(len(batches))]
+
+    def _put(self, item):
+        """Puts an item on the queue unless the sampler is closed. Returns whether the item was put."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            while not self._stop.is_set():
+                for index in self._epoch_batches():
+                    inp, target, seq_len = self.gen_data.batch(index)
+                    if not self._put((torch.from_numpy(inp).long(), torch.from_numpy(target).long(), seq_len)):
+                        return
+                self.epoch += 1
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        inp, target, seq_len = item
+        if self.gen_data.use_cuda:
+            inp = inp.cuda(non_blocking=True)
+            target = target.cuda(non_blocking=True)
+        if self.return_seq_len:
+            return inp, target, seq_len
+        return inp, target
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -6,17 +6,181 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
+import json
 import os
 
 import joblib
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split, KFold
 from sklearn.preprocessing import StandardScaler
 from sklearn.utils import shuffle as shuffle_data
 
+from irelease.utils import get_vocabulary, pad_sequences
+
+
+def file_digest(path, block_size=1 << 20):
+    """SHA-1 of the contents of a file, read in blocks."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def token_features(smiles, tokens=None):
+    """
+    Featurizer (see ::func::load_smiles_data) that encodes SMILES into a padded matrix of token indices.
+    It follows the return convention of ::func::irelease.utils.get_fp.
+    """
+    x, _ = pad_sequences([str(sm) for sm in smiles])
+    return get_vocabulary(tokens).encode(x), list(range(len(smiles))), []
+
+
+class IndexedSplit(object):
+    """
+    A data split stored as an index array over the X and y arrays shared by all the splits of a data set.
+    It unpacks like the (x, y) tuple, or (x, y, features) when features are attached, and the rows of the split are
+    only gathered when accessed. The splits of a data set are cached with ::func::_pack_splits.
+
+    Arguments:
+    -----------
+    :param X: numpy.ndarray
+        SMILES of the whole data set.
+    :param y: numpy.ndarray
+        Labels of the whole data set.
+    :param index: numpy.ndarray
+        Rows of the split.
+    :param features: dict
+        Optional {name: (features, row)} of the whole data set, where row[i] is the row of the i-th molecule in
+        features or -1 if it could not be featurized.
+    """
+
+    def __init__(self, X, y, index, features=None):
+        self.X = X
+        self.y_all = y
+        self.index = np.asarray(index, dtype=np.int64)
+        self.features_all = features
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['features_all'] = None  # features are memory-mapped from their own cache files
+        return state
+
+    @property
+    def x(self):
+        return self.X[self.index]
+
+    @property
+    def y(self):
+        return self.y_all[self.index]
+
+    @property
+    def features(self):
+        """{name: (features of the split, processed indices within the split)} like ::func::irelease.utils.get_fp"""
+        if self.features_all is None:
+            return None
+        features = {}
+        for name, (mat, row) in self.features_all.items():
+            split_rows = row[self.index]
+            valid = split_rows >= 0
+            features[name] = (mat[split_rows[valid]], np.flatnonzero(valid))
+        return features
+
+    def with_features(self, features):
+        return IndexedSplit(self.X, self.y_all, self.index, features)
+
+    def __len__(self):
+        return 2 if self.features_all is None else 3
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+        if self.features_all is not None:
+            yield self.features
+
+    def __getitem__(self, item):
+        getters = [lambda: self.x, lambda: self.y, lambda: self.features][:len(self)]
+        if isinstance(item, slice):
+            return tuple(g() for g in getters[item])
+        return getters[item]()
+
+
+def _pack_splits(data_dict):
+    """
+    Returns {'X': X, 'y': y, 'splits': {key: index or {part: index}}} for caching the splits of `data_dict`. X and y
+    are stored once: joblib does not memoize arrays, so dumping the splits themselves would write y once per split.
+    """
+    splits = {}
+    for key, val in data_dict.items():
+        if isinstance(val, dict):  # CV fold
+            splits[key] = {part: split.index for part, split in val.items()}
+        else:
+            splits[key] = val.index
+    first = next(iter(data_dict.values()))
+    first = next(iter(first.values())) if isinstance(first, dict) else first
+    return {'X': first.X, 'y': first.y_all, 'splits': splits}
+
+
+def _unpack_splits(cache):
+    """Rebuilds the ::class::IndexedSplit objects, sharing X and y, from the output of ::func::_pack_splits."""
+    X, y = cache['X'], cache['y']
+    data_dict = {}
+    for key, val in cache['splits'].items():
+        if isinstance(val, dict):  # CV fold
+            data_dict[key] = {part: IndexedSplit(X, y, index) for part, index in val.items()}
+        else:
+            data_dict[key] = IndexedSplit(X, y, val)
+    return data_dict
+
+
+def _featurize_splits(data_dict, featurizers, cache_prefix, reload, log):
+    """
+    Featurizes the SMILES shared by the splits of `data_dict` once and attaches the features to every split (see
+    ::class::IndexedSplit), so that each split unpacks as (x, y, {featurizer name: (features, processed_indices)}).
+    Features are saved as .npy files next to the cached splits and memory-mapped (read-only) when loaded.
+    """
+    splits = [s for v in data_dict.values() for s in (v.values() if isinstance(v, dict) else [v])]
+    X = splits[0].X
+    features = {}
+    for name, fn in featurizers.items():
+        mat_file = f'{cache_prefix}_{name}.npy'
+        row_file = f'{cache_prefix}_{name}_row.npy'
+        if not (reload and os.path.exists(mat_file) and os.path.exists(row_file)):
+            log(f'Featurizing data with {name}...')
+            mat, processed_indices, _ = fn(X)
+            row = np.full((len(X),), -1, dtype=np.int64)
+            row[np.asarray(processed_indices, dtype=np.int64)] = np.arange(len(processed_indices))
+            np.save(mat_file, np.asarray(mat))
+            np.save(row_file, row)
+        features[name] = (np.load(mat_file, mmap_mode='r'), np.load(row_file))
+
+    featurized = {}
+    for key, val in data_dict.items():
+        if isinstance(val, dict):  # CV fold
+            featurized[key] = {part: split.with_features(features) for part, split in val.items()}
+        else:
+            featurized[key] = val.with_features(features)
+    return featurized
+
 
 def load_smiles_data(file, cv, normalize_y=True, k=5, header=0, index_col=0, delimiter=',', x_y_cols=(0, 1),
-                     reload=True, seed=None, verbose=True, shuffle=0, create_val=True, train_size=0.8):
+                     reload=True, seed=None, verbose=True, shuffle=0, create_val=True, train_size=0.8,
+                     chunk_size=100000, featurizers=None):
+    """
+    Loads a SMILES property file and splits it into train/val/test sets (or CV folds of such sets). Every split is an
+    ::class::IndexedSplit over the shared X and y that unpacks like an (x, y) tuple.
+
+    Splits are cached next to the data file under a key derived from the file contents and every parameter that
+    affects the splits, so editing the file or changing the split parameters never returns stale splits.
+
+    :param featurizers: dict
+        Optional {name: callable} featurizers following the convention of ::func::irelease.utils.get_fp, i.e.
+        callable(smiles) -> (features, processed_indices, invalid_indices). The SMILES of the data set are featurized
+        once, and each split unpacks with a third element {name: (features, processed_indices)}. The features are
+        cached as memory-mappable .npy files next to the splits; the name identifies the featurization in the cache.
+    """
     assert (os.path.exists(file)), f'File {file} cannot be found.'
     assert (0 < train_size < 1), 'Train set size must be between (0,1)'
 
@@ -28,29 +192,37 @@ def load_smiles_data(file, cv, normalize_y=True, k=5, header=0, index_col=0, del
     transformer = None
     data_dir, filename = os.path.split(file)
     suffix = '_cv' if cv else '_std'
-    save_dir = os.path.join(data_dir, filename.split('.')[0] + f'_data_dict{suffix}.joblib')
-    trans_save_dir = os.path.join(data_dir, filename.split('.')[0] + f'_transformer{suffix}.joblib')
+    split_params = {'format': 'shared_index', 'cv': bool(cv), 'normalize_y': normalize_y, 'k': k, 'header': header,
+                    'index_col': index_col, 'delimiter': delimiter, 'x_y_cols': list(x_y_cols), 'seed': seed,
+                    'shuffle': shuffle, 'create_val': create_val, 'train_size': train_size}
+    cache_key = hashlib.sha1((file_digest(file) + json.dumps(split_params, sort_keys=True)).encode()).hexdigest()
+    cache_prefix = os.path.join(data_dir, filename.split('.')[0] + f'{suffix}_{cache_key[:16]}')
+    save_dir = cache_prefix + '_data_dict.joblib'
+    trans_save_dir = cache_prefix + '_transformer.joblib'
 
     # Load data if possible
     if reload and os.path.exists(save_dir):
         log('Loading data...')
         with open(save_dir, 'rb') as f:
-            data_dict = joblib.load(f)
+            data_dict = _unpack_splits(joblib.load(f))
             transformer = None
         if os.path.exists(trans_save_dir):
             with open(trans_save_dir, 'rb') as f:
                 transformer = joblib.load(f)
         log('Data loaded successfully')
+        if featurizers:
+            data_dict = _featurize_splits(data_dict, featurizers, cache_prefix, reload, log)
         return data_dict, transformer
 
-    # Read and process data
-    dataframe = pd.read_csv(file, header=header, index_col=index_col, delimiter=delimiter)
+    # Read and process data. The file is streamed in chunks and only the X and y columns of each chunk are kept.
+    chunks = pd.read_csv(file, header=header, index_col=index_col, delimiter=delimiter, chunksize=chunk_size)
+    dataframe = pd.concat([c[[c.columns[x_y_cols[0]], c.columns[x_y_cols[1]]]] for c in chunks])
     if shuffle > 0:
         for i in range(shuffle):
             dataframe = shuffle_data(dataframe)
     log(f'Loaded data size = {dataframe.shape}')
-    X = dataframe[dataframe.columns[x_y_cols[0]]].values
-    y = dataframe[dataframe.columns[x_y_cols[1]]].values.reshape(-1, 1)
+    X = dataframe[dataframe.columns[0]].values
+    y = dataframe[dataframe.columns[1]].values.reshape(-1, 1)
     if normalize_y:
         log('Normalizing labels...')
         transformer = StandardScaler()
@@ -58,36 +230,37 @@ def load_smiles_data(file, cv, normalize_y=True, k=5, header=0, index_col=0, del
     log(f'Data directory in use is {data_dir}')
 
     # Split data
+    # Splits are index arrays over the shared X and y (see ::class::IndexedSplit)
     if cv:
         log(f'Splitting data into {k} folds. Each fold has train, val, and test sets.')
         cv_split = KFold(k, shuffle=True, random_state=seed)
         for i, (train_idx, test_idx) in enumerate(cv_split.split(X, y)):
-            x_train, y_train = X[train_idx], y[train_idx]
             if create_val:
-                x_val, x_test, y_val, y_test = train_test_split(X[test_idx], y[test_idx], test_size=.5,
-                                                                random_state=seed)
-                data_dict[f'fold_{i}'] = {'train': (x_train, y_train),
-                                          'val': (x_val, y_val),
-                                          'test': (x_test, y_test)}
+                val_idx, test_idx = train_test_split(test_idx, test_size=.5, random_state=seed)
+                data_dict[f'fold_{i}'] = {'train': IndexedSplit(X, y, train_idx),
+                                          'val': IndexedSplit(X, y, val_idx),
+                                          'test': IndexedSplit(X, y, test_idx)}
             else:
-                data_dict[f'fold_{i}'] = {'train': (x_train, y_train),
-                                          'test': (X[test_idx], y[test_idx])}
+                data_dict[f'fold_{i}'] = {'train': IndexedSplit(X, y, train_idx),
+                                          'test': IndexedSplit(X, y, test_idx)}
         log('CV splitting completed')
     else:
         log('Splitting data into train, val, and test sets...')
-        x_train, x_test, y_train, y_test = train_test_split(X, y, test_size=1 - train_size, random_state=seed)
-        data_dict['train'] = (x_train, y_train)
+        train_idx, test_idx = train_test_split(np.arange(len(X)), test_size=1 - train_size, random_state=seed)
+        data_dict['train'] = IndexedSplit(X, y, train_idx)
         if create_val:
-            x_val, y_val, x_test, y_test = train_test_split(x_test, y_test, test_size=0.5, random_state=seed)
-            data_dict['val'] = (x_val, y_val)
-        data_dict['test'] = (x_test, y_test)
+            val_idx, test_idx = train_test_split(test_idx, test_size=0.5, random_state=seed)
+            data_dict['val'] = IndexedSplit(X, y, val_idx)
+        data_dict['test'] = IndexedSplit(X, y, test_idx)
         log('Splitting completed.')
 
     # Persist data if allowed
     if reload:
         with open(save_dir, 'wb') as f:
-            joblib.dump(dict(data_dict), f)
+            joblib.dump(_pack_splits(data_dict), f)
         if normalize_y:
             with open(trans_save_dir, 'wb') as f:
                 joblib.dump(transformer, f)
+    if featurizers:
+        data_dict = _featurize_splits(data_dict, featurizers, cache_prefix, reload, log)
     return data_dict, transformer
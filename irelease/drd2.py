@@ -2,11 +2,14 @@ import pickle
 import rdkit.Chem as Chem
 from rdkit.Chem import AllChem
 import numpy as np
+from joblib import Parallel, delayed
 
 
 class DRD2Model:
     """Scores based on an ECFP classifier for activity."""
 
+    fp_size = 2048
+
     def __init__(self, path):
         with open(path, "rb") as f:
             self.clf = pickle.load(f)
@@ -19,12 +22,75 @@ class DRD2Model:
             return float(score)
         return 0.0
 
+    def predict_batch(self, smiles, batch_size=1024, n_jobs=1):
+        """
+        Scores a list of SMILES with one `predict_proba` call per chunk.
+
+        :param smiles: list
+            SMILES strings to be scored.
+        :param batch_size: int
+            Number of molecules featurized and scored together.
+        :param n_jobs: int
+            Number of worker processes used for featurization. Scoring is always done in the calling process.
+        :return: numpy.ndarray
+            Activity probabilities. Invalid SMILES are scored 0.0, as in `__call__`.
+        """
+        scores = np.zeros((len(smiles),), dtype=np.float64)
+        for i in range(0, len(smiles), batch_size):
+            chunk = smiles[i:i + batch_size]
+            fps, valid_idx = DRD2Model.fingerprints_from_smiles(chunk, n_jobs=n_jobs)
+            if len(valid_idx) > 0:
+                scores[i + valid_idx] = self.clf.predict_proba(fps)[:, 1]
+        return scores
+
     @classmethod
     def fingerprints_from_mol(cls, mol):
-        fp = AllChem.GetMorganFingerprint(mol, 3, useCounts=True, useFeatures=True)
-        size = 2048
-        nfp = np.zeros((1, size), np.int32)
-        for idx, v in fp.GetNonzeroElements().items():
-            nidx = idx % size
-            nfp[0, nidx] += int(v)
-        return nfp
+        return cls.fingerprints_from_mols([mol])
+
+    @classmethod
+    def fingerprints_from_mols(cls, mols):
+        """
+        Folds the Morgan count fingerprints of the given molecules into a (len(mols), fp_size) int32 matrix.
+        The folding of all molecules is done with a single `np.bincount` over flattened (row, bit) indices.
+        """
+        size = cls.fp_size
+        rows, cols, counts = [], [], []
+        for i, mol in enumerate(mols):
+            elements = AllChem.GetMorganFingerprint(mol, 3, useCounts=True, useFeatures=True).GetNonzeroElements()
+            if elements:
+                rows.append(np.full(len(elements), i, dtype=np.int64))
+                cols.append(np.fromiter(elements.keys(), dtype=np.int64, count=len(elements)))
+                counts.append(np.fromiter(elements.values(), dtype=np.int64, count=len(elements)))
+        if not rows:
+            return np.zeros((len(mols), size), np.int32)
+        flat_idx = np.concatenate(rows) * size + np.concatenate(cols) % size
+        nfp = np.bincount(flat_idx, weights=np.concatenate(counts), minlength=len(mols) * size)
+        return nfp.reshape(len(mols), size).astype(np.int32)
+
+    @classmethod
+    def fingerprints_from_smiles(cls, smiles, n_jobs=1):
+        """
+        Parses and featurizes SMILES, optionally sharding the work across `n_jobs` processes.
+
+        :return: tuple
+            [0] int32 fingerprint matrix of the valid molecules
+            [1] indices (into `smiles`) of the valid molecules
+        """
+        if n_jobs == 1 or len(smiles) < 2 * n_jobs:
+            return _featurize_chunk(smiles, cls)
+        shard_size = int(np.ceil(len(smiles) / n_jobs))
+        shards = [smiles[i:i + shard_size] for i in range(0, len(smiles), shard_size)]
+        results = Parallel(n_jobs=n_jobs)(delayed(_featurize_chunk)(shard, cls) for shard in shards)
+        fps = np.concatenate([r[0] for r in results], axis=0)
+        valid_idx = np.concatenate([r[1] + i * shard_size for i, r in enumerate(results)])
+        return fps, valid_idx
+
+
+def _featurize_chunk(smiles, model_cls):
+    mols, valid_idx = [], []
+    for i, sm in enumerate(smiles):
+        mol = Chem.MolFromSmiles(sm)
+        if mol:
+            mols.append(mol)
+            valid_idx.append(i)
+    return model_cls.fingerprints_from_mols(mols), np.array(valid_idx, dtype=np.int64)
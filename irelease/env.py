@@ -22,7 +22,7 @@ class MoleculeEnv(gym.Env):
     Arguments:
     ----------
     :param actions: list or tuple
-        Actions allowed in the environment. Thus, the unique set of SMILES characters.
+        Actions allowed in the environment. Thus, the unique set of SMILES characters or (atom-level) tokens.
     :param reward_func:
         Instance of ::class::RewardFunction. It provides the reward function for the environment.
     :param start_char:
@@ -30,7 +30,7 @@ class MoleculeEnv(gym.Env):
     :param end_char:
         Character that denotes the end of a SMILES string during generation.
     :param max_len:
-        The maximum number of characters that could be contained in a generated string.
+        The maximum number of tokens that could be contained in a generated string.
     :param seed:
         Seed value for the numpy PRNG used in by the environment.
     """
@@ -53,7 +53,7 @@ class MoleculeEnv(gym.Env):
         return self._state
 
     def step(self, action):
-        assert isinstance(action, str) and len(action) == 1
+        assert isinstance(action, str)
         assert self.action_space.contains(action), 'Selected action is out of range.'
         prev_state = copy.deepcopy(self._state)
         state = self._state + [action]
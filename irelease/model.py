@@ -14,7 +14,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from irelease.utils import init_hidden, init_cell, pad_sequences, seq2tensor
+from irelease.utils import init_hidden, init_cell, pad_sequences, get_vocabulary
 
 
 def clone(module, N):
@@ -557,6 +557,102 @@ class StackRNN(nn.Module):
         return new_stack
 
 
+@torch.jit.script
+def _stack_rnn_scan(gx, hidden, cell, stack, w_h, b_h, w_top, has_stack: bool, is_lstm: bool, stack_width: int):
+    """
+    Runs the recurrence of ::class::StackRNN over a full sequence.
+
+    :param gx: (seq_len, batch_size, num_gates * hidden_size) input projections of all the positions.
+    :param w_h: rows of the stack controls, stack input and hidden-to-hidden weights. They all take the previous hidden
+        state, so one matmul per step computes them together.
+    :param w_top: input-to-hidden weights of the stack top.
+    """
+    gh_start = 3 + stack_width if has_stack else 0
+    outputs = []
+    for t in range(gx.size(0)):
+        hp = torch.addmm(b_h, hidden, w_h.t())
+        gi = gx[t]
+        if has_stack:
+            controls = torch.softmax(hp[:, :3], dim=-1).unsqueeze(-1)
+            stack_input = torch.tanh(hp[:, 3:gh_start])
+            a_push, a_pop, a_no_op = controls[:, 0:1], controls[:, 1:2], controls[:, 2:3]
+            # Same as ::meth::StackRNN.stack_augmentation, without the shifted copies of the stack
+            new_stack = a_no_op * stack
+            new_stack[:, 0].add_(a_push[:, 0] * stack_input)
+            new_stack[:, 1:].add_(a_push * stack[:, :-1])
+            new_stack[:, :-1].add_(a_pop * stack[:, 1:])
+            stack = new_stack
+            gi = torch.addmm(gi, stack[:, 0], w_top.t())
+        gh = hp[:, gh_start:]
+        if is_lstm:
+            i, f, g, o = (gi + gh).chunk(4, 1)
+            cell = torch.sigmoid(f) * cell + torch.sigmoid(i) * torch.tanh(g)
+            hidden = torch.sigmoid(o) * torch.tanh(cell)
+        else:
+            i_r, i_z, i_n = gi.chunk(3, 1)
+            h_r, h_z, h_n = gh.chunk(3, 1)
+            r = torch.sigmoid(i_r + h_r)
+            z = torch.sigmoid(i_z + h_z)
+            n = torch.tanh(i_n + r * h_n)
+            hidden = (1. - z) * n + z * hidden
+        outputs.append(hidden)
+    return torch.stack(outputs), hidden, cell, stack
+
+
+class FusedStackRNN(StackRNN):
+    """
+    ::class::StackRNN for full-sequence (teacher forcing) passes. It has the same parameters, so checkpoints of either
+    layer load into the other, and computes the same outputs with a TorchScript loop that:
+        - projects the inputs of all positions with a single matmul before the loop,
+        - computes the stack controls, stack input and hidden-to-hidden projections with one matmul per step,
+        - updates the stack without allocating its shifted copies (see ::meth::StackRNN.stack_augmentation).
+    """
+
+    @classmethod
+    def from_layer(cls, layer):
+        """Creates a fused copy of the given ::class::StackRNN, sharing no parameters with it."""
+        input_size = layer.rnn.input_size - (layer.stack_width if layer.has_stack else 0)
+        fused = cls(layer.layer_index, input_size, layer.hidden_size, layer.has_stack, layer.unit_type,
+                    layer.stack_width, layer.stack_depth, bias=layer.rnn.bias, k_mask_func=layer.k_padding_mask_func)
+        fused.load_state_dict(layer.state_dict())
+        return fused.to(layer.rnn.weight_hh_l0.device)
+
+    def forward(self, inp, **kwargs):
+        x, hidden_states = inp[0], inp[self.layer_index]
+        if x.shape[0] == 1:
+            # Step-wise sampling: concatenating the weights would cost more than the single step
+            return super(FusedStackRNN, self).forward(inp, **kwargs)
+        hidden, cell, stack = hidden_states
+        in_dim = x.shape[-1]
+        w_ih, w_hh = self.rnn.weight_ih_l0, self.rnn.weight_hh_l0
+        if self.rnn.bias:
+            b_ih, b_hh = self.rnn.bias_ih_l0, self.rnn.bias_hh_l0
+        else:
+            b_ih, b_hh = None, torch.zeros(w_hh.shape[0], dtype=w_hh.dtype, device=w_hh.device)
+        gx = F.linear(x, w_ih[:, :in_dim], b_ih)
+        if self.has_stack:
+            w_h = torch.cat([self.stack_controls_layer.weight, self.stack_input_layer.weight, w_hh])
+            b_h = torch.cat([self.stack_controls_layer.bias, self.stack_input_layer.bias, b_hh])
+        else:
+            w_h, b_h, stack = w_hh, b_hh, hidden
+        c0 = cell[0] if self.has_cell else hidden[0]
+        outputs, h_n, c_n, stack = _stack_rnn_scan(gx, hidden[0], c0, stack, w_h, b_h, w_ih[:, in_dim:],
+                                                   self.has_stack, self.has_cell, self.stack_width)
+        inp[0] = outputs
+        if not self.has_stack:
+            stack = hidden_states[2]
+        inp[self.layer_index] = (h_n.unsqueeze(0), c_n.unsqueeze(0) if self.has_cell else cell, stack)
+        return inp
+
+
+def fuse_stack_rnn_layers(model):
+    """Replaces the ::class::StackRNN layers of an nn.Sequential model with ::class::FusedStackRNN copies in place."""
+    for name, module in model.named_children():
+        if type(module) is StackRNN:
+            setattr(model, name, FusedStackRNN.from_layer(module))
+    return model
+
+
 # class StackRNNLinear(nn.Module):
 #     """Linearly projects Stack RNN outputs to a fixed dimension"""
 #
@@ -842,17 +938,72 @@ class RNNPredictorModel(nn.Module):
         :return: tensor
             predictions corresponding to x.
         """
-        batch_size = len(x)
-        x, states_len = pad_sequences(x)
-        x, _ = seq2tensor(x, self.tokens)
-        x = torch.from_numpy(x).long().to(self.device)
+        if not torch.is_tensor(x):
+            x = self.tokenize(x)
+        return self.forward_tokens(x)
+
+    def tokenize(self, x):
+        """Pads the given SMILES strings and maps them to a LongTensor of token indices (batch_size, seq_len)"""
+        return self.tokenize_smiles(x, self.tokens, self.device)
+
+    @staticmethod
+    def tokenize_smiles(x, tokens, device='cpu'):
+        """::meth::tokenize without a model instance, e.g. for the TorchScript experts."""
+        x, states_len = pad_sequences(list(x))
+        x = get_vocabulary(tokens).encode(x)
+        return torch.from_numpy(x).long().to(device)
+
+    def forward_tokens(self, x):
+        """
+        Forward propagation on already tokenized input. This keeps string processing out of the graph so that the
+        model could be traced with TorchScript.
+
+        :param x: tensor
+            Token indices of shape (batch_size, seq_len)
+        :return: tensor
+            predictions of shape (batch_size, 1)
+        """
+        batch_size = x.size(0)
         x = self.encoder(x)
         x = x.permute(1, 0, 2)
-        h0 = torch.zeros(self.num_layers * self.num_directions, batch_size, self.d_model).to(self.device)
+        h0 = torch.zeros(self.num_layers * self.num_directions, batch_size, self.d_model, device=x.device)
         if self.unit_type == 'lstm':
-            c0 = torch.zeros(self.num_layers * self.num_directions, batch_size, self.d_model).to(self.device)
+            c0 = torch.zeros(self.num_layers * self.num_directions, batch_size, self.d_model, device=x.device)
             h0 = (h0, c0)
         x, hidden = self.rnn(x, h0)
         x = x[-1, :, :].reshape(batch_size, -1)
         x = self.read_out(x)
         return x
+
+
+class RNNPredictorEnsemble(nn.Module):
+    """
+    Pools the predictions of the fold models of an RNN expert on tokenized input. It is the module exported to
+    TorchScript by ::func::predictor.export_rnn_predictor.
+
+    Arguments:
+    -----------
+    :param models: list
+        ::class::RNNPredictorModel instances (one per fold).
+    :param is_binary: bool
+        If True, a sigmoid is applied to every fold output and the folds are averaged. Otherwise the minimum over
+        the folds is taken.
+    :param y_mean: float
+        Mean of the label transformer (regression only).
+    :param y_scale: float
+        Scale of the label transformer (regression only). Since the transformer is an affine map with a positive
+        scale, applying it after the min-pooling gives the same result as applying it to every fold.
+    """
+
+    def __init__(self, models, is_binary=False, y_mean=0., y_scale=1.):
+        super(RNNPredictorEnsemble, self).__init__()
+        self.models = nn.ModuleList(models)
+        self.is_binary = is_binary
+        self.register_buffer('y_mean', torch.tensor(float(y_mean)))
+        self.register_buffer('y_scale', torch.tensor(float(y_scale)))
+
+    def forward(self, x):
+        outputs = torch.stack([model.forward_tokens(x) for model in self.models])
+        if self.is_binary:
+            return torch.sigmoid(outputs).mean(dim=0)
+        return outputs.min(dim=0)[0] * self.y_scale + self.y_mean
@@ -18,10 +18,11 @@ import numpy as np
 from rdkit import DataStructs, Chem
 from rdkit import rdBase
 from rdkit.Chem import AllChem as Chem, AllChem
-from rdkit.Chem import Crippen, MolFromSmiles, MolToSmiles
+from rdkit.Chem import Crippen
 from rdkit.Chem import Descriptors
 
 import irelease
+from irelease.utils import smiles_info
 
 # Disables logs for Smiles conversion
 
@@ -269,7 +270,10 @@ def pct(a, b):
 
 
 def canon_smile(smile):
-    return MolToSmiles(MolFromSmiles(smile))
+    canon, valid, _ = smiles_info(smile)
+    if not valid:
+        raise ValueError(f'Invalid SMILES: {smile}')
+    return canon
 
 
 def verified_and_below(smile, max_len):
@@ -277,8 +281,8 @@ def verified_and_below(smile, max_len):
 
 
 def verify_sequence(smile):
-    mol = Chem.MolFromSmiles(smile)
-    return smile != '' and mol is not None and mol.GetNumAtoms() > 1
+    _, valid, num_atoms = smiles_info(smile)
+    return smile != '' and valid and num_atoms > 1
 
 
 def compute_results(samples, results={}, verbose=True):
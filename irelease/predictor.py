@@ -4,56 +4,299 @@
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import copy
+import math
 import os
+import threading
+import time
+from collections import deque
 
 import joblib
 import numpy as np
-import rdkit.Chem as Chem
 import torch
 from tqdm import tqdm
 from xgboost import DMatrix
 
 from irelease.drd2 import DRD2Model
-from irelease.model import RNNPredictorModel
-from irelease.utils import get_default_tokens, get_fp
+from irelease.model import RNNPredictorModel, RNNPredictorEnsemble
+from irelease.utils import get_default_tokens, get_fp, get_fp_onbits, canonical_smiles, smiles_info
 
 
 class Predictor:
+    # Set by ::class::InstrumentedPredictor to collect the time spent in each stage of `predict`.
+    profiler = None
+
     def predict(self, *args, **kwargs):
         pass
 
     def __call__(self, *args, **kwargs):
         return self.predict(*args, **kwargs)
 
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the enclosed block as the given stage if the predictor is instrumented."""
+        if self.profiler is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.profiler.record_stage(name, time.perf_counter() - start)
+
+    def canonicalize(self, smiles, use_tqdm=False):
+        """
+        Converts the given SMILES to their canonical forms.
+
+        :return: tuple
+            [0] canonical SMILES of the valid SMILES
+            [1] invalid SMILES
+        """
+        canonical_smiles = []
+        invalid_smiles = []
+        if use_tqdm:
+            pbar = tqdm(range(len(smiles)))
+        else:
+            pbar = range(len(smiles))
+        with self.stage('canonicalization'):
+            for i in pbar:
+                sm = smiles[i]
+                if use_tqdm:
+                    pbar.set_description("Calculating predictions...")
+                canon, valid, _ = smiles_info(sm, sanitize=False)
+                if not valid:
+                    invalid_smiles.append(sm)
+                elif len(canon) == 0:
+                    invalid_smiles.append(canon)
+                else:
+                    canonical_smiles.append(canon)
+        return canonical_smiles, invalid_smiles
+
+
+class PredictorStats(object):
+    """
+    Latency and throughput statistics of a predictor.
+
+    Arguments:
+    -----------
+    :param window: int
+        Number of most recent calls used for the latency percentiles and batch size histogram.
+    """
+
+    stages = ('canonicalization', 'featurization', 'model')
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.num_molecules = 0
+        self.num_invalid = 0
+        self.total_time = 0.
+        self.stage_time = {k: 0. for k in self.stages}
+        self.latencies = deque(maxlen=self.window)
+        self.batch_sizes = deque(maxlen=self.window)
+
+    def record_stage(self, name, secs):
+        self.stage_time[name] = self.stage_time.get(name, 0.) + secs
+
+    def record_call(self, batch_size, num_invalid, secs):
+        self.calls += 1
+        self.num_molecules += batch_size
+        self.num_invalid += num_invalid
+        self.total_time += secs
+        self.latencies.append(secs)
+        self.batch_sizes.append(batch_size)
+
+    def batch_size_histogram(self):
+        """Counts of calls per batch size bucket. Buckets are powers of 2: 1, 2, (2, 4], (4, 8], ..."""
+        hist = {}
+        for bs in self.batch_sizes:
+            bucket = 1 if bs <= 1 else 2 ** int(math.ceil(math.log2(bs)))
+            hist[bucket] = hist.get(bucket, 0) + 1
+        return dict(sorted(hist.items()))
+
+    def as_dict(self):
+        latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        stats = {'calls': self.calls,
+                 'molecules': self.num_molecules,
+                 'invalid_rate': self.num_invalid / max(1, self.num_molecules),
+                 'total_time': self.total_time,
+                 'molecules_per_sec': self.num_molecules / self.total_time if self.total_time > 0 else 0.,
+                 'latency_p50': float(p50),
+                 'latency_p95': float(p95),
+                 'latency_p99': float(p99),
+                 'batch_size_hist': self.batch_size_histogram()}
+        for k in self.stage_time:
+            stats[f'{k}_time'] = self.stage_time[k]
+        return stats
+
+    def write_to_tensorboard(self, writer, step_idx, prefix='expert'):
+        stats = self.as_dict()
+        writer.add_scalars(f'{prefix}_latency', {'p50': stats['latency_p50'],
+                                                 'p95': stats['latency_p95'],
+                                                 'p99': stats['latency_p99']}, step_idx)
+        writer.add_scalars(f'{prefix}_time', {k: stats[f'{k}_time'] for k in self.stage_time}, step_idx)
+        writer.add_scalar(f'{prefix}_calls', stats['calls'], step_idx)
+        writer.add_scalar(f'{prefix}_invalid_rate', stats['invalid_rate'], step_idx)
+        writer.add_scalar(f'{prefix}_molecules_per_sec', stats['molecules_per_sec'], step_idx)
+        if len(self.batch_sizes) > 0:
+            writer.add_histogram(f'{prefix}_batch_size', np.array(self.batch_sizes), step_idx)
+        return stats
+
+
+class InstrumentedPredictor(Predictor):
+    """
+    Wraps any ::class::Predictor and records its latency and throughput statistics (see ::class::PredictorStats).
+    All other attributes are delegated to the wrapped predictor.
+    """
+
+    def __init__(self, predictor, window=10000):
+        assert isinstance(predictor, Predictor)
+        self.predictor = predictor
+        self.stats = PredictorStats(window)
+        predictor.profiler = self.stats
+
+    def predict(self, smiles, *args, **kwargs):
+        start = time.perf_counter()
+        results = self.predictor.predict(smiles, *args, **kwargs)
+        self.stats.record_call(len(smiles), len(results[2]), time.perf_counter() - start)
+        return results
+
+    def __getattr__(self, item):
+        if item == 'predictor':
+            raise AttributeError(item)
+        return getattr(self.predictor, item)
+
+
+# Process-level registry of expert ensembles. Predictors constructed with the same model directory (and model
+# configuration) share one ensemble so that the fold models are only ever loaded once per process.
+_ensemble_registry = {}
+_registry_lock = threading.Lock()
+
+
+class LazyEnsemble(object):
+    """
+    Holds the fold models of an expert ensemble saved in a dedicated folder. A fold model is only loaded the first
+    time it is accessed. Any file with 'transformer' in its name is treated as the label transformer.
+
+    Arguments:
+    -----------
+    :param model_dir: str
+        The folder containing the fold models (and transformer).
+    :param load_fn: callable
+        Takes the path of a fold model file and returns the loaded model.
+    """
+
+    def __init__(self, model_dir, load_fn):
+        assert callable(load_fn)
+        self.model_dir = model_dir
+        self.transformer = None
+        self.model_files = []
+        for model_file in sorted(os.listdir(model_dir)):
+            path = os.path.join(model_dir, model_file)
+            if 'transformer' in model_file:
+                self.transformer = joblib.load(path)
+            else:
+                self.model_files.append(path)
+        self._load_fn = load_fn
+        self._models = [None] * len(self.model_files)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.model_files)
+
+    def __getitem__(self, i):
+        if self._models[i] is None:
+            with self._lock:
+                if self._models[i] is None:
+                    self._models[i] = self._load_fn(self.model_files[i])
+        return self._models[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def num_loaded(self):
+        return sum(m is not None for m in self._models)
+
+
+def get_ensemble(key, model_dir, load_fn):
+    """Returns the ensemble registered under `key`, creating it on the first request."""
+    key = (os.path.realpath(model_dir),) + tuple(key)
+    with _registry_lock:
+        if key not in _ensemble_registry:
+            _ensemble_registry[key] = LazyEnsemble(model_dir, load_fn)
+        return _ensemble_registry[key]
+
+
+def clear_ensemble_registry():
+    with _registry_lock:
+        _ensemble_registry.clear()
+
+
+def mmap_torch_load(path, device):
+    """Loads a state dict with its storages memory-mapped (shared by all processes reading the same file)."""
+    try:
+        return torch.load(path, map_location=torch.device(device), mmap=True)
+    except (TypeError, RuntimeError):  # older torch versions or legacy (non-zip) serialization format
+        return torch.load(path, map_location=torch.device(device))
+
+
+def mmap_joblib_load(path):
+    """Loads a joblib-persisted model with its numpy arrays memory-mapped (read-only)."""
+    return joblib.load(path, mmap_mode='r')
+
+
+def load_script_model(path, device):
+    """Loads (once per process) a TorchScript expert artifact created with ::func::export_rnn_predictor."""
+    key = (os.path.realpath(path), 'torchscript', str(device))
+    with _registry_lock:
+        if key not in _ensemble_registry:
+            _ensemble_registry[key] = torch.jit.load(path, map_location=torch.device(device)).eval()
+        return _ensemble_registry[key]
+
 
 class RNNPredictor(Predictor):
     def __init__(self, hparams, device, is_binary=False):
-        expert_model_dir = hparams['model_dir']
-        assert (os.path.isdir(expert_model_dir)), 'Expert model(s) should be in a dedicated folder'
-        self.models = []
+        self.hparams = hparams
         self.tokens = get_default_tokens()
         self.device = device
-        model_paths = os.listdir(expert_model_dir)
-        self.transformer = None
         self.is_binary = is_binary
-        for model_file in model_paths:
-            if 'transformer' in model_file:
-                with open(os.path.join(expert_model_dir, model_file), 'rb') as f:
-                    self.transformer = joblib.load(f)
-                    continue
-            model = RNNPredictorModel(d_model=hparams['d_model'],
-                                      tokens=self.tokens,
-                                      num_layers=hparams['rnn_num_layers'],
-                                      dropout=hparams['dropout'],
-                                      bidirectional=hparams['is_bidirectional'],
-                                      unit_type=hparams['unit_type'],
-                                      device=device).to(device)
-            if is_binary:
-                model = torch.nn.Sequential(model, torch.nn.Sigmoid()).to(device)
-            model.load_state_dict(torch.load(os.path.join(expert_model_dir, model_file),
-                                             map_location=torch.device(device)))
-            model = model.eval()
-            self.models.append(model)
+        self.script_model = None
+        self.models = None
+        if hparams.get('script_model'):
+            # TorchScript artifact: the fold models, pooling and label transformer are all inside the graph.
+            assert os.path.isfile(hparams['script_model']), f'{hparams["script_model"]} cannot be found'
+            self.script_model = load_script_model(hparams['script_model'], device)
+            return
+        expert_model_dir = hparams['model_dir']
+        assert (os.path.isdir(expert_model_dir)), 'Expert model(s) should be in a dedicated folder'
+        hparams_key = tuple(sorted((k, str(v)) for k, v in hparams.items() if k != 'model_dir'))
+        self.models = get_ensemble(('rnn', str(device), is_binary, hparams_key), expert_model_dir,
+                                   self._load_model)
+
+    @property
+    def transformer(self):
+        return None if self.models is None else self.models.transformer
+
+    def _load_model(self, path):
+        hparams = self.hparams
+        model = RNNPredictorModel(d_model=hparams['d_model'],
+                                  tokens=self.tokens,
+                                  num_layers=hparams['rnn_num_layers'],
+                                  dropout=hparams['dropout'],
+                                  bidirectional=hparams['is_bidirectional'],
+                                  unit_type=hparams['unit_type'],
+                                  device=self.device).to(self.device)
+        if self.is_binary:
+            model = torch.nn.Sequential(model, torch.nn.Sigmoid()).to(self.device)
+        model.load_state_dict(mmap_torch_load(path, self.device))
+        return model.eval()
 
     @torch.no_grad()
     def predict(self, smiles, use_tqdm=False):
@@ -65,187 +308,300 @@ class RNNPredictor(Predictor):
         :param use_tqdm: bool
         :return:
         """
-        canonical_smiles = []
-        invalid_smiles = []
-        if use_tqdm:
-            pbar = tqdm(range(len(smiles)))
-        else:
-            pbar = range(len(smiles))
-        for i in pbar:
-            sm = smiles[i]
-            if use_tqdm:
-                pbar.set_description("Calculating predictions...")
-            try:
-                sm = Chem.MolToSmiles(Chem.MolFromSmiles(sm, sanitize=False))
-                if len(sm) == 0:
-                    invalid_smiles.append(sm)
-                else:
-                    canonical_smiles.append(sm)
-            except:
-                invalid_smiles.append(sm)
+        canonical_smiles, invalid_smiles = self.canonicalize(smiles, use_tqdm)
         if len(canonical_smiles) == 0:
             return canonical_smiles, [], invalid_smiles
-        prediction = []
-        for i in range(len(self.models)):
-            y_pred = self.models[i](canonical_smiles).detach().cpu().numpy()
-            if not self.is_binary and self.transformer is not None:
-                y_pred = self.transformer.inverse_transform(y_pred)
-            prediction.append(y_pred)
-        prediction = np.array(prediction)
-        pool = np.mean if self.is_binary else np.min
-        prediction = pool(prediction, axis=0)
+        with self.stage('featurization'):
+            x = RNNPredictorModel.tokenize_smiles(canonical_smiles, self.tokens, self.device)
+        with self.stage('model'):
+            if self.script_model is not None:
+                prediction = self.script_model(x).detach().cpu().numpy()
+                return canonical_smiles, prediction, invalid_smiles
+            prediction = []
+            for i in range(len(self.models)):
+                y_pred = self.models[i](x).detach().cpu().numpy()
+                if not self.is_binary and self.transformer is not None:
+                    y_pred = self.transformer.inverse_transform(y_pred)
+                prediction.append(y_pred)
+            prediction = np.array(prediction)
+            pool = np.mean if self.is_binary else np.min
+            prediction = pool(prediction, axis=0)
         return canonical_smiles, prediction, invalid_smiles
 
 
+@torch.no_grad()
+def export_rnn_predictor(hparams, path, is_binary=False, quantize=False, example_smiles=None):
+    """
+    Traces the fold models of an RNN expert into a single TorchScript artifact for CPU serving. Tokenization stays
+    outside the graph (see ::meth::RNNPredictorModel.tokenize_smiles). The artifact could be used by setting
+    `hparams['script_model']` when creating an ::class::RNNPredictor.
+
+    :param hparams: dict
+        The hyperparameters used to create the ::class::RNNPredictor of the float model.
+    :param path: str
+        Where the artifact would be saved.
+    :param is_binary: bool
+        Whether the expert is a binary classifier.
+    :param quantize: bool
+        If True, int8 dynamic quantization is applied to the LSTM and Linear layers before tracing.
+    :param example_smiles: list
+        SMILES used as the tracing input.
+    :return: the traced module
+    """
+    float_predictor = RNNPredictor(hparams, 'cpu', is_binary)
+    models = [m[0] if is_binary else m for m in float_predictor.models]
+    transformer = float_predictor.transformer
+    y_mean, y_scale = 0., 1.
+    if not is_binary and transformer is not None:
+        # mean_/scale_ are None when the transformer was fit with with_mean=False/with_std=False
+        if getattr(transformer, 'mean_', None) is not None and getattr(transformer, 'with_mean', True):
+            y_mean = float(transformer.mean_[0])
+        if getattr(transformer, 'scale_', None) is not None:
+            y_scale = float(transformer.scale_[0])
+    ensemble = RNNPredictorEnsemble(copy.deepcopy(models), is_binary, y_mean, y_scale).eval()
+    if quantize:
+        ensemble = torch.quantization.quantize_dynamic(ensemble, {torch.nn.LSTM, torch.nn.Linear},
+                                                       dtype=torch.qint8)
+    if example_smiles is None:
+        example_smiles = ['CC(=O)Oc1ccccc1C(=O)O', 'CCO']
+    example = RNNPredictorModel.tokenize_smiles(example_smiles, float_predictor.tokens)
+    traced = torch.jit.trace(ensemble, example, check_trace=False)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    traced.save(path)
+    return traced
+
+
+def compare_predictors(reference, candidate, smiles, labels=None, is_binary=False, threshold=0.5):
+    """
+    Reports how far the predictions of `candidate` (e.g. a quantized TorchScript expert) are from those of
+    `reference` (e.g. the float model) on a held-out set.
+
+    :return: dict
+    """
+    canon, valid_vec = canonical_smiles(smiles, sanitize=False)
+    valid_idx = [i for i, v in enumerate(valid_vec) if v and len(canon[i]) > 0]
+    smiles = [canon[i] for i in valid_idx]
+    y_ref = np.asarray(reference(smiles)[1]).reshape(-1)
+    y_cand = np.asarray(candidate(smiles)[1]).reshape(-1)
+    diff = np.abs(y_ref - y_cand)
+    results = {'num_molecules': len(smiles),
+               'mean_abs_diff': float(np.mean(diff)),
+               'max_abs_diff': float(np.max(diff))}
+    if labels is not None:
+        y_true = np.asarray(labels, dtype=np.float64)[valid_idx]
+        if is_binary:
+            results['reference_accuracy'] = float(np.mean((y_ref >= threshold) == (y_true >= threshold)))
+            results['candidate_accuracy'] = float(np.mean((y_cand >= threshold) == (y_true >= threshold)))
+            results['accuracy_delta'] = results['candidate_accuracy'] - results['reference_accuracy']
+        else:
+            results['reference_rmse'] = float(np.sqrt(np.mean(np.square(y_ref - y_true))))
+            results['candidate_rmse'] = float(np.sqrt(np.mean(np.square(y_cand - y_true))))
+            results['rmse_delta'] = results['candidate_rmse'] - results['reference_rmse']
+    return results
+
+
+def _split_svr_pipeline(model):
+    """
+    Splits a fold model into its input scaling and its SVR.
+
+    :return: tuple
+        [0] (mean, scale) of the StandardScaler preceding the SVR, or (None, None) when there is none.
+        [1] the fitted SVR, or None when the model is not a (StandardScaler ->) SVR pipeline.
+    """
+    steps = [s for _, s in model.steps] if hasattr(model, 'steps') else [model]
+    svr = steps[-1]
+    if not hasattr(svr, 'dual_coef_') or getattr(svr, 'kernel', None) not in ('rbf', 'linear', 'poly', 'sigmoid'):
+        return (None, None), None
+    if len(steps) == 1:
+        return (None, None), svr
+    if len(steps) == 2 and type(steps[0]).__name__ == 'StandardScaler':
+        scaler = steps[0]
+        mean = scaler.mean_ if scaler.with_mean else None
+        scale = scaler.scale_ if scaler.with_std else None
+        return (mean, scale), svr
+    return (None, None), None
+
+
+class SVREnsemble(object):
+    """
+    Evaluates the decision functions of the SVR fold models of an expert with dense, chunked kernel blocks, i.e. one
+    BLAS matmul per chunk of query rows and fold instead of libsvm's row-by-row kernel evaluations. Folds that are not
+    (StandardScaler ->) SVR pipelines are evaluated with their own `predict`.
+
+    The support vectors of different folds are not shared: every fold has its own StandardScaler and gamma, so their
+    kernels are computed in different spaces.
+
+    :param models: sequence
+        The fitted fold models.
+    :param chunk_size: int
+        Number of query rows per kernel block. This bounds memory to chunk_size x (number of support vectors of a fold).
+    """
+
+    def __init__(self, models, chunk_size=256):
+        self.chunk_size = chunk_size
+        self.num_folds = len(models)
+        self.folds = []
+        self.fallback = []
+        for fold, model in enumerate(models):
+            (mean, scale), svr = _split_svr_pipeline(model)
+            if svr is None:
+                self.fallback.append((fold, model))
+                continue
+            sv = svr.support_vectors_
+            sv = (sv.toarray() if hasattr(sv, 'toarray') else np.asarray(sv)).astype(np.float64)
+            self.folds.append({'fold': fold, 'kernel': svr.kernel, 'gamma': float(getattr(svr, '_gamma', 0.)),
+                               'coef0': float(svr.coef0), 'degree': int(svr.degree), 'mean': mean, 'scale': scale,
+                               'svs': sv, 'sv_sq_norms': np.einsum('ij,ij->i', sv, sv),
+                               'dual_coef': np.asarray(svr.dual_coef_, np.float64).ravel(),
+                               'intercept': float(np.ravel(svr.intercept_)[0])})
+
+    @property
+    def num_support_vectors(self):
+        return sum(len(f['svs']) for f in self.folds)
+
+    @staticmethod
+    def _kernel(fold, x):
+        gram = x @ fold['svs'].T
+        if fold['kernel'] == 'linear':
+            return gram
+        if fold['kernel'] == 'poly':
+            return (fold['gamma'] * gram + fold['coef0']) ** fold['degree']
+        if fold['kernel'] == 'sigmoid':
+            return np.tanh(fold['gamma'] * gram + fold['coef0'])
+        sq_dists = np.einsum('ij,ij->i', x, x)[:, None] + fold['sv_sq_norms'][None, :] - 2. * gram
+        return np.exp(-fold['gamma'] * np.maximum(sq_dists, 0.))
+
+    def decision_functions(self, x):
+        """
+        :param x: array-like
+            Query features of shape (n, num_features).
+        :return: numpy.ndarray
+            Predictions of every fold, of shape (num_folds, n).
+        """
+        x = x.toarray() if hasattr(x, 'toarray') else np.asarray(x)
+        out = np.empty((self.num_folds, x.shape[0]), dtype=np.float64)
+        for fold in self.folds:
+            for i in range(0, x.shape[0], self.chunk_size):
+                xc = x[i:i + self.chunk_size].astype(np.float64)
+                if fold['mean'] is not None:
+                    xc = xc - fold['mean']
+                if fold['scale'] is not None:
+                    xc = xc / fold['scale']
+                out[fold['fold'], i:i + len(xc)] = self._kernel(fold, xc) @ fold['dual_coef'] + fold['intercept']
+        for fold, model in self.fallback:
+            out[fold] = model.predict(x)
+        return out
+
+
 class SVRPredictor(Predictor):
-    def __init__(self, expert_model_dir):
+    def __init__(self, expert_model_dir, chunk_size=256):
         assert (os.path.isdir(expert_model_dir)), 'Expert model(s) should be in a dedicated folder'
-        self.models = []
-        model_paths = os.listdir(expert_model_dir)
-        self.transformer = None
-        for model_file in model_paths:
-            if 'transformer' in model_file:
-                with open(os.path.join(expert_model_dir, model_file), 'rb') as f:
-                    self.transformer = joblib.load(f)
-                    continue
-            with open(os.path.join(expert_model_dir, model_file), 'rb') as f:
-                model = joblib.load(f)
-                self.models.append(model)
+        self.models = get_ensemble(('svr',), expert_model_dir, mmap_joblib_load)
+        self.chunk_size = chunk_size
+        self._evaluator = None
+
+    @property
+    def transformer(self):
+        return self.models.transformer
+
+    @property
+    def evaluator(self):
+        if self._evaluator is None:
+            self._evaluator = SVREnsemble([self.models[i] for i in range(len(self.models))], self.chunk_size)
+        return self._evaluator
 
     def predict(self, smiles, get_features=get_fp, use_tqdm=False):
-        canonical_smiles = []
-        invalid_smiles = []
-        if use_tqdm:
-            pbar = tqdm(range(len(smiles)))
-        else:
-            pbar = range(len(smiles))
-        for i in pbar:
-            sm = smiles[i]
-            if use_tqdm:
-                pbar.set_description("Calculating predictions...")
-            try:
-                sm = Chem.MolToSmiles(Chem.MolFromSmiles(sm, sanitize=False))
-                if len(sm) == 0:
-                    invalid_smiles.append(sm)
-                else:
-                    canonical_smiles.append(sm)
-            except:
-                invalid_smiles.append(sm)
+        canonical_smiles, invalid_smiles = self.canonicalize(smiles, use_tqdm)
         if len(canonical_smiles) == 0:
             return canonical_smiles, [], invalid_smiles
-        prediction = []
-        x, _, _ = get_features(canonical_smiles, sanitize=False)
-        for i in range(len(self.models)):
-            y_pred = self.models[i].predict(x)
+        with self.stage('featurization'):
+            x, _, _ = get_features(canonical_smiles, sanitize=False)
+        with self.stage('model'):
+            prediction = np.min(self.evaluator.decision_functions(x), axis=0)
             if self.transformer is not None:
-                y_pred = self.transformer.inverse_transform(y_pred)
-            prediction.append(y_pred)
-        prediction = np.array(prediction)
-        prediction = np.min(prediction, axis=0)
+                # inverse transformation of a StandardScaler is monotone, so it commutes with the min over folds
+                prediction = self.transformer.inverse_transform(prediction.reshape(-1, 1)).ravel()
         return canonical_smiles, prediction, invalid_smiles
 
 
+def _load_booster(path, nthread=None):
+    booster = mmap_joblib_load(path)
+    if nthread is not None:
+        booster.set_param({'nthread': nthread})
+    return booster
+
+
 class XGBPredictor(Predictor):
-    def __init__(self, expert_model_dir):
+    """
+    Averages the predictions of the XGBoost fold models.
+
+    Arguments:
+    -----------
+    :param expert_model_dir: str
+        Folder containing the fold boosters (and transformer).
+    :param nthread: int
+        The number of threads every booster is pinned to. Single-molecule calls (e.g. in the reward functions) are
+        faster with a single thread.
+    :param batch_size: int
+        Maximum number of molecules featurized and evaluated at once. The default covers the SMILES sampled in an
+        RL episode in a single pass.
+    """
+
+    def __init__(self, expert_model_dir, nthread=1, batch_size=512):
         assert (os.path.isdir(expert_model_dir)), 'Expert model(s) should be in a dedicated folder'
-        self.models = []
-        model_paths = os.listdir(expert_model_dir)
-        self.transformer = None
-        for model_file in model_paths:
-            if 'transformer' in model_file:
-                with open(os.path.join(expert_model_dir, model_file), 'rb') as f:
-                    self.transformer = joblib.load(f)
-                    continue
-            with open(os.path.join(expert_model_dir, model_file), 'rb') as f:
-                model = joblib.load(f)
-                self.models.append(model)
+        self.batch_size = batch_size
+        self.models = get_ensemble(('xgb', nthread), expert_model_dir,
+                                   lambda path: _load_booster(path, nthread))
 
-    def predict(self, smiles, get_features=get_fp, use_tqdm=False):
-        canonical_smiles = []
-        invalid_smiles = []
-        if use_tqdm:
-            pbar = tqdm(range(len(smiles)))
-        else:
-            pbar = range(len(smiles))
-        for i in pbar:
-            sm = smiles[i]
-            if use_tqdm:
-                pbar.set_description("Calculating predictions...")
-            try:
-                sm = Chem.MolToSmiles(Chem.MolFromSmiles(sm, sanitize=False))
-                if len(sm) == 0:
-                    invalid_smiles.append(sm)
-                else:
-                    canonical_smiles.append(sm)
-            except:
-                invalid_smiles.append(sm)
+    @property
+    def transformer(self):
+        return self.models.transformer
+
+    def predict(self, smiles, get_features=get_fp_onbits, use_tqdm=False):
+        canonical_smiles, invalid_smiles = self.canonicalize(smiles, use_tqdm)
         if len(canonical_smiles) == 0:
             return canonical_smiles, [], invalid_smiles
-        prediction = []
-        x, _, _ = get_features(canonical_smiles, sanitize=False)
-        x = DMatrix(x)
-        for i in range(len(self.models)):
-            y_pred = self.models[i].predict(x)
+        prediction = np.zeros((len(canonical_smiles),), dtype=np.float32)
+        for i in range(0, len(canonical_smiles), self.batch_size):
+            with self.stage('featurization'):
+                x, _, _ = get_features(canonical_smiles[i:i + self.batch_size], sanitize=False)
+                x = np.asarray(x, dtype=np.float32)
+            with self.stage('model'):
+                self._predict_folds(x, prediction[i:i + self.batch_size])
+        with self.stage('model'):
+            # averaging and the label transformer (affine) commute, so the transformer is applied once.
+            prediction /= len(self.models)
             if self.transformer is not None:
-                y_pred = self.transformer.inverse_transform(y_pred)
-            prediction.append(y_pred)
-        prediction = np.array(prediction)
-        prediction = np.mean(prediction, axis=0)
+                prediction = self.transformer.inverse_transform(prediction.reshape(-1, 1)).reshape(-1)
         return canonical_smiles, prediction, invalid_smiles
 
+    def _predict_folds(self, x, out):
+        """Accumulates the predictions of all fold boosters on the feature matrix x into out."""
+        for booster in self.models:
+            if hasattr(booster, 'inplace_predict'):
+                out += booster.inplace_predict(x)
+            else:  # xgboost < 1.1 has no in-place prediction
+                out += booster.predict(DMatrix(x))
+
 
 class SVCPredictor(Predictor):
-    def __init__(self, svc_path):
+    def __init__(self, svc_path, batch_size=1024, n_jobs=1):
         self.svc = DRD2Model(svc_path)
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
 
     def predict(self, smiles, use_tqdm=False):
-        canonical_smiles = []
-        invalid_smiles = []
-        if use_tqdm:
-            pbar = tqdm(range(len(smiles)))
-        else:
-            pbar = range(len(smiles))
-        for i in pbar:
-            sm = smiles[i]
-            if use_tqdm:
-                pbar.set_description("Calculating predictions...")
-            try:
-                sm = Chem.MolToSmiles(Chem.MolFromSmiles(sm, sanitize=False))
-                if len(sm) == 0:
-                    invalid_smiles.append(sm)
-                else:
-                    canonical_smiles.append(sm)
-            except:
-                invalid_smiles.append(sm)
+        canonical_smiles, invalid_smiles = self.canonicalize(smiles, use_tqdm)
         if len(canonical_smiles) == 0:
             return canonical_smiles, [], invalid_smiles
-        prediction = []
-        for smiles in canonical_smiles:
-            prediction.append(self.svc(smiles))
-        prediction = np.array(prediction)
+        with self.stage('model'):
+            prediction = self.svc.predict_batch(canonical_smiles, batch_size=self.batch_size, n_jobs=self.n_jobs)
         return canonical_smiles, prediction, invalid_smiles
 
 
 class DummyPredictor(Predictor):
     def predict(self, smiles, use_tqdm=False):
-        canonical_smiles = []
-        invalid_smiles = []
-        if use_tqdm:
-            pbar = tqdm(range(len(smiles)))
-        else:
-            pbar = range(len(smiles))
-        for i in pbar:
-            sm = smiles[i]
-            if use_tqdm:
-                pbar.set_description("Calculating predictions...")
-            try:
-                sm = Chem.MolToSmiles(Chem.MolFromSmiles(sm, sanitize=False))
-                if len(sm) == 0:
-                    invalid_smiles.append(sm)
-                else:
-                    canonical_smiles.append(sm)
-            except:
-                invalid_smiles.append(sm)
+        canonical_smiles, invalid_smiles = self.canonicalize(smiles, use_tqdm)
         if len(canonical_smiles) == 0:
             return canonical_smiles, [], invalid_smiles
         prediction = np.zeros((len(canonical_smiles),))
@@ -285,28 +641,28 @@ def get_drd2_activity_baseline_reward(smiles, predictor, invalid_reward=0.0):
 
 
 def get_jak2_max_reward(smiles, predictor, invalid_reward=0.0):
-    mol, pred, nan_smiles = predictor.predict([smiles], get_features=get_fp)
+    mol, pred, nan_smiles = predictor.predict([smiles])
     if len(nan_smiles) == 1:
         return invalid_reward
     return float(np.exp(pred[0] / 3))
 
 
 def get_jak2_max_baseline_reward(smiles, predictor, invalid_reward=0.0):
-    mol, pred, nan_smiles = predictor.predict([smiles], get_features=get_fp)
+    mol, pred, nan_smiles = predictor.predict([smiles])
     if len(nan_smiles) == 1:
         return invalid_reward
     return float(pred[0])
 
 
 def get_jak2_min_reward(smiles, predictor, invalid_reward=0.0):
-    mol, prop, nan_smiles = predictor.predict([smiles], get_features=get_fp)
+    mol, prop, nan_smiles = predictor.predict([smiles])
     if len(nan_smiles) == 1:
         return invalid_reward
     return float(np.exp(-prop[0] / 3 + 3))
 
 
 def get_jak2_min_baseline_reward(smiles, predictor, invalid_reward=0.0):
-    mol, prop, nan_smiles = predictor.predict([smiles], get_features=get_fp)
+    mol, prop, nan_smiles = predictor.predict([smiles])
     if len(nan_smiles) == 1:
         return invalid_reward
     return float(-prop[0])
@@ -9,7 +9,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import torch
 
 from irelease.monte_carlo import MoleculeMonteCarloTreeSearchNode, MonteCarloTreeSearch
-from irelease.utils import canonical_smiles, seq2tensor
+from irelease.utils import canonical_smiles, get_vocabulary
 
 
 class RewardFunction:
@@ -90,8 +90,7 @@ class RewardFunction:
             else:
                 smiles, valid_vec = canonical_smiles([state])
                 valid_vec = torch.tensor(valid_vec).view(-1, 1).float().to(self.device)
-                inp, _ = seq2tensor([state], tokens=self.actions)
-                inp = torch.from_numpy(inp).long().to(self.device)
+                inp = torch.from_numpy(get_vocabulary(self.actions).encode([x.tolist()])).long().to(self.device)
                 reward = self.model([inp, valid_vec]).squeeze().item()
             return self.reward_wrapper(reward)
 
@@ -16,7 +16,8 @@ from ptan.agent import BaseAgent
 from torch.optim.lr_scheduler import StepLR
 from tqdm import trange
 
-from irelease.utils import seq2tensor, get_default_tokens, pad_sequences, canonical_smiles
+from irelease.smiles_syntax import SmilesSyntaxMask
+from irelease.utils import seq2tensor, get_vocabulary, pad_sequences, bulk_canonical_smiles
 
 EpisodeStep = namedtuple('EpisodeStep', ['state', 'action'])
 Trajectory = namedtuple('Trajectory', ['terminal_state', 'traj_prob'])
@@ -64,11 +65,23 @@ class StateActionProbRegistry:
 
 
 class PolicyAgent(BaseAgent):
+    """
+    Samples the actions (tokens) of an agent network.
+
+    :param syntax_mask: SmilesSyntaxMask
+        Optional mask of the actions that would make the SMILES of the current state syntactically invalid
+        (see ::class::irelease.smiles_syntax.SmilesSyntaxMask). The probabilities of the masked policy are the ones
+        recorded in the probability registry. The same mask must be given to the training algorithm (::class::REINFORCE,
+        ::class::PPO) so that its log-probabilities are those of the masked sampling policy.
+    """
+
     def __init__(self, model, action_selector, states_preprocessor=seq2tensor, initial_state=None,
-                 initial_state_args=None, apply_softmax=True, device='cpu', probs_registry=None):
+                 initial_state_args=None, apply_softmax=True, device='cpu', probs_registry=None, syntax_mask=None):
         assert callable(states_preprocessor)
         if probs_registry:
             assert isinstance(probs_registry, StateActionProbRegistry)
+        if syntax_mask:
+            assert isinstance(syntax_mask, SmilesSyntaxMask)
         if initial_state:
             assert callable(initial_state)
             assert isinstance(initial_state_args, dict)
@@ -80,6 +93,7 @@ class PolicyAgent(BaseAgent):
         self.init_state = initial_state
         self.initial_state_args = initial_state_args
         self.probs_reg = probs_registry
+        self.syntax_mask = syntax_mask
 
     def initial_state(self):
         return self.init_state(batch_size=1, **self.initial_state_args)
@@ -107,6 +121,13 @@ class PolicyAgent(BaseAgent):
             agent_states = outputs[1:]
         else:  # trans-decoder
             probs_v = outputs
+        if self.syntax_mask:
+            valid_actions = self.syntax_mask.prefix_mask(states[0]).to(probs_v.device)
+            if self.apply_softmax:
+                probs_v = probs_v.masked_fill(~valid_actions, float('-inf'))
+            else:
+                probs_v = probs_v * valid_actions
+                probs_v = probs_v / probs_v.sum(dim=-1, keepdim=True)
         if self.apply_softmax:
             probs_v = torch.softmax(probs_v, dim=-1)
         probs = probs_v.data.cpu().squeeze().numpy()
@@ -166,6 +187,17 @@ def unpack_batch(trajs, gamma):
     return batch_states, batch_actions, batch_qvals
 
 
+def _syntax_masked(logits, prefixes, syntax_mask):
+    """
+    Sets the logits of the actions that ::class::irelease.smiles_syntax.SmilesSyntaxMask forbids after each prefix
+    (one row of `logits` per prefix) to -inf, as ::class::PolicyAgent does when sampling.
+    """
+    if syntax_mask is None:
+        return logits
+    masks = torch.stack([syntax_mask.prefix_mask(prefix) for prefix in prefixes]).to(logits.device)
+    return logits.masked_fill(~masks, float('-inf'))
+
+
 def unpack_trajectory(traj, gamma, delayed_reward):
     states, actions, rewards = [], [], []
     for exp in traj:
@@ -182,9 +214,13 @@ def unpack_trajectory(traj, gamma, delayed_reward):
 class REINFORCE(DRLAlgorithm):
     def __init__(self, model, optimizer, initial_states_func, initial_states_args, gamma=0.97, grad_clipping=None,
                  lr_decay_gamma=0.1, prior_data_gen=None, xent_lambda=0.3, lr_decay_step=100, device='cpu',
-                 delayed_reward=False):
+                 delayed_reward=False, tokens=None, syntax_mask=None):
         assert callable(initial_states_func)
         assert isinstance(initial_states_args, dict)
+        if syntax_mask:
+            assert isinstance(syntax_mask, SmilesSyntaxMask)
+        self.syntax_mask = syntax_mask
+        self.vocab = get_vocabulary(tokens)
         self.model = model
         self.optimizer = optimizer
         self.lr_scheduler = StepLR(optimizer, step_size=lr_decay_step, gamma=lr_decay_gamma)
@@ -211,15 +247,17 @@ class REINFORCE(DRLAlgorithm):
         for t in trange(len(trajectories), desc='REINFORCE opt...'):
             trajectory = trajectories[t]
             states, actions, q_values = unpack_trajectory(trajectory, self.gamma, self.delayed_reward)
-            (states, state_len), actions = _preprocess_states_actions(actions, states, self.device)
+            last_state = list(states[-1])
+            (states, state_len), actions = _preprocess_states_actions(actions, states, self.device, self.vocab)
             hidden_states = self.initial_states_func(1, **self.initial_states_args)
-            trajectory_input = states[-1]  # since the last state captures all previous states
-            for p in range(len(trajectory)):
-                outputs = self.model([trajectory_input[p].reshape(1, 1)] + hidden_states)
-                output, hidden_states = outputs[0], outputs[1:]
-                log_prob = torch.log_softmax(output.view(1, -1), dim=1)
-                top_i = actions[p]
-                rl_loss = rl_loss - (float(q_values[p]) * log_prob[0, top_i])
+            # The last state captures all previous states, so the whole trajectory is a single teacher-forced pass
+            n = len(trajectory)
+            trajectory_input = states[-1][:n].reshape(1, n)
+            output = self.model([trajectory_input] + hidden_states)[0].view(n, -1)
+            output = _syntax_masked(output, [last_state[:p + 1] for p in range(n)], self.syntax_mask)
+            log_prob = torch.log_softmax(output, dim=1)
+            q_values = torch.tensor(q_values[:n], dtype=log_prob.dtype, device=log_prob.device)
+            rl_loss = rl_loss - (q_values * log_prob[range(n), actions[:n]]).sum()
 
         # Ensure pretraining effort isn't wiped out.
         xent_loss = 0.
@@ -245,15 +283,13 @@ class REINFORCE(DRLAlgorithm):
         return rl_loss.item()
 
 
-def _preprocess_states_actions(actions, states, device):
-    # Process states and actions
-    states = [''.join(list(state)) for state in states]
+def _preprocess_states_actions(actions, states, device, vocab):
+    # Process states and actions. States are kept as token lists so that lengths are counted in tokens.
+    states = [list(state) for state in states]
     states, states_len = pad_sequences(states)
-    states, _ = seq2tensor(states, get_default_tokens())
-    states = torch.from_numpy(states).long().to(device)
+    states = torch.from_numpy(vocab.encode(states)).long().to(device)
     states_len = torch.tensor(states_len).long().to(device)
-    actions, _ = seq2tensor(actions, get_default_tokens())
-    actions = torch.from_numpy(actions.reshape(-1)).long().to(device)
+    actions = torch.from_numpy(vocab.encode(actions).reshape(-1)).long().to(device)
     return (states, states_len), actions
 
 
@@ -275,9 +311,14 @@ class PPO(DRLAlgorithm):
     """
 
     def __init__(self, actor, critic, actor_opt, critic_opt, initial_states_func, initial_states_args, gamma=0.99,
-                 gae_lambda=0.95, ppo_eps=0.2, ppo_epochs=10, ppo_batch=64, entropy_beta=0.01, device='cpu'):
+                 gae_lambda=0.95, ppo_eps=0.2, ppo_epochs=10, ppo_batch=64, entropy_beta=0.01, device='cpu',
+                 tokens=None, syntax_mask=None):
         assert callable(initial_states_func)
         assert isinstance(initial_states_args, dict)
+        if syntax_mask:
+            assert isinstance(syntax_mask, SmilesSyntaxMask)
+        self.syntax_mask = syntax_mask
+        self.vocab = get_vocabulary(tokens)
         self.actor = actor
         self.critic = critic
         self.actor_opt = actor_opt
@@ -298,9 +339,8 @@ class PPO(DRLAlgorithm):
 
     def calc_adv_ref(self, trajectory):
         states, actions, _ = unpack_batch([trajectory], self.gamma)
-        last_state = ''.join(list(states[-1]))
-        inp, _ = seq2tensor([last_state], tokens=get_default_tokens())
-        inp = torch.from_numpy(inp).long().to(self.device)
+        last_state = list(states[-1])
+        inp = torch.from_numpy(self.vocab.encode([last_state])).long().to(self.device)
         values_v = self.critic(inp)
         values = values_v.view(-1, ).data.cpu().numpy()
         last_gae = 0.0
@@ -337,13 +377,16 @@ class PPO(DRLAlgorithm):
         batch_adv = (batch_adv - batch_adv.mean()) / batch_adv.std()
 
         # Calculate old probs of actions
-        (states, states_len), actions, = _preprocess_states_actions(batch_actions, batch_states, self.device)
+        prefixes = [list(state) for state in batch_states]
+        (states, states_len), actions, = _preprocess_states_actions(batch_actions, batch_states, self.device,
+                                                                    self.vocab)
         hidden_states = self.initial_states_func(batch_size=states.shape[0], **self.initial_states_args)
         with torch.set_grad_enabled(False):
             outputs = self.actor([states] + hidden_states)
         x = outputs[0]
         states_len = states_len - 1  # to select actions since samples are padded
         x = torch.cat([x[states_len[i], i, :].reshape(1, -1) for i in range(x.shape[1])], dim=0).to(self.device)
+        x = _syntax_masked(x, prefixes, self.syntax_mask)
         old_log_probs = torch.log_softmax(x, dim=-1).detach()
         old_log_probs = old_log_probs[range(old_log_probs.shape[0]), actions]
 
@@ -376,6 +419,7 @@ class PPO(DRLAlgorithm):
                 x_v = self.actor([states_v] + hidden_states_v)
                 x_v = x_v[0]
                 x_v = torch.cat([x_v[states_len_v[i], i, :].reshape(1, -1) for i in range(x_v.shape[1])], dim=0)
+                x_v = _syntax_masked(x_v, prefixes[batch_ofs:batch_ofs + self.ppo_batch], self.syntax_mask)
                 logprob_pi_v = torch.log_softmax(x_v, dim=-1)
                 logprob_pi_v = logprob_pi_v[range(logprob_pi_v.shape[0]), actions_v]
                 ratio_v = torch.exp(logprob_pi_v - old_log_probs_v)
@@ -388,9 +432,23 @@ class PPO(DRLAlgorithm):
                 self.actor_opt.step()
         return np.mean(sum_loss_value), np.mean(sum_loss_policy)
 
+    def _trajectory_log_probs(self, model, last_state, actions):
+        """
+        Log-probabilities of the actions of a trajectory, computed with a single teacher-forced pass over its last
+        state (which captures all previous states).
+        """
+        last_state = list(last_state)
+        n = len(last_state)
+        inp = torch.from_numpy(self.vocab.encode([last_state])).long().to(self.device)
+        hidden_states = self.initial_states_func(batch_size=1, **self.initial_states_args)
+        output = model([inp] + hidden_states)[0].view(n, -1)
+        output = _syntax_masked(output, [last_state[:p + 1] for p in range(n)], self.syntax_mask)
+        actions = torch.from_numpy(self.vocab.encode([list(actions[:n])])).long().to(self.device).view(-1)
+        return torch.log_softmax(output, dim=-1)[range(n), actions]
+
     @torch.enable_grad()
     def fit(self, trajectories):
-        sq2ten = lambda x: torch.from_numpy(seq2tensor(x, get_default_tokens())[0]).long().to(self.device)
+        sq2ten = lambda x: torch.from_numpy(self.vocab.encode(x)).long().to(self.device)
         t_states, t_actions, t_adv, t_ref = [], [], [], []
         t_old_probs = []
         for traj in trajectories:
@@ -403,16 +461,8 @@ class PPO(DRLAlgorithm):
             t_ref.append(ref_v)
 
             with torch.set_grad_enabled(False):
-                hidden_states = self.initial_states_func(batch_size=1, **self.initial_states_args)
-                trajectory_input = sq2ten(states[-1])
-                actions = sq2ten(actions)
-                old_probs = []
-                for p in range(len(trajectory_input)):
-                    outputs = self.model([trajectory_input[p].reshape(1, 1)] + hidden_states)
-                    output, hidden_states = outputs[0], outputs[1:]
-                    log_prob = torch.log_softmax(output.view(1, -1), dim=1)
-                    old_probs.append(log_prob[0, actions[p]].item())
-                t_old_probs.append(old_probs)
+                log_prob = self._trajectory_log_probs(self.model, states[-1], actions)
+                t_old_probs.append(log_prob.detach())
 
         if len(t_states) == 0:
             return 0., 0.
@@ -426,32 +476,22 @@ class PPO(DRLAlgorithm):
                 traj_adv = t_adv[i]
                 traj_ref = t_ref[i]
                 traj_old_probs = t_old_probs[i]
-                hidden_states = self.initial_states_func(1, **self.initial_states_args)
                 for p in range(len(traj_last_state)):
-                    state, action, adv = traj_last_state[p], traj_actions[p], traj_adv[p]
-                    old_log_prob = traj_old_probs[p]
-                    state, action = sq2ten(state), sq2ten(action)
-
                     # Critic
-                    pred = self.critic(state)
+                    pred = self.critic(sq2ten(traj_last_state[p]))
                     cr_loss = cr_loss + F.mse_loss(pred.reshape(-1, 1), traj_ref[p].reshape(-1, 1))
 
-                    # Actor
-                    outputs = self.actor([state] + hidden_states)
-                    output, hidden_states = outputs[0], outputs[1:]
-                    logprob_pi_v = torch.log_softmax(output.view(1, -1), dim=-1)
-                    logprob_pi_v = logprob_pi_v[0, action]
-                    ratio_v = torch.exp(logprob_pi_v - old_log_prob)
-                    surr_obj_v = adv * ratio_v
-                    clipped_surr_v = adv * torch.clamp(ratio_v, 1.0 - self.ppo_eps, 1.0 + self.ppo_eps)
-                    loss_policy_v = torch.min(surr_obj_v, clipped_surr_v)
-
-                    # Maximize entropy
-                    prob = torch.softmax(output.view(1, -1), dim=1)
-                    prob = prob[0, action]
-                    entropy = prob * logprob_pi_v
-                    entropy_loss = self.entropy_beta * entropy
-                    ac_loss = ac_loss - (loss_policy_v + entropy_loss)
+                # Actor
+                logprob_pi_v = self._trajectory_log_probs(self.actor, traj_last_state, traj_actions)
+                ratio_v = torch.exp(logprob_pi_v - traj_old_probs)
+                surr_obj_v = traj_adv * ratio_v
+                clipped_surr_v = traj_adv * torch.clamp(ratio_v, 1.0 - self.ppo_eps, 1.0 + self.ppo_eps)
+                loss_policy_v = torch.min(surr_obj_v, clipped_surr_v)
+
+                # Maximize entropy
+                entropy = torch.exp(logprob_pi_v) * logprob_pi_v
+                entropy_loss = self.entropy_beta * entropy
+                ac_loss = ac_loss - (loss_policy_v + entropy_loss).sum()
             # Update weights
             self.critic_opt.zero_grad()
             self.actor_opt.zero_grad()
@@ -526,13 +566,12 @@ class GuidedRewardLearningIRL(DRLAlgorithm):
             self.replay_buffer.populate(trajectories)
         d_traj, d_traj_probs = [], []
         for traj in trajectories:
-            d_traj.append(''.join(list(traj.terminal_state.state)) + traj.terminal_state.action)
+            d_traj.append(list(traj.terminal_state.state) + [traj.terminal_state.action])
             d_traj_probs.append(traj.traj_prob)
-        _, valid_vec_samp = canonical_smiles(d_traj)
+        _, valid_vec_samp = bulk_canonical_smiles([''.join(t) for t in d_traj])
         valid_vec_samp = torch.tensor(valid_vec_samp).view(-1, 1).float().to(self.device)
         d_traj, _ = pad_sequences(d_traj)
-        d_samp, _ = seq2tensor(d_traj, tokens=get_default_tokens())
-        d_samp = torch.from_numpy(d_samp).long().to(self.device)
+        d_samp = torch.from_numpy(self.demo_gen_data.vocab.encode(d_traj)).long().to(self.device)
         losses = []
         for i in trange(self.k, desc='IRL optimization...'):
             # D_demo processing
@@ -0,0 +1,330 @@
+# Author: bbrighttaer
+# Project: IReLeaSE
+# Date: 10/19/2026
+# Time: 4:40 PM
+# File: sampling.py
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import math
+import os
+from collections import namedtuple, deque
+
+import torch
+from tqdm import tqdm
+
+from irelease.utils import generate_smiles, bulk_canonical_smiles
+
+SampleBatch = namedtuple('SampleBatch', ['smiles', 'canonical', 'valid'])
+UniqueSamples = namedtuple('UniqueSamples', ['smiles', 'invalid', 'num_samples', 'num_valid', 'num_duplicates',
+                                             'aborted'])
+
+
+def iter_smiles(generator, gen_data, init_args, num_samples, batch_size=500, max_len=100, prime_str='<',
+                end_token='>', canonicalize=False, n_jobs=1, syntax_mask=False):
+    """
+    Samples SMILES from a generator in batches, so that only one batch is held in memory at a time.
+
+    Arguments:
+    ------------
+    :param generator: nn.Module
+        The model for generating SMILES.
+    :param gen_data:
+        Object of ::class::data.GeneratorData.
+    :param init_args: dict
+        Arguments for facilitating the creation of initial states. See ::func::irelease.utils.generate_smiles.
+    :param num_samples: int
+        Total number of SMILES to sample.
+    :param batch_size: int
+        Number of SMILES sampled per batch.
+    :param canonicalize: bool
+        Whether the canonical forms and validity of the samples are also computed. The process-wide SMILES cache is
+        bypassed so that memory stays bounded for large runs.
+    :param n_jobs: int
+        Number of canonicalization workers. See ::func::irelease.utils.bulk_smiles_info.
+    :param syntax_mask: bool
+        Whether sampling is restricted to syntactically valid SMILES. See ::func::irelease.utils.generate_smiles.
+    :return: generator
+        ::class::SampleBatch of each batch. canonical and valid are None when canonicalize is False.
+    """
+    assert batch_size > 0
+    was_training = generator.training
+    try:
+        remaining = num_samples
+        while remaining > 0:
+            n = min(batch_size, remaining)
+            samples = generate_smiles(generator, gen_data, init_args, prime_str=prime_str, end_token=end_token,
+                                      max_len=max_len, num_samples=n, is_train=False, syntax_mask=syntax_mask)
+            canonical, valid = None, None
+            if canonicalize:
+                canonical, valid = bulk_canonical_smiles(samples, n_jobs=n_jobs, cache=False)
+            remaining -= n
+            yield SampleBatch(samples, canonical, valid)
+    finally:
+        if was_training:
+            generator.train()
+
+
+class SmilesWriter(object):
+    """
+    Appends sampled SMILES to a file, one batch at a time. The format is given by the file extension:
+        .smi: tab-separated rows without a header
+        .csv: comma-separated rows with a header
+        .parquet: columnar file with one row group per batch (requires pyarrow)
+
+    Arguments:
+    ------------
+    :param path: str
+        The output file.
+    :param columns: list
+        Column names of the rows written.
+    """
+
+    formats = ('.smi', '.csv', '.parquet')
+
+    def __init__(self, path, columns=('smiles',)):
+        self.path = path
+        self.columns = list(columns)
+        self.format = os.path.splitext(path)[1].lower()
+        assert self.format in self.formats, f'Output format must be one of {self.formats}'
+        self.num_rows = 0
+        self._file = None
+        self._parquet_writer = None
+        if self.format == '.parquet':
+            import pyarrow
+            import pyarrow.parquet
+            self._pa = pyarrow
+            self._schema = pyarrow.schema([(c, pyarrow.string() if c != 'valid' else pyarrow.bool_())
+                                           for c in self.columns])
+            self._parquet_writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        else:
+            self._file = open(path, 'w')
+            if self.format == '.csv':
+                self._file.write(','.join(self.columns) + '\n')
+
+    def write(self, rows):
+        """
+        :param rows: list
+            Rows of values ordered as `columns`.
+        """
+        if len(rows) == 0:
+            return
+        if self._parquet_writer is not None:
+            data = {c: [row[i] for row in rows] for i, c in enumerate(self.columns)}
+            self._parquet_writer.write_table(self._pa.Table.from_pydict(data, schema=self._schema))
+        else:
+            sep = '\t' if self.format == '.smi' else ','
+            self._file.write(''.join(sep.join(str(v) for v in row) + '\n' for row in rows))
+        self.num_rows += len(rows)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def sample_to_file(generator, gen_data, init_args, path, num_samples, batch_size=500, max_len=100,
+                   canonicalize=True, valid_only=False, n_jobs=1, verbose=True, syntax_mask=False):
+    """
+    Streams sampled SMILES to a .smi, .csv or .parquet file (see ::class::SmilesWriter) with memory bounded by
+    `batch_size`, regardless of `num_samples`.
+
+    :param canonicalize: bool
+        Whether the canonical form and validity of each sample are written along with it.
+    :param valid_only: bool
+        Whether only the canonical SMILES of valid samples are written. Requires canonicalize.
+    :return: dict
+        Number of samples, valid samples and rows written.
+    """
+    assert canonicalize or not valid_only, 'valid_only requires canonicalize'
+    columns = ['smiles', 'canonical', 'valid'] if canonicalize and not valid_only else ['smiles']
+    num_valid = 0
+    batches = iter_smiles(generator, gen_data, init_args, num_samples, batch_size, max_len,
+                          canonicalize=canonicalize, n_jobs=n_jobs, syntax_mask=syntax_mask)
+    with SmilesWriter(path, columns) as writer:
+        with tqdm(total=num_samples, desc='Sampling SMILES...', disable=not verbose) as pbar:
+            for batch in batches:
+                if canonicalize:
+                    valid = [bool(v) and len(c) > 0 for c, v in zip(batch.canonical, batch.valid)]
+                    num_valid += sum(valid)
+                    if valid_only:
+                        rows = [(c,) for c, v in zip(batch.canonical, valid) if v]
+                    else:
+                        rows = list(zip(batch.smiles, batch.canonical, valid))
+                else:
+                    rows = [(sm,) for sm in batch.smiles]
+                writer.write(rows)
+                pbar.update(len(batch.smiles))
+    return {'samples': num_samples, 'valid': num_valid if canonicalize else None, 'written': writer.num_rows,
+            'path': path}
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set of strings with a fixed memory footprint. Membership tests have no false negatives and a false
+    positive rate of about `error_rate` once `capacity` items have been added.
+
+    Arguments:
+    -----------
+    :param capacity: int
+        Expected number of items.
+    :param error_rate: float
+        False positive rate at `capacity` items.
+    """
+
+    def __init__(self, capacity, error_rate=1e-3):
+        assert capacity > 0 and 0. < error_rate < 1.
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing (Kirsch & Mitzenmacher): the i-th position is h1 + i * h2
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def add(self, item):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+
+class UniqueCollector(object):
+    """
+    Collects the unique, valid canonical SMILES of a stream of sampled batches, and detects when the stream has
+    (nearly) collapsed to the molecules already collected.
+
+    Arguments:
+    ------------
+    :param num_unique: int
+        Number of unique SMILES to collect.
+    :param window: int
+        Number of most recent valid samples over which the duplicate rate is computed. The rate is not checked before
+        `window` valid samples have been seen, so small batches cannot trigger ::attr::collapsed on their own.
+    :param max_duplicate_rate: float
+        ::attr::collapsed is set when the duplicate rate of the window exceeds this value.
+    :param membership: str
+        'set' or 'bloom'. See ::func::sample_unique.
+    """
+
+    def __init__(self, num_unique, window, max_duplicate_rate=0.95, membership='set', error_rate=1e-3):
+        assert num_unique > 0 and window > 0
+        assert membership in ('set', 'bloom'), 'membership must be one of set, bloom'
+        self.num_unique = num_unique
+        self.max_duplicate_rate = max_duplicate_rate
+        self.seen = BloomFilter(num_unique, error_rate) if membership == 'bloom' else set()
+        self.unique, self.invalid = [], []
+        self.num_samples = self.num_valid = self.num_duplicates = 0
+        self._recent = deque(maxlen=window)
+        self._recent_duplicates = 0
+        self.collapsed = False
+
+    @property
+    def done(self):
+        return len(self.unique) >= self.num_unique
+
+    def _record(self, is_duplicate):
+        if len(self._recent) == self._recent.maxlen:
+            self._recent_duplicates -= self._recent[0]
+        self._recent.append(is_duplicate)
+        self._recent_duplicates += is_duplicate
+
+    def duplicate_rate(self):
+        """Duplicate rate of the window, or None before the window is full."""
+        if len(self._recent) < self._recent.maxlen:
+            return None
+        return self._recent_duplicates / len(self._recent)
+
+    def add(self, samples, canonical, valid):
+        self.num_samples += len(samples)
+        for sm, canon, v in zip(samples, canonical, valid):
+            if not v or len(canon) == 0:
+                self.invalid.append(sm)
+                continue
+            self.num_valid += 1
+            is_duplicate = canon in self.seen
+            if is_duplicate:
+                self.num_duplicates += 1
+            elif not self.done:
+                self.seen.add(canon)
+                self.unique.append(canon)
+            self._record(int(is_duplicate))
+        rate = self.duplicate_rate()
+        if not self.done and rate is not None and rate > self.max_duplicate_rate:
+            self.collapsed = True
+
+    def next_batch_size(self, batch_size, min_batch_size):
+        """Size of the next batch, estimated from the yield of unique SMILES so far."""
+        if len(self.unique) == 0:
+            return batch_size
+        needed = self.num_unique - len(self.unique)
+        return max(min_batch_size, min(batch_size, int(math.ceil(needed * self.num_samples / len(self.unique)))))
+
+
+@torch.no_grad()
+def sample_unique(generator, gen_data, init_args, num_unique, batch_size=500, max_len=100, prime_str='<',
+                  end_token='>', n_jobs=1, syntax_mask=False, max_samples=None, max_duplicate_rate=0.95,
+                  membership='set', error_rate=1e-3, min_batch_size=None):
+    """
+    Samples batches until `num_unique` unique, valid canonical SMILES are collected. After the first batch, the size of
+    each batch is estimated from the yield of unique SMILES observed so far, so little is sampled beyond what is needed.
+
+    Arguments:
+    ------------
+    :param num_unique: int
+        Number of unique, valid canonical SMILES to collect.
+    :param max_samples: int
+        Sampling stops when this many SMILES have been sampled. Defaults to 20 * num_unique.
+    :param max_duplicate_rate: float
+        Sampling stops when the fraction of duplicates among the last `batch_size` valid SMILES exceeds this value,
+        i.e. the generator has (nearly) collapsed to the molecules already collected. See ::class::UniqueCollector.
+    :param membership: str
+        'set' tracks the collected SMILES exactly. 'bloom' uses a ::class::BloomFilter of `num_unique` capacity, whose
+        memory does not grow with the SMILES lengths; a new SMILES is then discarded as a duplicate with probability
+        of about `error_rate`.
+    :param min_batch_size: int
+        Lower bound of the estimated batch sizes. Defaults to batch_size // 10.
+    :return: ::class::UniqueSamples
+        [0] the unique canonical SMILES, at most num_unique
+        [1] the invalid samples
+        [2] number of samples
+        [3] number of valid samples
+        [4] number of valid samples discarded as duplicates
+        [5] whether sampling stopped before num_unique SMILES were collected
+    """
+    assert num_unique > 0 and batch_size > 0
+    max_samples = max_samples or 20 * num_unique
+    min_batch_size = min_batch_size or max(1, batch_size // 10)
+    collector = UniqueCollector(num_unique, batch_size, max_duplicate_rate, membership, error_rate)
+    was_training = generator.training
+    try:
+        while not collector.done and not collector.collapsed and collector.num_samples < max_samples:
+            n = min(collector.next_batch_size(batch_size, min_batch_size), max_samples - collector.num_samples)
+            samples = generate_smiles(generator, gen_data, init_args, prime_str=prime_str, end_token=end_token,
+                                      max_len=max_len, num_samples=n, is_train=False, syntax_mask=syntax_mask)
+            canonical, valid = bulk_canonical_smiles(samples, n_jobs=n_jobs, cache=False)
+            collector.add(samples, canonical, valid)
+    finally:
+        if was_training:
+            generator.train()
+    return UniqueSamples(collector.unique, collector.invalid, collector.num_samples, collector.num_valid,
+                         collector.num_duplicates, not collector.done)
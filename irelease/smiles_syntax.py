@@ -0,0 +1,235 @@
+# Author: bbrighttaer
+# Project: IReLeaSE
+# Date: 10/19/2026
+# Time: 6:05 PM
+# File: smiles_syntax.py
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+
+import torch
+
+# Syntactic role of the last token of a SMILES prefix
+START, ATOM, BOND, OPEN, CLOSE, RING, DOT = range(7)
+# Parsing modes: outside brackets, right after '[', inside a non-empty bracket atom, after '%' or its first digit
+NORMAL, BRACKET_EMPTY, BRACKET, PERCENT = range(4)
+
+_ALIPHATIC = set('BCNOSPFI') | {'Cl', 'Br'}
+_AROMATIC = set('bcnosp')
+
+
+def token_class(token, start_token='<', end_token='>'):
+    """Syntactic class of a generator token (single character or atom-level, see ::class::SmilesTokenizer)."""
+    if token == start_token:
+        return 'start'
+    if token == end_token:
+        return 'end'
+    if token in _ALIPHATIC:
+        return 'atom'
+    if token in _AROMATIC:
+        return 'arom'
+    if len(token) > 2 and token[0] == '[' and token[-1] == ']':
+        return 'bracket_atom'
+    if len(token) == 3 and token[0] == '%' and token[1:].isdigit():
+        return 'ring_pct'
+    return {'=': 'bond', '#': 'bond', '-': 'bond', '/': 'bond', '\\': 'bond', ':': 'arom_bond', '%': 'percent',
+            '(': 'open', ')': 'close', '.': 'dot', '[': 'lbracket', ']': 'rbracket', 'l': 'l',
+            'r': 'r'}.get(token, 'digit' if token.isdigit() and len(token) == 1 else 'other')
+
+
+def in_bracket_token(token):
+    """Whether the token may appear inside a bracket atom, e.g. [C@@H], [nH], [O-], [13C]."""
+    return len(token) == 1 and (token.isalnum() or token in '@+-')
+
+
+class SmilesSyntaxState(object):
+    """
+    Incremental SMILES syntax state of one sequence. It tracks the open branches, the open ring closures, bracket
+    atoms, two-character atoms (Cl, Br) and whether the last atom is aromatic. ::meth::key summarizes the state into
+    the index of its row of valid next tokens in ::class::SmilesSyntaxMask.
+    """
+
+    __slots__ = ('mode', 'prev', 'depth', 'rings', 'num_atoms', 'aromatic', 'can_l', 'can_r', 'pct', 'bracket',
+                 'ended')
+
+    def __init__(self):
+        self.mode = NORMAL
+        self.prev = START
+        self.depth = 0
+        self.rings = set()
+        self.num_atoms = 0
+        self.aromatic = False
+        self.can_l = False
+        self.can_r = False
+        self.pct = ''
+        self.bracket = ''
+        self.ended = False
+
+    def key(self):
+        flags = (self.depth > 0, len(self.rings) > 0, self.num_atoms > 0, self.aromatic, self.can_l, self.can_r)
+        key = self.mode * 7 + self.prev
+        for f in flags:
+            key = key * 2 + int(f)
+        return key
+
+    def _atom(self, aromatic):
+        self.prev = ATOM
+        self.num_atoms += 1
+        self.aromatic = aromatic
+
+    def _ring(self, ring_id):
+        self.rings ^= {ring_id}
+        self.prev = RING
+
+    def update(self, token, cls):
+        """Advances the state with the given token of syntactic class `cls` (see ::func::token_class)."""
+        self.can_l = self.can_r = False
+        if self.mode in (BRACKET_EMPTY, BRACKET):
+            if cls == 'rbracket':
+                self.mode = NORMAL
+                self._atom(self.bracket[:1].islower())
+                self.bracket = ''
+            else:
+                self.mode = BRACKET
+                self.bracket += token
+        elif self.mode == PERCENT:
+            self.pct += token
+            if len(self.pct) == 2:
+                self.mode = NORMAL
+                self._ring('%' + self.pct)
+                self.pct = ''
+        elif cls == 'atom':
+            self._atom(False)
+            self.can_l, self.can_r = token == 'C', token == 'B'
+        elif cls == 'arom':
+            self._atom(True)
+        elif cls == 'bracket_atom':
+            self._atom(token[1:2].islower())
+        elif cls in ('l', 'r'):
+            pass  # second character of Cl/Br, the atom was counted with its first character
+        elif cls in ('bond', 'arom_bond'):
+            self.prev = BOND
+        elif cls == 'digit':
+            self._ring(token)
+        elif cls == 'ring_pct':
+            self._ring(token)
+        elif cls == 'percent':
+            self.mode = PERCENT
+        elif cls == 'open':
+            self.depth += 1
+            self.prev = OPEN
+        elif cls == 'close':
+            self.depth = max(0, self.depth - 1)
+            self.prev = CLOSE
+        elif cls == 'dot':
+            self.prev = DOT
+        elif cls == 'lbracket':
+            self.mode = BRACKET_EMPTY
+        elif cls == 'end':
+            self.ended = True
+
+
+def _allowed_classes(mode, prev, branch_open, ring_open, has_atoms, aromatic, can_l, can_r):
+    """Token classes that keep a SMILES prefix in the given (summarized) state syntactically valid."""
+    if mode == PERCENT:
+        return {'digit'}
+    if mode == BRACKET_EMPTY:
+        return {'in_bracket'}
+    if mode == BRACKET:
+        return {'in_bracket', 'rbracket'}
+    allowed = {'atom', 'arom', 'bracket_atom', 'lbracket'}
+    after_atom = prev in (ATOM, RING, CLOSE)
+    if prev in (ATOM, RING, CLOSE, OPEN):
+        allowed.add('bond')
+        if aromatic:
+            allowed.add('arom_bond')
+    if prev in (ATOM, RING, BOND):
+        allowed.update(['digit', 'percent', 'ring_pct'])
+    if after_atom:
+        allowed.add('open')
+        if branch_open:
+            allowed.add('close')
+        else:
+            allowed.add('dot')
+            if not ring_open and has_atoms:
+                allowed.add('end')
+    if can_l:
+        allowed.add('l')
+    if can_r:
+        allowed.add('r')
+    return allowed
+
+
+class SmilesSyntaxMask(object):
+    """
+    Per-step masks of the tokens that keep sampled SMILES syntactically valid: balanced branches, closed rings and
+    bracket atoms, bonds between atoms and aromatic bonds after aromatic atoms. The masks are rows of a table that is
+    precomputed for every summarized ::class::SmilesSyntaxState, so masking a batch is a single gather.
+    Valence and ring-size rules are not checked, so masked samples can still fail RDKit parsing, but much less often.
+
+    Arguments:
+    -----------
+    :param tokens: list
+        The generator tokens, ordered as the generator's output.
+    :param start_token: str
+        Token at the beginning of every sequence. It is never allowed.
+    :param end_token: str
+        Token ending a sequence.
+    :param device: str
+        Device of the masks.
+    """
+
+    def __init__(self, tokens, start_token='<', end_token='>', device='cpu'):
+        self.tokens = list(tokens)
+        self.classes = [token_class(t, start_token, end_token) for t in self.tokens]
+        self.device = device
+        self._index = {t: i for i, t in enumerate(self.tokens)}
+        bracket_ok = [in_bracket_token(t) for t in self.tokens]
+        rows = []
+        for mode, prev in itertools.product(range(4), range(7)):
+            for flags in itertools.product((False, True), repeat=6):
+                allowed = _allowed_classes(mode, prev, *flags)
+                row = [c in allowed or ('in_bracket' in allowed and ok) for c, ok in zip(self.classes, bracket_ok)]
+                rows.append(row if any(row) else [True] * len(row))
+        self.table = torch.tensor(rows, dtype=torch.bool, device=device)
+
+    def new_states(self, n):
+        return [SmilesSyntaxState() for _ in range(n)]
+
+    def update(self, states, token_ids):
+        """Advances each state with its sampled token index."""
+        for state, idx in zip(states, token_ids):
+            state.update(self.tokens[idx], self.classes[idx])
+
+    def masks(self, states):
+        """(len(states), num_tokens) boolean tensor of the valid next tokens of each state."""
+        keys = torch.tensor([s.key() for s in states], dtype=torch.long, device=self.device)
+        return self.table[keys]
+
+    def apply(self, logits, states):
+        """Sets the logits of the invalid next tokens to -inf."""
+        return logits.masked_fill(~self.masks(states).to(logits.device), float('-inf'))
+
+    def prefix_state(self, prefix):
+        """The state after the given prefix (a string or a list of tokens)."""
+        state = SmilesSyntaxState()
+        for token in prefix:
+            if token in self._index:
+                state.update(token, self.classes[self._index[token]])
+        return state
+
+    def prefix_mask(self, prefix):
+        """Boolean mask of the valid next tokens after the given prefix."""
+        return self.table[self.prefix_state(prefix).key()]
+
+
+# Masks shared by the call sites using the same tokens
+_syntax_mask_cache = {}
+
+
+def get_syntax_mask(tokens, start_token='<', end_token='>', device='cpu'):
+    key = (tuple(tokens), start_token, end_token, str(device))
+    if key not in _syntax_mask_cache:
+        _syntax_mask_cache[key] = SmilesSyntaxMask(tokens, start_token, end_token, device)
+    return _syntax_mask_cache[key]
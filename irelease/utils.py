@@ -1,9 +1,16 @@
 # Original code from: https://github.com/isayev/ReLeaSE
 
-import csv
+import json
 import math
+import multiprocessing
+import os
+import re
+import threading
 import time
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 
 import numpy as np
 import pandas as pd
@@ -16,6 +23,8 @@ from torch.utils.data import Dataset
 from tqdm import trange
 from sklearn.metrics import mean_squared_error
 
+from irelease.smiles_syntax import get_syntax_mask
+
 
 lg = RDLogger.logger()
 lg.setLevel(RDLogger.CRITICAL)
@@ -36,44 +45,131 @@ def get_fp(smiles, sanitize=True):
     return np.array(fp), processed_indices, invalid_indices
 
 
-def get_desc(smiles, calc):
-    desc = []
+def get_fp_onbits(smiles, sanitize=True, n=2048):
+    """
+    Same features as ::func::get_fp but the (float32) matrix is filled from the on-bits of every fingerprint with a
+    single scatter, instead of converting each fingerprint to a float64 array first.
+    """
+    rows, cols = [], []
     processed_indices = []
     invalid_indices = []
     for i in range(len(smiles)):
-        sm = smiles[i]
         try:
-            mol = Chem.MolFromSmiles(sm)
-            tmp = np.array(calc(mol))
-            desc.append(tmp)
-            processed_indices.append(i)
+            m = Chem.MolFromSmiles(smiles[i], sanitize=sanitize)
+            on_bits = list(Chem.RDKFingerprint(m, maxPath=4, fpSize=n).GetOnBits())
         except:
             invalid_indices.append(i)
+            continue
+        rows.extend([len(processed_indices)] * len(on_bits))
+        cols.extend(on_bits)
+        processed_indices.append(i)
+    fp = np.zeros((len(processed_indices), n), dtype=np.float32)
+    fp[rows, cols] = 1.
+    return fp, processed_indices, invalid_indices
+
 
-    desc_array = np.array(desc)
-    return desc_array, processed_indices, invalid_indices
+def _to_float32(rows):
+    """Converts descriptor rows to a float32 matrix. Values that are not numbers (e.g. descriptor errors) become NaN."""
+    try:
+        return np.asarray(rows, dtype=np.float32)
+    except (TypeError, ValueError):
+        frame = pd.DataFrame(list(rows))
+        return frame.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32)
+
+
+# Errors of RDKit parsing (e.g. MolSanitizeException, Boost.Python.ArgumentError) and of descriptor calculators
+_DESC_ERRORS = (ValueError, TypeError, RuntimeError, ArithmeticError)
+
+
+def _desc_chunk(smiles, calc, sanitize):
+    rows = []
+    valid = np.zeros((len(smiles),), dtype=bool)
+    for i, sm in enumerate(smiles):
+        try:
+            mol = Chem.MolFromSmiles(sm, sanitize=sanitize)
+            if mol is None:
+                continue
+            rows.append(list(calc(mol)))
+            valid[i] = True
+        except _DESC_ERRORS:
+            continue
+    desc = np.full((len(smiles), len(rows[0]) if rows else 0), np.nan, dtype=np.float32)
+    if rows:
+        desc[valid] = _to_float32(rows)
+    return desc, valid
+
+
+def compute_descriptors(smiles, calc, sanitize=True, n_jobs=1, chunk_size=1000, backend='process'):
+    """
+    Computes the descriptors of the given SMILES in chunks, optionally on a pool of workers.
+
+    :param smiles: list
+        SMILES strings.
+    :param calc: callable
+        Takes an RDKit molecule and returns its descriptor values (e.g. a mordred Calculator). It must be picklable
+        when the process backend is used.
+    :param sanitize: bool
+        Whether RDKit sanitizes the molecules.
+    :param n_jobs: int
+        Number of workers. Non-positive values use all CPUs.
+    :param chunk_size: int
+        Number of molecules featurized by a worker per task.
+    :param backend: str
+        'process' or 'thread'. See ::func::bulk_smiles_info.
+    :return: tuple
+        [0] float32 matrix of shape (len(smiles), num. descriptors). Rows of invalid molecules and descriptor
+            values that are not numbers are NaN (see ::func::normalize_desc).
+        [1] boolean validity mask of the molecules
+    """
+    n_jobs = os.cpu_count() if n_jobs <= 0 else n_jobs
+    chunks = [smiles[i:i + chunk_size] for i in range(0, len(smiles), chunk_size)]
+    if n_jobs == 1 or len(chunks) <= 1:
+        results = [_desc_chunk(chunk, calc, sanitize) for chunk in chunks]
+    else:
+        pool = _get_worker_pool(backend, n_jobs)
+        results = list(pool.map(_desc_chunk, chunks, repeat(calc), repeat(sanitize)))
+    num_desc = max([r[0].shape[1] for r in results], default=0)
+    desc = np.full((len(smiles), num_desc), np.nan, dtype=np.float32)
+    valid = np.zeros((len(smiles),), dtype=bool)
+    offset = 0
+    for chunk_desc, chunk_valid in results:
+        n = len(chunk_valid)
+        if chunk_desc.shape[1] > 0:
+            desc[offset:offset + n] = chunk_desc
+        valid[offset:offset + n] = chunk_valid
+        offset += n
+    return desc, valid
+
+
+def get_desc(smiles, calc, sanitize=True, n_jobs=1, chunk_size=1000, backend='process'):
+    """
+    Descriptor counterpart of ::func::get_fp, so that ``functools.partial(get_desc, calc=calc)`` can be used as a
+    featurizer of ::func::irelease.dataloader.load_smiles_data (and its feature cache). See ::func::compute_descriptors
+    for the arguments.
+
+    :return: tuple
+        [0] float32 descriptors of the valid molecules, non-finite values are NaN
+        [1] indices of the valid molecules
+        [2] indices of the invalid molecules
+    """
+    desc, valid = compute_descriptors(smiles, calc, sanitize, n_jobs, chunk_size, backend)
+    return desc[valid], np.flatnonzero(valid).tolist(), np.flatnonzero(~valid).tolist()
 
 
 def normalize_desc(desc_array, desc_mean=None):
-    desc_array = np.array(desc_array).reshape(len(desc_array), -1)
-    ind = np.zeros(desc_array.shape)
-    for i in range(desc_array.shape[0]):
-        for j in range(desc_array.shape[1]):
-            try:
-                if np.isfinite(desc_array[i, j]):
-                    ind[i, j] = 1
-            except:
-                pass
-    for i in range(desc_array.shape[0]):
-        for j in range(desc_array.shape[1]):
-            if ind[i, j] == 0:
-                desc_array[i, j] = 0
+    """
+    Replaces the non-finite values of each descriptor (column) with its mean. When `desc_mean` is not given, it is the
+    mean of the descriptor over all molecules, with the non-finite values counted as 0.
+
+    :return: tuple
+        [0] float32 descriptor matrix
+        [1] descriptor means
+    """
+    desc_array = _to_float32(desc_array).reshape(len(desc_array), -1)
+    finite = np.isfinite(desc_array)
     if desc_mean is None:
-        desc_mean = np.mean(desc_array, axis=0)
-    for i in range(desc_array.shape[0]):
-        for j in range(desc_array.shape[1]):
-            if ind[i, j] == 0:
-                desc_array[i, j] = desc_mean[j]
+        desc_mean = np.where(finite, desc_array, 0.).mean(axis=0)
+    desc_array = np.where(finite, desc_array, np.asarray(desc_mean, dtype=np.float32)).astype(np.float32)
     return desc_array, desc_mean
 
 
@@ -88,6 +184,186 @@ def mol2image(x, n=2048, sanitize=False):
         return [np.nan]
 
 
+class SmilesCache(object):
+    """
+    Bounded LRU memo of RDKit parsing results: (SMILES, sanitize) -> (canonical SMILES, validity, number of atoms).
+    A SMILES is valid if RDKit could parse it, in which case its canonical form is given. Otherwise the canonical
+    SMILES is '' and the number of atoms is 0. The cache is thread-safe.
+
+    Arguments:
+    -----------
+    :param maxsize: int
+        Maximum number of entries kept. The least recently used entries are evicted first.
+    """
+
+    def __init__(self, maxsize=1000000):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __call__(self, smiles, sanitize=True):
+        entry = self.get(smiles, sanitize)
+        if entry is None:
+            entry = self.parse(smiles, sanitize)
+            self.put(smiles, sanitize, entry)
+        return entry
+
+    def get(self, smiles, sanitize=True):
+        """Returns the cached entry of the given SMILES, or None (counted as a miss) if it is not cached."""
+        key = (smiles, sanitize)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def put(self, smiles, sanitize, entry):
+        with self._lock:
+            self._entries[(smiles, sanitize)] = entry
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def parse(smiles, sanitize=True):
+        try:
+            mol = Chem.MolFromSmiles(smiles, sanitize=sanitize)
+            return Chem.MolToSmiles(mol), True, mol.GetNumAtoms()
+        except:
+            return '', False, 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def as_dict(self):
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+    def write_to_tensorboard(self, writer, step_idx, prefix='smiles_cache'):
+        stats = self.as_dict()
+        writer.add_scalar(f'{prefix}_hit_rate', stats['hit_rate'], step_idx)
+        writer.add_scalar(f'{prefix}_size', stats['size'], step_idx)
+        return stats
+
+
+# Process-wide memo shared by all SMILES canonicalization and validity checks.
+smiles_cache = SmilesCache()
+
+
+def smiles_info(smiles, sanitize=True):
+    """
+    Returns (canonical SMILES, validity, number of atoms) of the given SMILES. See ::class::SmilesCache.
+    """
+    return smiles_cache(smiles, sanitize)
+
+
+def _parse_smiles_chunk(smiles, sanitize):
+    return [SmilesCache.parse(sm, sanitize) for sm in smiles]
+
+
+# Worker pools of the bulk featurization helpers, created on first use and kept for the lifetime of the process.
+_worker_pools = {}
+
+
+def _get_worker_pool(backend, n_jobs):
+    assert backend in ('process', 'thread'), 'backend must be one of [process, thread]'
+    key = (backend, n_jobs)
+    if key not in _worker_pools:
+        if backend == 'process':
+            # spawn: forked workers would inherit CUDA state and the locks of the parent's threads
+            _worker_pools[key] = ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            _worker_pools[key] = ThreadPoolExecutor(n_jobs)
+    return _worker_pools[key]
+
+
+def bulk_smiles_info(smiles, sanitize=True, n_jobs=-1, chunk_size=1000, backend='process', cache=True):
+    """
+    Order-preserving bulk version of ::func::smiles_info. SMILES that are not in the process-wide
+    ::class::SmilesCache are de-duplicated and parsed in chunks by a pool of workers, and their results are cached.
+
+    :param smiles: list
+        SMILES strings.
+    :param sanitize: bool
+        Whether RDKit sanitizes the molecules.
+    :param n_jobs: int
+        Number of workers. Non-positive values use all CPUs. With 1 worker, or no more than `chunk_size` SMILES to
+        parse, the SMILES are parsed in the calling thread.
+    :param chunk_size: int
+        Number of SMILES parsed by a worker per task.
+    :param backend: str
+        'process' (spawned process pool) or 'thread' (thread pool; only useful with RDKit builds that release the GIL).
+    :param cache: bool
+        Whether the process-wide cache is used. Streams of mostly unique SMILES can bypass it.
+    :return: list
+        (canonical SMILES, validity, number of atoms) of each SMILES.
+    """
+    results = [None] * len(smiles)
+    pending = OrderedDict()
+    for i, sm in enumerate(smiles):
+        entry = smiles_cache.get(sm, sanitize) if cache else None
+        if entry is None:
+            pending.setdefault(sm, []).append(i)
+        else:
+            results[i] = entry
+    to_parse = list(pending.keys())
+    n_jobs = os.cpu_count() if n_jobs <= 0 else n_jobs
+    if n_jobs == 1 or len(to_parse) <= chunk_size:
+        parsed = _parse_smiles_chunk(to_parse, sanitize)
+    else:
+        pool = _get_worker_pool(backend, n_jobs)
+        chunks = [to_parse[i:i + chunk_size] for i in range(0, len(to_parse), chunk_size)]
+        parsed = [entry for chunk in pool.map(_parse_smiles_chunk, chunks, repeat(sanitize)) for entry in chunk]
+    for sm, entry in zip(to_parse, parsed):
+        if cache:
+            smiles_cache.put(sm, sanitize, entry)
+        for i in pending[sm]:
+            results[i] = entry
+    return results
+
+
+def bulk_canonical_smiles(smiles, sanitize=True, throw_warning=False, n_jobs=-1, chunk_size=1000, backend='process',
+                          cache=True):
+    """
+    Parallel drop-in for ::func::canonical_smiles. See ::func::bulk_smiles_info for the parallelism arguments.
+
+    :return: tuple
+        [0] canonical SMILES ('' if invalid)
+        [1] validity (1/0) of each SMILES
+    """
+    new_smiles = []
+    valid_vec = []
+    for sm, (canon, valid, _) in zip(smiles, bulk_smiles_info(smiles, sanitize, n_jobs, chunk_size, backend, cache)):
+        if not valid and throw_warning:
+            warnings.warn(sm + ' can not be canonized: invalid SMILES string!', UserWarning)
+        new_smiles.append(canon)
+        valid_vec.append(int(valid))
+    return new_smiles, valid_vec
+
+
+def bulk_sanitize_smiles(smiles, canonical=True, throw_warning=False, n_jobs=-1, chunk_size=1000, backend='process'):
+    """
+    Parallel drop-in for ::func::sanitize_smiles. See ::func::bulk_smiles_info for the parallelism arguments.
+    """
+    if not canonical:
+        return list(smiles)
+    return bulk_canonical_smiles(smiles, True, throw_warning, n_jobs, chunk_size, backend)[0]
+
+
 def sanitize_smiles(smiles, canonical=True, throw_warning=False):
     """
     Takes list of SMILES strings and returns list of their sanitized versions.
@@ -118,15 +394,13 @@ def sanitize_smiles(smiles, canonical=True, throw_warning=False):
     """
     new_smiles = []
     for sm in smiles:
-        try:
-            if canonical:
-                new_smiles.append(Chem.MolToSmiles(Chem.MolFromSmiles(sm, sanitize=True)))
-            else:
-                new_smiles.append(sm)
-        except:
-            if throw_warning:
-                warnings.warn('Unsanitized SMILES string: ' + sm, UserWarning)
-            new_smiles.append('')
+        if not canonical:
+            new_smiles.append(sm)
+            continue
+        canon, valid, _ = smiles_info(sm, sanitize=True)
+        if not valid and throw_warning:
+            warnings.warn('Unsanitized SMILES string: ' + sm, UserWarning)
+        new_smiles.append(canon)
     return new_smiles
 
 
@@ -160,16 +434,12 @@ def canonical_smiles(smiles, sanitize=True, throw_warning=False):
     new_smiles = []
     valid_vec = []
     for sm in smiles:
-        try:
-            mol = Chem.MolFromSmiles(sm, sanitize=sanitize)
-            new_smiles.append(Chem.MolToSmiles(mol))
-            valid_vec.append(1)
-        except:
-            if throw_warning:
-                warnings.warn(sm + ' can not be canonized: invalid '
-                                   'SMILES string!', UserWarning)
-            new_smiles.append('')
-            valid_vec.append(0)
+        canon, valid, _ = smiles_info(sm, sanitize=sanitize)
+        if not valid and throw_warning:
+            warnings.warn(sm + ' can not be canonized: invalid '
+                               'SMILES string!', UserWarning)
+        new_smiles.append(canon)
+        valid_vec.append(int(valid))
     return new_smiles, valid_vec
 
 
@@ -346,21 +616,59 @@ def cross_validation_split(x, y, n_folds=5, split='random', folds=None):
     return cross_val_data, cross_val_labels
 
 
+def iter_object_property_file(path, delimiter=',', cols_to_read=[0, 1], keep_header=False, chunk_size=100000,
+                              max_len=None, valid_only=False, filter_col=0, **kwargs):
+    """
+    Streams the requested columns of a delimited file chunk by chunk. Only the requested columns are parsed, so the
+    peak memory is bounded by the chunk size and not by the size of the file.
+
+    :param path: str
+        Path of the file.
+    :param delimiter: str
+        Column delimiter.
+    :param cols_to_read: list
+        Indices of the columns to be read.
+    :param keep_header: bool
+        If False, the first row is treated as a header and skipped.
+    :param chunk_size: int
+        Number of rows parsed at a time.
+    :param max_len: int
+        If given, rows whose `filter_col` value (stripped) is longer than this are dropped.
+    :param valid_only: bool
+        If True, rows whose `filter_col` value is not a valid SMILES are dropped.
+    :param filter_col: int
+        Position, in `cols_to_read`, of the column the filters apply to.
+    :return: generator
+        Yields a list of numpy arrays (one per requested column) for every chunk.
+    """
+    reader = pd.read_csv(path, sep=delimiter, header=None, usecols=cols_to_read, skiprows=0 if keep_header else 1,
+                         dtype=str, na_filter=False, chunksize=chunk_size, engine='c')
+    for chunk in reader:
+        data = [chunk[col].values for col in cols_to_read]
+        if max_len is not None or valid_only:
+            keep = np.ones(len(chunk), dtype=bool)
+            if max_len is not None:
+                keep &= chunk[cols_to_read[filter_col]].str.strip().str.len().values <= max_len
+            if valid_only:
+                keep &= np.array([Chem.MolFromSmiles(sm.strip()) is not None if k else False
+                                  for sm, k in zip(data[filter_col], keep)], dtype=bool)
+            data = [d[keep] for d in data]
+        if len(data[0]) > 0:
+            yield data
+
+
 def read_object_property_file(path, delimiter=',', cols_to_read=[0, 1],
-                              keep_header=False, **kwargs):
-    f = open(path, 'r')
-    reader = csv.reader(f, delimiter=delimiter)
-    data_full = np.array(list(reader))
-    if keep_header:
-        start_position = 0
-    else:
-        start_position = 1
-    assert len(data_full) > start_position
-    data = [[] for _ in range(len(cols_to_read))]
-    for i in range(len(cols_to_read)):
-        col = cols_to_read[i]
-        data[i] = data_full[start_position:, col]
-    f.close()
+                              keep_header=False, chunk_size=100000, max_len=None, valid_only=False, **kwargs):
+    """
+    Reads the requested columns of a delimited file. The file is streamed with ::func::iter_object_property_file,
+    so only the requested (and filtered) columns are ever held in memory.
+    """
+    if len(cols_to_read) == 0:
+        return []
+    chunks = list(iter_object_property_file(path, delimiter, cols_to_read, keep_header, chunk_size, max_len,
+                                            valid_only))
+    data = [np.concatenate([c[i] for c in chunks]) if chunks else np.array([], dtype=object)
+            for i in range(len(cols_to_read))]
     if len(cols_to_read) == 1:
         data = data[0]
     return data
@@ -402,6 +710,97 @@ def init_cell(num_layers, batch_size, hidden_size, num_dir=1, dvc='cpu'):
     return init_hidden(num_layers, batch_size, hidden_size, num_dir, dvc)
 
 
+class StatePool(object):
+    """
+    Reusable arena of zeroed recurrent (hidden, cell) and stack states, so that initializing the states of a
+    rollout does not allocate and transfer fresh zero tensors on every call. One buffer is kept per state kind, shape,
+    device and dtype, and the same buffer is handed out to every request with that key.
+
+    The buffers must be treated as read-only, which the recurrent and stack layers of this project do (they return new
+    state tensors). A buffer that was nevertheless modified in place is detected through its version counter and
+    zeroed in place before it is handed out again. Buffers that were not modified are never touched, so tensors of a
+    previous request saved for backward stay valid.
+
+    Arguments:
+    -----------
+    :param dtype: torch.dtype
+        Data type of the states.
+    """
+
+    def __init__(self, dtype=torch.float32):
+        self.dtype = dtype
+        self._buffers = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.allocations = 0
+        self.num_bytes = 0
+        self.peak_bytes = 0
+        self.peak_batch_size = 0
+
+    def zeros(self, kind, *shape, dvc='cpu', batch_dim=0):
+        key = (kind, tuple(int(d) for d in shape), str(torch.device(dvc)))
+        with self._lock:
+            self.requests += 1
+            self.peak_batch_size = max(self.peak_batch_size, int(shape[batch_dim]))
+            buf = self._buffers.get(key)
+            if buf is None:
+                buf = torch.zeros(*key[1], dtype=self.dtype, device=dvc)
+                self._buffers[key] = buf
+                self.allocations += 1
+                self.num_bytes += buf.numel() * buf.element_size()
+                self.peak_bytes = max(self.peak_bytes, self.num_bytes)
+            elif buf._version != self._versions[key]:
+                buf.zero_()
+            self._versions[key] = buf._version
+            return buf
+
+    def hidden(self, num_layers, batch_size, hidden_size, num_dir=1, dvc='cpu'):
+        """Pooled counterpart of ::func::init_hidden"""
+        return self.zeros('hidden', num_layers * num_dir, batch_size, hidden_size, dvc=dvc, batch_dim=1)
+
+    def cell(self, num_layers, batch_size, hidden_size, num_dir=1, dvc='cpu'):
+        """Pooled counterpart of ::func::init_cell"""
+        return self.zeros('cell', num_layers * num_dir, batch_size, hidden_size, dvc=dvc, batch_dim=1)
+
+    def stack(self, batch_size, stack_width, stack_depth, dvc='cpu'):
+        """Pooled counterpart of ::func::init_stack"""
+        return self.zeros('stack', batch_size, stack_depth, stack_width, dvc=dvc, batch_dim=0)
+
+    def states(self, batch_size, hidden_size, num_layers, stack_depth, stack_width, unit_type, dvc='cpu'):
+        """
+        Returns the (hidden, cell, stack) initial states of a stack RNN layer. The cell is None unless unit_type is
+        'lstm'.
+        """
+        hidden = self.hidden(num_layers, batch_size, hidden_size, dvc=dvc)
+        cell = self.cell(num_layers, batch_size, hidden_size, dvc=dvc) if unit_type == 'lstm' else None
+        stack = self.stack(batch_size, stack_width, stack_depth, dvc=dvc)
+        return hidden, cell, stack
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self._versions.clear()
+            self.num_bytes = 0
+
+    def as_dict(self):
+        return {'requests': self.requests, 'allocations': self.allocations, 'buffers': len(self._buffers),
+                'bytes': self.num_bytes, 'peak_bytes': self.peak_bytes, 'peak_batch_size': self.peak_batch_size}
+
+    def write_to_tensorboard(self, writer, step_idx, prefix='state_pool'):
+        stats = self.as_dict()
+        writer.add_scalars(f'{prefix}_counts', {'requests': stats['requests'],
+                                                'allocations': stats['allocations'],
+                                                'buffers': stats['buffers']}, step_idx)
+        writer.add_scalars(f'{prefix}_bytes', {'current': stats['bytes'], 'peak': stats['peak_bytes']}, step_idx)
+        writer.add_scalar(f'{prefix}_peak_batch_size', stats['peak_batch_size'], step_idx)
+        return stats
+
+
+# Process-wide pool of initial recurrent/stack states.
+state_pool = StatePool()
+
+
 class Flags(object):
     # enables using either object referencing or dict indexing to retrieve user passed arguments of flag objects.
     def __getitem__(self, item):
@@ -422,11 +821,8 @@ def get_default_tokens():
 def char_to_tensor(string, device, tokens=None):
     if tokens is None:
         tokens = get_default_tokens()
-    tensor = torch.zeros(len(string)).long()
-    for c in range(len(string)):
-        tensor[c] = tokens.index(string[c])
-    tensor = tensor.to(device)
-    return tensor.clone()
+    tensor = torch.from_numpy(get_vocabulary(tokens, strict=True).encode([string])[0]).long()
+    return tensor.to(device)
 
 
 def parse_optimizer(hparams, model):
@@ -469,10 +865,31 @@ def count_parameters(model):
 
 
 class GradStats(object):
-    def __init__(self, net, tb_writer=None, beta=.9, bias_cor=False):
+    """
+    Exponential averages of the RMS (L2), max absolute value and variance of the gradients of a network.
+    The statistics are computed with per-tensor reductions on the device of each parameter and combined on the host
+    from a few scalars per tensor, so calling ::func::stats every step does not copy the gradients.
+
+    Arguments:
+    -----------
+    :param net: nn.Module
+        The network whose parameter gradients are monitored.
+    :param tb_writer: SummaryWriter
+        Optional tensorboard writer.
+    :param beta: float
+        Smoothing factor of the exponential averages.
+    :param bias_cor: bool
+        Whether bias correction is applied to the exponential averages.
+    :param per_layer: bool
+        Whether the (non-averaged) statistics of each layer are also computed. They are kept in `layer_stats`.
+    """
+
+    def __init__(self, net, tb_writer=None, beta=.9, bias_cor=False, per_layer=False):
         super(GradStats, self).__init__()
         self.net = net
         self.writer = tb_writer
+        self.per_layer = per_layer
+        self.layer_stats = {}
         self._l2 = ExpAverage(beta, bias_cor)
         self._max = ExpAverage(beta, bias_cor)
         self._var = ExpAverage(beta, bias_cor)
@@ -499,25 +916,65 @@ class GradStats(object):
         self._var.reset()
         self.t = 0
 
+    def _tensor_moments(self):
+        """
+        Returns the names of the parameters that have gradients, and their number of elements, mean, variance and
+        max absolute value as float64 arrays. Only these scalars are transferred from the devices.
+        """
+        names, counts, moments = [], [], {}
+        for name, p in self.net.named_parameters():
+            if p.grad is None or p.grad.numel() == 0:
+                continue
+            g = p.grad.detach().float()
+            var, mean = torch.var_mean(g, unbiased=False)
+            names.append(name)
+            counts.append(g.numel())
+            moments.setdefault(g.device, []).append((len(names) - 1, torch.stack([mean, var, g.abs().max()])))
+        stats = np.zeros((len(names), 3), dtype=np.float64)
+        for dev_moments in moments.values():
+            idx = [i for i, _ in dev_moments]
+            stats[idx] = torch.stack([m for _, m in dev_moments]).double().cpu().numpy()
+        return names, np.array(counts, dtype=np.float64), stats[:, 0], stats[:, 1], stats[:, 2]
+
+    @staticmethod
+    def _combine(counts, means, variances, maxs):
+        """Combines per-tensor moments into the (L2, max, var) of all their elements (parallel variance formula)."""
+        n = counts.sum()
+        mean = np.sum(counts * means) / n
+        var = np.sum(counts * (variances + np.square(means - mean))) / n
+        l2 = np.sqrt(np.sum(counts * (variances + np.square(means))) / n)
+        return l2, np.max(maxs), var
+
     def stats(self, step_idx=None):
-        grads = np.concatenate([p.grad.data.cpu().numpy().flatten() for p in self.net.parameters()
-                                if p.grad is not None])
-        l2 = np.sqrt(np.mean(np.square(grads)))
+        names, counts, means, variances, maxs = self._tensor_moments()
+        if len(names) == 0:
+            return "Grads stats (w={}): L2={}, max={}, var={}".format(int(self._window), self.l2, self.max, self.var)
+        l2, mx, vr = self._combine(counts, means, variances, maxs)
         self._l2.update(l2)
-        mx = np.max(np.abs(grads))
         self._max.update(mx)
-        vr = np.var(grads)
         self._var.update(vr)
+        if self.per_layer:
+            layers = {}
+            for i, name in enumerate(names):
+                layers.setdefault(name.rsplit('.', 1)[0], []).append(i)
+            self.layer_stats = {}
+            for layer, idx in layers.items():
+                layer_l2, layer_max, layer_var = self._combine(counts[idx], means[idx], variances[idx], maxs[idx])
+                self.layer_stats[layer] = {'l2': layer_l2, 'max': layer_max, 'var': layer_var}
         if self.writer:
             assert step_idx is not None, "step_idx cannot be none"
             self.writer.add_scalar("grad_l2", l2, step_idx)
             self.writer.add_scalar("grad_max", mx, step_idx)
             self.writer.add_scalar("grad_var", vr, step_idx)
+            if self.per_layer:
+                self.writer.add_scalars("grad_l2_per_layer", {k: v['l2'] for k, v in self.layer_stats.items()},
+                                        step_idx)
         return "Grads stats (w={}): L2={}, max={}, var={}".format(int(self._window), self.l2, self.max, self.var)
 
 
 def generate_smiles(generator, gen_data, init_args, prime_str='<', end_token='>', max_len=100, num_samples=5,
-                    gen_type='rnn', is_train=True, return_probs=False, return_logits=False, verbose=False):
+                    gen_type='rnn', is_train=True, return_probs=False, return_logits=False, verbose=False,
+                    syntax_mask=False):
     """
     Generates SMILES strings using the model/generator given.
 
@@ -543,8 +1000,14 @@ def generate_smiles(generator, gen_data, init_args, prime_str='<', end_token='>'
     :param is_train: bool
         Whether the call is from a training procedure. If it is then the generator would be set back to train after
         generation.
+    :param syntax_mask: bool
+        Whether the tokens that would make a sample syntactically invalid SMILES are masked out at every step
+        (see ::class::irelease.smiles_syntax.SmilesSyntaxMask).
     :return: list
         Generated string(s).
+
+    RNN sampling without `return_probs`/`return_logits` is done by ::func::sample_active_set, which stops as soon as
+    every sequence has emitted `end_token`.
     """
     generator.eval()
     if gen_type == 'rnn':
@@ -567,7 +1030,8 @@ def generate_smiles(generator, gen_data, init_args, prime_str='<', end_token='>'
                 stack = None
             hidden_states.append((hidden, cell, stack))
 
-    prime_input, _ = seq2tensor([prime_str] * num_samples, tokens=gen_data.all_characters, flip=False)
+    vocab = get_vocabulary(gen_data.all_characters)
+    prime_input = vocab.encode([prime_str] * num_samples)
     prime_input = torch.from_numpy(prime_input).long().to(init_args['device'])
     new_samples = [[prime_str] * num_samples]
 
@@ -579,6 +1043,14 @@ def generate_smiles(generator, gen_data, init_args, prime_str='<', end_token='>'
                 x_ = x_.view(-1, 1)
             outputs = generator([x_] + hidden_states)
             hidden_states = outputs[1:]
+    syntax = get_syntax_mask(vocab.tokens, prime_str, end_token, init_args['device']) if syntax_mask else None
+    syntax_states = syntax.new_states(num_samples) if syntax else None
+    if gen_type == 'rnn' and not (return_probs or return_logits):
+        string_samples = sample_active_set(generator, hidden_states, prime_input, vocab, end_token, max_len, verbose,
+                                           syntax)
+        if is_train:
+            generator.train()
+        return string_samples
     inp = prime_input[:, -1]
     if inp.ndim == 1:
         inp = inp.view(-1, 1)
@@ -607,19 +1079,25 @@ def generate_smiles(generator, gen_data, init_args, prime_str='<', end_token='>'
             output = output.detach().cpu()
 
         # Sample the next character from the generator
-        probs = torch.softmax(output.view(-1, output.shape[-1]), dim=-1).detach()
+        output = output.view(-1, output.shape[-1])
+        if syntax:
+            output = syntax.apply(output, syntax_states)
+        probs = torch.softmax(output, dim=-1).detach()
         probs_out.append(probs)
         top_i = torch.multinomial(probs, 1).cpu().numpy()
+        if syntax:
+            syntax.update(syntax_states, top_i.reshape(-1).tolist())
 
         # Add predicated character to string and use as next input.
-        predicted_char = (np.array(gen_data.all_characters)[top_i].reshape(-1))
+        predicted_char = vocab.decode_tokens(top_i).reshape(-1)
         predicted_char = predicted_char.tolist()
         new_samples.append(predicted_char)
 
         # Prepare next input token for the generator
         if gen_type == 'trans':
-            predicted_char = np.array(new_samples).transpose()
-        inp, _ = seq2tensor(predicted_char, tokens=gen_data.all_characters)
+            inp = vocab.encode(np.array(new_samples).transpose())
+        else:
+            inp = top_i
         inp = torch.from_numpy(inp).long().to(init_args['device'])
     # except:
     #     print('SMILES generation error')
@@ -651,18 +1129,333 @@ def generate_smiles(generator, gen_data, init_args, prime_str='<', end_token='>'
     return string_samples
 
 
+def select_batch_states(hidden_states, index):
+    """
+    Selects the samples at `index` from the states of every layer. A layer state is a (hidden, cell[, stack]) tuple
+    where hidden and cell have the batch in dimension 1 and the stack in dimension 0. Missing states are None.
+    """
+    selected = []
+    for state in hidden_states:
+        batch_dims = [1, 1, 0][:len(state)]
+        selected.append(tuple(None if t is None else t.index_select(d, index) for t, d in zip(state, batch_dims)))
+    return selected
+
+
+@torch.no_grad()
+def sample_active_set(generator, hidden_states, prime_input, vocab, end_token='>', max_len=100, verbose=False,
+                      syntax=None):
+    """
+    Samples sequences from an RNN generator on the device of `prime_input`. Sequences are removed from the batch
+    (and their hidden and stack states dropped) as soon as they sample `end_token`, sampling stops once all sequences
+    have ended, and the token indices are decoded once at the end.
+
+    :param generator: nn.Module
+        The RNN generator. It takes [input, layer states...] and returns [logits, layer states...].
+    :param hidden_states: list
+        Initial states of the generator's layers. See ::func::select_batch_states.
+    :param prime_input: torch.Tensor
+        (batch_size, prime_len) token indices. The last column is the first input.
+    :param vocab: Vocabulary
+        Vocabulary (or ::class::SmilesTokenizer) of the generator.
+    :param end_token: str
+        Token indicating the end of a sequence.
+    :param max_len: int
+        Maximum number of sampling steps is max_len - 1.
+    :param syntax: SmilesSyntaxMask
+        Optional syntax mask applied to the logits of every step.
+    :return: list
+        The sampled strings, without the prime and end tokens.
+    """
+    num_samples, device = prime_input.shape[0], prime_input.device
+    end_idx = vocab.index(end_token)
+    tokens = torch.zeros(num_samples, max(0, max_len - 1), dtype=torch.long, device=device)
+    lengths = torch.full((num_samples,), tokens.shape[1], dtype=torch.long, device=device)
+    active = torch.arange(num_samples, device=device)
+    inp = prime_input[:, -1].view(-1, 1)
+    syntax_states = syntax.new_states(num_samples) if syntax else None
+    loop = trange(max_len - 1, desc='Generating SMILES...') if verbose else range(max_len - 1)
+    for t in loop:
+        outputs = generator([inp] + hidden_states)
+        output, hidden_states = outputs[0], outputs[1:]
+        output = output.view(-1, output.shape[-1])
+        if syntax:
+            output = syntax.apply(output, syntax_states)
+        probs = torch.softmax(output, dim=-1)
+        top_i = torch.multinomial(probs, 1).view(-1)
+        tokens[active, t] = top_i
+        if syntax:
+            syntax.update(syntax_states, top_i.tolist())
+        ended = top_i == end_idx
+        if ended.any():
+            lengths[active[ended]] = t
+            keep = torch.nonzero(~ended).view(-1)
+            if len(keep) == 0:
+                break
+            active, top_i = active[keep], top_i[keep]
+            hidden_states = select_batch_states(hidden_states, keep)
+            if syntax:
+                syntax_states = [syntax_states[i] for i in keep.tolist()]
+        inp = top_i.view(-1, 1)
+    token_array = vocab.decode_tokens(tokens.cpu().numpy())
+    return [''.join(row[:n]) for row, n in zip(token_array, lengths.cpu().tolist())]
+
+
+class Vocabulary(object):
+    """
+    Frozen mapping between single-character tokens and their indices.
+
+    Encoding and decoding are done with precomputed NumPy lookup tables indexed by character code, so a batch of
+    padded sequences is converted in one vectorized operation on its bytes instead of a `list.index` scan per
+    character.
+
+    :param tokens: iterable
+        The single-character tokens (code points < 256). The index of a token is its position in `tokens`.
+    :param strict: bool
+        If True, encoding a character that is not in the vocabulary raises a ValueError. Otherwise such characters
+        are mapped to index 0, the padding token of the default tokens.
+    """
+
+    def __init__(self, tokens, strict=False):
+        self._tokens = tuple(tokens)
+        self.strict = strict
+        assert len(self._tokens) > 0, 'A vocabulary requires at least one token'
+        # Index 256 collects every code point the table cannot hold, which is therefore always unknown.
+        self._lut = np.full((257,), -1, dtype=np.int64)
+        for i, token in enumerate(self._tokens):
+            assert len(token) == 1 and ord(token) < 256, f'Token {token!r} is not a single-byte character'
+            if self._lut[ord(token)] < 0:
+                self._lut[ord(token)] = i
+        self._token_codes = np.array([ord(t) for t in self._tokens], dtype=np.uint8)
+        self._token_array = np.array(self._tokens)
+
+    @property
+    def tokens(self):
+        return list(self._tokens)
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, token):
+        return len(token) == 1 and ord(token) < 256 and self._lut[ord(token)] >= 0
+
+    def index(self, token):
+        if token not in self:
+            raise ValueError(f'{token!r} is not in the vocabulary')
+        return int(self._lut[ord(token)])
+
+    def tokenize(self, seq):
+        return list(seq)
+
+    def _codes(self, rows, width):
+        text = ''.join(rows)
+        try:
+            return np.frombuffer(text.encode('latin-1'), dtype=np.uint8).reshape(len(rows), width)
+        except UnicodeEncodeError:
+            codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).reshape(len(rows), width)
+            return np.minimum(codes, 256)
+
+    def encode(self, seqs, flip=False):
+        """
+        Encodes a batch of sequences into a (len(seqs), max_seq_len) int64 matrix of token indices.
+
+        :param seqs: list
+            Sequences, each a string or a list of single-character tokens. Shorter sequences are filled with index 0.
+        :param flip: bool
+            Whether to reverse the sequences.
+        """
+        rows = [s if isinstance(s, str) else ''.join(s) for s in seqs]
+        if len(rows) == 0:
+            return np.zeros((0, 0), dtype=np.int64)
+        width = max(len(r) for r in rows)
+        if any(len(r) != width for r in rows):
+            rows = [r.ljust(width, self._tokens[0]) for r in rows]
+        indices = self._lut[self._codes(rows, width)]
+        unknown = indices < 0
+        if unknown.any():
+            if self.strict:
+                chars = sorted(set(c for r, m in zip(rows, unknown) for c, u in zip(r, m) if u))
+                raise ValueError(f'Characters {chars} are not in the vocabulary')
+            indices[unknown] = 0
+        if flip:
+            indices = np.flip(indices, axis=1).copy()
+        return indices
+
+    def decode_tokens(self, indices):
+        """Maps an array of token indices to an array of the same shape holding the tokens."""
+        return self._token_array[np.asarray(indices)]
+
+    def decode(self, indices, flip=False):
+        """
+        Decodes a (batch_size, seq_len) matrix of token indices into a list of strings.
+
+        :param indices: array-like
+            Token indices, e.g. the output of ::method::encode.
+        :param flip: bool
+            Whether the sequences were reversed when encoded.
+        """
+        indices = np.atleast_2d(np.asarray(indices))
+        if flip:
+            indices = np.flip(indices, axis=1)
+        codes = self._token_codes[indices]
+        width = codes.shape[1]
+        text = codes.tobytes().decode('latin-1')
+        return [text[i:i + width] for i in range(0, len(text), width)] if width > 0 else [''] * len(codes)
+
+    def state_dict(self):
+        return {'type': 'char', 'tokens': self.tokens}
+
+
+# Atom-level SMILES tokens: bracket atoms, two-letter organic-subset halogens, two-digit ring closures and the
+# generator's special characters are single tokens. Any other character is a token on its own.
+SMILES_TOKEN_PATTERN = r'(\[[^\]]+\]|Br|Cl|%\d{2}|[BCNOSPFIbcnosp]|[()\.=#\-+\\/:~@?*$<> \n]|\d|.)'
+
+
+class SmilesTokenizer(object):
+    """
+    Frozen atom-level (regex) SMILES vocabulary. It exposes the same interface as ::class::Vocabulary so that it can
+    be used wherever token sequences are tensorized, but sequences given as strings are first split with
+    `SMILES_TOKEN_PATTERN`. Sequences may also be given as lists of tokens.
+
+    :param tokens: iterable
+        The tokens. The index of a token is its position in `tokens`.
+    :param strict: bool
+        If True, encoding a token that is not in the vocabulary raises a ValueError. Otherwise such tokens are mapped
+        to index 0.
+    """
+
+    def __init__(self, tokens, strict=False):
+        self._tokens = tuple(tokens)
+        self.strict = strict
+        assert len(self._tokens) > 0, 'A vocabulary requires at least one token'
+        self._index = {}
+        for i, token in enumerate(self._tokens):
+            self._index.setdefault(token, i)
+        self._token_array = np.array(self._tokens, dtype=object)
+        self._regex = re.compile(SMILES_TOKEN_PATTERN, re.DOTALL)
+
+    @classmethod
+    def from_smiles(cls, smiles, special_tokens=(' ', '<', '>'), strict=False):
+        """Builds the vocabulary of the given SMILES. The special tokens come first, so the pad symbol gets index 0."""
+        tokenizer = cls(special_tokens)
+        found = set()
+        for sm in smiles:
+            found.update(tokenizer.tokenize(sm))
+        return cls(list(special_tokens) + sorted(found - set(special_tokens)), strict)
+
+    @property
+    def tokens(self):
+        return list(self._tokens)
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, token):
+        return token in self._index
+
+    def index(self, token):
+        if token not in self._index:
+            raise ValueError(f'{token!r} is not in the vocabulary')
+        return self._index[token]
+
+    def tokenize(self, smiles):
+        return self._regex.findall(smiles)
+
+    def encode(self, seqs, flip=False):
+        """
+        Encodes a batch of sequences into a (len(seqs), max_num_tokens) int64 matrix of token indices.
+
+        :param seqs: list
+            Sequences, each a SMILES string or a list of tokens. Shorter sequences are filled with index 0.
+            A single string is treated as a batch of one sequence.
+        :param flip: bool
+            Whether to reverse the sequences.
+        """
+        if isinstance(seqs, str):
+            seqs = [seqs]
+        rows = [self.tokenize(s) if isinstance(s, str) else list(s) for s in seqs]
+        lengths = np.array([len(r) for r in rows], dtype=np.int64)
+        width = int(lengths.max()) if len(rows) > 0 else 0
+        flat = np.fromiter((self._index.get(t, -1) for r in rows for t in r), dtype=np.int64, count=int(lengths.sum()))
+        if (flat < 0).any():
+            if self.strict:
+                unknown = sorted(set(t for r in rows for t in r if t not in self._index))
+                raise ValueError(f'Tokens {unknown} are not in the vocabulary')
+            flat[flat < 0] = 0
+        indices = np.zeros((len(rows), width), dtype=np.int64)
+        indices[np.arange(width)[None, :] < lengths[:, None]] = flat
+        if flip:
+            indices = np.flip(indices, axis=1).copy()
+        return indices
+
+    def decode_tokens(self, indices):
+        """Maps an array of token indices to an array of the same shape holding the tokens."""
+        return self._token_array[np.asarray(indices)]
+
+    def decode(self, indices, flip=False):
+        """Decodes a (batch_size, seq_len) matrix of token indices into a list of strings."""
+        indices = np.atleast_2d(np.asarray(indices))
+        if flip:
+            indices = np.flip(indices, axis=1)
+        return [''.join(row) for row in self._token_array[indices]]
+
+    def state_dict(self):
+        return {'type': 'regex', 'tokens': self.tokens, 'pattern': SMILES_TOKEN_PATTERN}
+
+
+# Vocabularies shared by all the call sites using the same tokens.
+_vocabulary_cache = {}
+
+
+def get_vocabulary(tokens=None, strict=False):
+    """
+    Returns the (cached) frozen vocabulary of the given tokens: a ::class::Vocabulary when all tokens are single
+    characters and a ::class::SmilesTokenizer otherwise.
+
+    :param tokens: iterable
+        The tokens. Defaults to ::func::get_default_tokens.
+    :param strict: bool
+        Whether unknown characters/tokens should be rejected.
+    """
+    key = (tuple(get_default_tokens() if tokens is None else tokens), strict)
+    vocab = _vocabulary_cache.get(key)
+    if vocab is None:
+        vocab_cls = Vocabulary if all(len(t) == 1 and ord(t) < 256 for t in key[0]) else SmilesTokenizer
+        vocab = _vocabulary_cache[key] = vocab_cls(key[0], strict)
+    return vocab
+
+
+def vocabulary_file(model_file):
+    """Path of the vocabulary metadata saved alongside the given model checkpoint."""
+    return model_file + '.vocab.json'
+
+
+def save_vocabulary(vocab, path):
+    """Writes the vocabulary metadata of a model checkpoint to a JSON file."""
+    with open(path, 'w') as f:
+        json.dump(vocab.state_dict(), f)
+
+
+def load_vocabulary(path, strict=False):
+    """Loads the vocabulary saved by ::func::save_vocabulary."""
+    with open(path, 'r') as f:
+        state = json.load(f)
+    return vocabulary_from_state_dict(state, strict)
+
+
+def vocabulary_from_state_dict(state, strict=False):
+    vocab_cls = SmilesTokenizer if state['type'] == 'regex' else Vocabulary
+    return vocab_cls(state['tokens'], strict)
+
+
 def seq2tensor(seqs, tokens, flip=False):
-    tensor = np.zeros((len(seqs), len(seqs[0])))
-    for i in range(len(seqs)):
-        for j in range(len(seqs[i])):
-            if seqs[i][j] in tokens:
-                tensor[i, j] = tokens.index(seqs[i][j])
-            else:
-                tokens = tokens + [seqs[i][j]]
-                tensor[i, j] = tokens.index(seqs[i][j])
-    if flip:
-        tensor = np.flip(tensor, axis=1).copy()
-    return tensor, tokens
+    """
+    Encodes the sequences with the ::class::Vocabulary of `tokens`.
+
+    :return: tuple
+        [0] (len(seqs), max_seq_len) int64 array of token indices
+        [1] the tokens, unchanged since the vocabulary is frozen
+    """
+    return get_vocabulary(tokens).encode(seqs, flip=flip), tokens
 
 
 def pad_sequences(seqs, max_length=None, pad_symbol=' '):
@@ -674,7 +1467,10 @@ def pad_sequences(seqs, max_length=None, pad_symbol=' '):
     for i in range(len(seqs)):
         cur_len = len(seqs[i])
         lengths.append(cur_len)
-        seqs[i] = seqs[i] + pad_symbol * (max_length - cur_len)
+        if isinstance(seqs[i], str):
+            seqs[i] = seqs[i] + pad_symbol * (max_length - cur_len)
+        else:  # list of (multi-character) tokens
+            seqs[i] = list(seqs[i]) + [pad_symbol] * (max_length - cur_len)
     return seqs, lengths
 
 
@@ -753,8 +1549,12 @@ class DummyException(RuntimeError):
 
 
 class SmilesDataset(Dataset):
-    def __init__(self, x, y):
-        self.X, processed_indices, invalid_indices = get_fp(x)
+    def __init__(self, x, y, features=None, feature_name='fp'):
+        if features is not None and feature_name in features:
+            # pre-featurized (cached) split, see irelease.dataloader.load_smiles_data
+            self.X, processed_indices = features[feature_name]
+        else:
+            self.X, processed_indices, invalid_indices = get_fp(x)
         self.y = y[processed_indices]
 
     def __len__(self):
@@ -0,0 +1,90 @@
+# Author: bbrighttaer
+# Project: IReLeaSE
+# Date: 10/19/2026
+# Time: 7:10 PM
+# File: benchmark_stack_rnn.py
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import time
+
+import torch
+
+from irelease.model import StackRNN, FusedStackRNN
+from irelease.utils import init_hidden, init_cell, init_stack
+
+
+def initial_states(args, device):
+    hidden = init_hidden(1, args.batch_size, args.hidden_size, num_dir=1, dvc=device)
+    cell = init_cell(1, args.batch_size, args.hidden_size, num_dir=1, dvc=device) if args.unit_type == 'lstm' else None
+    stack = init_stack(args.batch_size, args.stack_width, args.stack_depth, dvc=device)
+    return hidden, cell, stack
+
+
+def max_abs_diff(a, b):
+    return max((x - y).abs().max().item() for x, y in zip(a, b) if x is not None)
+
+
+def check_equivalence(layer, fused, x, states):
+    out = layer([x, states])
+    out_fused = fused([x, states])
+    out[0].sum().backward()
+    out_fused[0].sum().backward()
+    grads = [p.grad for p in layer.parameters()]
+    grads_fused = [p.grad for p in fused.parameters()]
+    layer.zero_grad()
+    fused.zero_grad()
+    return {'output': max_abs_diff([out[0]], [out_fused[0]]),
+            'states': max_abs_diff(out[1], out_fused[1]),
+            'grads': max_abs_diff(grads, grads_fused)}
+
+
+def time_layer(layer, x, states, iterations, backward, device):
+    for _ in range(2):  # warm-up, which also compiles the TorchScript loop
+        out = layer([x, states])
+        if backward:
+            out[0].sum().backward()
+    if 'cuda' in device:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iterations):
+        out = layer([x, states])
+        if backward:
+            out[0].sum().backward()
+    if 'cuda' in device:
+        torch.cuda.synchronize()
+    return (time.time() - start) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Compares StackRNN with FusedStackRNN on full-sequence passes')
+    parser.add_argument('--unit_type', type=str, default='gru', choices=['gru', 'lstm'])
+    parser.add_argument('--seq_len', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--input_size', type=int, default=256)
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--stack_width', type=int, default=256)
+    parser.add_argument('--stack_depth', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--forward_only', action='store_true', help='Times the forward pass only')
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    layer = StackRNN(1, args.input_size, args.hidden_size, True, args.unit_type, args.stack_width,
+                     args.stack_depth).to(args.device)
+    fused = FusedStackRNN.from_layer(layer)
+    x = torch.randn(args.seq_len, args.batch_size, args.input_size, device=args.device)
+    states = initial_states(args, args.device)
+
+    diffs = check_equivalence(layer, fused, x, states)
+    print('Max. absolute differences: ' + ', '.join(f'{k} = {v:.2e}' for k, v in diffs.items()))
+
+    backward = not args.forward_only
+    t_layer = time_layer(layer, x, states, args.iterations, backward, args.device)
+    t_fused = time_layer(fused, x, states, args.iterations, backward, args.device)
+    print(f'{"Forward" if args.forward_only else "Forward + backward"} pass, {args.unit_type}, '
+          f'seq_len={args.seq_len}, batch_size={args.batch_size}, device={args.device}')
+    print(f'StackRNN: {t_layer * 1000:.1f} ms, FusedStackRNN: {t_fused * 1000:.1f} ms, '
+          f'speedup = {t_layer / t_fused:.2f}x')
@@ -0,0 +1,47 @@
+# Author: bbrighttaer
+# Project: IReLeaSE
+# Date: 10/19/2026
+# Time: 2:05 PM
+# File: build_token_corpus.py
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import time
+
+from irelease.data import build_token_corpus
+from irelease.utils import read_object_property_file, bulk_canonical_smiles, get_default_tokens, Vocabulary, \
+    SmilesTokenizer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Builds a pre-tokenized, memory-mappable SMILES corpus for generator training')
+    parser.add_argument('--data', type=str, help='SMILES file')
+    parser.add_argument('--output', type=str, help='Directory of the corpus to be created')
+    parser.add_argument('--delimiter', type=str, default='\t')
+    parser.add_argument('--col', type=int, default=0, help='Column of the SMILES in the data file')
+    parser.add_argument('--keep_header', action='store_true', help='Whether the first row is data and not a header')
+    parser.add_argument('--max_len', type=int, default=120, help='SMILES longer than this are excluded')
+    parser.add_argument('--tokenizer', type=str, default='char', choices=['char', 'regex'])
+    parser.add_argument('--no_canonicalize', action='store_true', help='Keeps the SMILES as they are in the file')
+    parser.add_argument('--chunk_size', type=int, default=100000)
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='Number of canonicalization processes. Non-positive values use all CPUs.')
+    args = parser.parse_args()
+
+    start = time.time()
+    smiles = read_object_property_file(args.data, delimiter=args.delimiter, cols_to_read=[args.col],
+                                       keep_header=args.keep_header)
+    smiles = [sm.strip() for sm in smiles]
+    if not args.no_canonicalize:
+        print('Canonicalizing...')
+        canon, valid = bulk_canonical_smiles(smiles, sanitize=True, n_jobs=args.num_workers)
+        canonical = [sm for sm, v in zip(canon, valid) if v and len(sm) > 0]
+        print(f'{len(smiles) - len(canonical)} invalid SMILES removed')
+        smiles = canonical
+    if args.tokenizer == 'regex':
+        vocab = SmilesTokenizer.from_smiles(smiles, special_tokens=(' ', '<', '>'))
+    else:
+        tokens = get_default_tokens()
+        vocab = Vocabulary(tokens + sorted(set(''.join(smiles)) - set(tokens)))
+    num_seqs = build_token_corpus(smiles, args.output, vocab, max_len=args.max_len, chunk_size=args.chunk_size)
+    print(f'{num_seqs} sequences ({len(vocab)} tokens) written to {args.output} in {time.time() - start:.1f}s')
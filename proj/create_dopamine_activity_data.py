@@ -22,6 +22,8 @@ if __name__ == '__main__':
     parser.add_argument('--data', type=str, help='The SMILES data file to be used in creating the activity dataset')
     parser.add_argument('--save_dir', type=str, default='../data', help='The directory to save the created dataset')
     parser.add_argument('--filename', type=str, default='drd2_active.smi', help='The filename for the created dataset')
+    parser.add_argument('--batch_size', type=int, default=1024, help='Number of compounds scored per classifier call')
+    parser.add_argument('--n_jobs', type=int, default=1, help='Number of processes used for featurization')
     args = parser.parse_args()
 
     assert(os.path.exists(args.svc))
@@ -45,10 +47,11 @@ if __name__ == '__main__':
     os.makedirs(args.save_dir, exist_ok=True)
     num_active = 0
     with open(os.path.join(args.save_dir, args.filename), 'w') as f:
-        for i in trange(gen_data.file_len, desc='Screening compounds...'):
-            smiles = gen_data.file[i][1:-1]
-            p = clf(smiles)
-            if p >= args.threshold:
-                f.write(smiles + '\n')
-                num_active += 1
+        for i in trange(0, gen_data.file_len, args.batch_size, desc='Screening compounds...'):
+            smiles = [s[1:-1] for s in gen_data.file[i:i + args.batch_size]]
+            p = clf.predict_batch(smiles, batch_size=args.batch_size, n_jobs=args.n_jobs)
+            for sm, score in zip(smiles, p):
+                if score >= args.threshold:
+                    f.write(sm + '\n')
+                    num_active += 1
     print(f'Total number of actives written to file = {num_active}')
@@ -23,7 +23,7 @@ from soek import Trainer, DataNode, CategoricalParam, RealParam, RandomSearch, \
 from soek.bopt import GPMinArgs
 
 from irelease.dataloader import load_smiles_data
-from irelease.utils import Flags, time_since, SmilesDataset
+from irelease.utils import Flags, time_since, SmilesDataset, get_fp
 
 currentDT = dt.now()
 date_label = currentDT.strftime("%Y_%m_%d__%H_%M_%S")
@@ -116,7 +116,8 @@ def main(flags):
 
     # Load the data
     data_dict, transformer = load_smiles_data(flags.data_file, flags.cv, normalize_y=True, k=flags.folds,
-                                              index_col=None)
+                                              index_col=None,
+                                              featurizers={'fp': get_fp})
 
     for seed in seeds:
         data_node = DataNode(label="seed_%d" % seed)
@@ -25,7 +25,7 @@ from soek.bopt import GPMinArgs
 from sklearn.metrics import r2_score, mean_squared_error
 
 from irelease.dataloader import load_smiles_data
-from irelease.utils import time_since, SmilesDataset, root_mean_squared_error
+from irelease.utils import time_since, SmilesDataset, root_mean_squared_error, get_fp
 
 currentDT = dt.now()
 date_label = currentDT.strftime("%Y_%m_%d__%H_%M_%S")
@@ -182,7 +182,8 @@ def main(flags):
 
     # Load the data
     data_dict, transformer = load_smiles_data(flags.data_file, flags.cv, normalize_y=True, k=flags.folds, shuffle=5,
-                                              create_val=True, train_size=.7, index_col=None)
+                                              create_val=True, train_size=.7, index_col=None,
+                                              featurizers={'fp': get_fp})
 
     for seed in seeds:
         data_node = DataNode(label="seed_%d" % seed)
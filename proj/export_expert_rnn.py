@@ -0,0 +1,54 @@
+# Author: bbrighttaer
+# Project: IReLeaSE
+# Date: 10/19/2026
+# Time: 10:12 AM
+# File: export_expert_rnn.py
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import json
+import os
+
+import pandas as pd
+
+from irelease.predictor import RNNPredictor, export_rnn_predictor, compare_predictors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Exports an RNN expert ensemble to a (quantized) TorchScript artifact for CPU')
+    parser.add_argument('--model_dir', type=str, help='Directory containing the fold models (and transformer)')
+    parser.add_argument('--output', type=str, help='Path of the TorchScript artifact to be created')
+    parser.add_argument('--d_model', type=int, default=128)
+    parser.add_argument('--rnn_num_layers', type=int, default=2)
+    parser.add_argument('--dropout', type=float, default=0.8)
+    parser.add_argument('--bidirectional', action='store_true', help='Whether the expert RNN is bidirectional')
+    parser.add_argument('--unit_type', type=str, default='lstm', help='One of [lstm, gru]')
+    parser.add_argument('--binary', action='store_true', help='Whether the expert is a binary classifier (DRD2)')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Applies int8 dynamic quantization to the LSTM and Linear layers')
+    parser.add_argument('--eval_file', type=str, default=None,
+                        help='Held-out CSV file used to report the accuracy delta against the float model')
+    parser.add_argument('--smiles_col', type=str, default='SMILES', help='SMILES column of the held-out file')
+    parser.add_argument('--label_col', type=str, default=None,
+                        help='Label column of the held-out file. Defaults to the last column.')
+    parser.add_argument('--num_eval', type=int, default=10000, help='Maximum number of held-out molecules to use')
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.model_dir)
+    hparams = {'model_dir': args.model_dir,
+               'd_model': args.d_model,
+               'rnn_num_layers': args.rnn_num_layers,
+               'dropout': args.dropout,
+               'is_bidirectional': args.bidirectional,
+               'unit_type': args.unit_type}
+    export_rnn_predictor(hparams, args.output, is_binary=args.binary, quantize=args.quantize)
+    print(f'TorchScript expert saved to {args.output}')
+
+    if args.eval_file:
+        df = pd.read_csv(args.eval_file, header=0).iloc[:args.num_eval]
+        label_col = args.label_col if args.label_col else df.columns[-1]
+        float_model = RNNPredictor(hparams, 'cpu', args.binary)
+        script_model = RNNPredictor({'script_model': args.output}, 'cpu', args.binary)
+        results = compare_predictors(float_model, script_model, df[args.smiles_col].tolist(),
+                                     labels=df[label_col].values, is_binary=args.binary)
+        print(json.dumps(results, indent=2))
@@ -29,15 +29,15 @@ from tqdm import tqdm
 from irelease.data import GeneratorData
 from irelease.env import MoleculeEnv
 from irelease.model import Encoder, StackRNN, RNNLinearOut, \
-    CriticRNN, RewardNetRNN, StackedRNNDropout, StackedRNNLayerNorm
+    CriticRNN, RewardNetRNN, StackedRNNDropout, StackedRNNLayerNorm, fuse_stack_rnn_layers
 from irelease.mol_metrics import verify_sequence, get_mol_metrics
 from irelease.predictor import get_jak2_max_reward, get_jak2_min_reward, XGBPredictor, get_jak2_max_baseline_reward, \
-    get_jak2_min_baseline_reward
+    get_jak2_min_baseline_reward, InstrumentedPredictor
 from irelease.reward import RewardFunction
 from irelease.rl import MolEnvProbabilityActionSelector, PolicyAgent, GuidedRewardLearningIRL, \
     StateActionProbRegistry, Trajectory, EpisodeStep, PPO
-from irelease.utils import Flags, get_default_tokens, parse_optimizer, seq2tensor, init_hidden, init_cell, init_stack, \
-    time_since, generate_smiles, ExpAverage
+from irelease.utils import Flags, get_default_tokens, parse_optimizer, seq2tensor, \
+    time_since, generate_smiles, ExpAverage, smiles_cache, state_pool
 
 currentDT = dt.now()
 date_label = currentDT.strftime("%Y_%m_%d__%H_%M_%S")
@@ -59,15 +59,7 @@ def agent_net_hidden_states_func(batch_size, num_layers, hidden_size, stack_dept
 
 
 def get_initial_states(batch_size, hidden_size, num_layers, stack_depth, stack_width, unit_type):
-    hidden = init_hidden(num_layers=num_layers, batch_size=batch_size, hidden_size=hidden_size, num_dir=1,
-                         dvc=device)
-    if unit_type == 'lstm':
-        cell = init_cell(num_layers=num_layers, batch_size=batch_size, hidden_size=hidden_size, num_dir=1,
-                         dvc=device)
-    else:
-        cell = None
-    stack = init_stack(batch_size, stack_width, stack_depth, dvc=device)
-    return hidden, cell, stack
+    return state_pool.states(batch_size, hidden_size, num_layers, stack_depth, stack_width, unit_type, dvc=device)
 
 
 class IReLeaSE(Trainer):
@@ -100,6 +92,8 @@ class IReLeaSE(Trainer):
                                                hidden_size=hparams['d_model'],
                                                bidirectional=False,
                                                bias=True))
+        if hparams.get('fused_rnn', False):
+            agent_net = fuse_stack_rnn_layers(agent_net)
         optimizer_agent_net = parse_optimizer(hparams['agent_params'], agent_net)
         with contextlib.suppress(Exception):
             agent_net = agent_net.to(device)
@@ -151,7 +145,7 @@ class IReLeaSE(Trainer):
         with contextlib.suppress(Exception):
             reward_net = reward_net.to(device)
 
-        expert_model = XGBPredictor(hparams['expert_model_dir'])
+        expert_model = InstrumentedPredictor(XGBPredictor(hparams['expert_model_dir']))
         if hparams['baseline_reward']:
             true_reward_func = get_jak2_max_baseline_reward if hparams['bias_mode'] == 'max' \
                 else get_jak2_min_baseline_reward
@@ -350,6 +344,10 @@ class IReLeaSE(Trainer):
                         tb_writer.add_scalars('qsar_score', {'sampled': mean_preds,
                                                              'baseline': baseline_score,
                                                              'demo_data': demo_score}, step_idx)
+                        expert_model.stats.write_to_tensorboard(tb_writer, step_idx)
+                        smiles_cache.write_to_tensorboard(tb_writer, step_idx)
+                        state_pool.write_to_tensorboard(tb_writer, step_idx)
+                        expert_model.stats.reset()
                         tb_writer.add_scalars('SMILES stats', {'per. of valid': per_valid,
                                                                'per. in drug-like region': percentage_in_threshold},
                                               step_idx)
@@ -556,6 +554,7 @@ def main(flags):
 def default_hparams_min(args):
     return {'d_model': 1500,
             'dropout': 0.0,
+            'fused_rnn': args.fused_rnn,
             'monte_carlo_N': 5,
             'use_monte_carlo_sim': True,
             'no_mc_fill_val': 0.0,
@@ -602,6 +601,7 @@ def default_hparams_min(args):
 def default_hparams_max(args):
     return {'d_model': 1500,
             'dropout': 0.0,
+            'fused_rnn': args.fused_rnn,
             'monte_carlo_N': 5,
             'use_monte_carlo_sim': True,
             'no_mc_fill_val': 0.0,
@@ -731,6 +731,9 @@ if __name__ == '__main__':
                         help='If true reward is enabled, this indicates whether the baseline reward option is used.')
     parser.add_argument('--no_smiles_validity_flag', action='store_true',
                         help='If True, smiles validity flag would not be passed to the reward net')
+    parser.add_argument('--fused_rnn', action='store_true',
+                        help='Uses the TorchScript stack-RNN layer (FusedStackRNN) for the teacher-forced passes of '
+                             'the policy updates. Checkpoints are interchangeable with the default layer.')
 
     args = parser.parse_args()
     flags = Flags()
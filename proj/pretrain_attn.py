@@ -17,7 +17,7 @@ from datetime import datetime as dt
 import numpy as np
 import torch
 import torch.nn as nn
-from irelease.data import GeneratorData
+from irelease.data import GeneratorData, BucketBatchSampler
 from irelease.model import StackDecoderLayer, Encoder, PositionalEncoding, AttentionTerminal
 from irelease.utils import Flags, get_default_tokens, parse_optimizer, ExpAverage, GradStats, Count, init_stack_2d, \
     time_since, generate_smiles
@@ -137,7 +137,9 @@ class GpmtPretrain(Trainer):
         best_epoch = -1
         terminate_training = False
         e_avg = ExpAverage(.01)
-        num_batches = math.ceil(gen_data.file_len / gen_data.batch_size)
+        # length-bucketed batches prepared in the background
+        sampler = BucketBatchSampler(gen_data)
+        num_batches = sampler.num_batches
         n_epochs = math.ceil(n_iters / num_batches)
         grad_stats = GradStats(model, beta=0.)
 
@@ -186,7 +188,7 @@ class GpmtPretrain(Trainer):
                     # with TBMeanTracker(tb_writer, 10) as tracker:
                     with grad_stats:
                         for b in trange(0, num_batches, desc=f'{phase} in progress...'):
-                            inputs, labels = gen_data.random_training_set()
+                            inputs, labels = next(sampler)
 
                             optimizer.zero_grad()
 
@@ -278,6 +280,8 @@ class GpmtPretrain(Trainer):
                             best_epoch = epoch
         except RuntimeError as e:
             print(str(e))
+        finally:
+            sampler.close()
 
         duration = time.time() - start
         print('\nModel training duration: {:.0f}m {:.0f}s'.format(duration // 60, duration % 60))
@@ -24,10 +24,12 @@ from soek.template import Trainer
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import trange
 
-from irelease.data import GeneratorData
-from irelease.model import Encoder, StackRNN, RNNLinearOut, StackedRNNLayerNorm, StackedRNNDropout
+from irelease.data import GeneratorData, TokenCorpusData, BucketBatchSampler
+from irelease.model import Encoder, StackRNN, FusedStackRNN, RNNLinearOut, StackedRNNLayerNorm, StackedRNNDropout
+from irelease.sampling import sample_unique
 from irelease.utils import Flags, parse_optimizer, ExpAverage, GradStats, Count, init_hidden, init_cell, init_stack, \
-    generate_smiles, time_since, get_default_tokens, canonical_smiles
+    generate_smiles, time_since, get_default_tokens, save_vocabulary, load_vocabulary, \
+    vocabulary_file, SmilesTokenizer
 
 currentDT = dt.now()
 date_label = currentDT.strftime("%Y_%m_%d__%H_%M_%S")
@@ -55,15 +57,16 @@ class IreleasePretrain(Trainer):
         # Create RNN layers
         rnn_layers = []
         has_stack = True
+        rnn_cls = FusedStackRNN if hparams.get('fused_rnn', False) else StackRNN
         for i in range(1, hparams['num_layers'] + 1):
-            rnn_layers.append(StackRNN(layer_index=i,
-                                       input_size=hparams['d_model'],
-                                       hidden_size=hparams['d_model'],
-                                       has_stack=has_stack,
-                                       unit_type=hparams['unit_type'],
-                                       stack_width=hparams['stack_width'],
-                                       stack_depth=hparams['stack_depth'],
-                                       k_mask_func=encoder.k_padding_mask))
+            rnn_layers.append(rnn_cls(layer_index=i,
+                                      input_size=hparams['d_model'],
+                                      hidden_size=hparams['d_model'],
+                                      has_stack=has_stack,
+                                      unit_type=hparams['unit_type'],
+                                      stack_width=hparams['stack_width'],
+                                      stack_depth=hparams['stack_depth'],
+                                      k_mask_func=encoder.k_padding_mask))
             if hparams['num_layers'] > 1:
                 rnn_layers.append(StackedRNNDropout(hparams['dropout']))
                 rnn_layers.append(StackedRNNLayerNorm(hparams['d_model']))
@@ -91,7 +94,17 @@ class IreleasePretrain(Trainer):
 
     @staticmethod
     def data_provider(k, flags):
-        tokens = get_default_tokens()
+        if flags.corpus:
+            gen_data = TokenCorpusData(flags.corpus, use_cuda=use_cuda)
+            return {"train": gen_data, "val": gen_data, "test": gen_data}
+        tokenizer = flags.tokenizer
+        tokens = get_default_tokens() if tokenizer == 'char' else None
+        # A saved model is used with the vocabulary it was trained with.
+        model_name = flags.eval_model_name if flags.eval else flags.init_model
+        if model_name and os.path.exists(vocabulary_file(os.path.join(flags.model_dir, model_name))):
+            vocab = load_vocabulary(vocabulary_file(os.path.join(flags.model_dir, model_name)))
+            tokens = vocab.tokens
+            tokenizer = 'regex' if isinstance(vocab, SmilesTokenizer) else 'char'
         gen_data = GeneratorData(training_data_path=flags.data_file,
                                  delimiter='\t',
                                  cols_to_read=[0],
@@ -99,7 +112,8 @@ class IreleasePretrain(Trainer):
                                  pad_symbol=' ',
                                  max_len=120,
                                  tokens=tokens,
-                                 use_cuda=use_cuda)
+                                 use_cuda=use_cuda,
+                                 tokenizer=tokenizer)
         return {"train": gen_data, "val": gen_data, "test": gen_data}
 
     @staticmethod
@@ -121,7 +135,9 @@ class IreleasePretrain(Trainer):
         best_epoch = -1
         terminate_training = False
         e_avg = ExpAverage(.01)
-        num_batches = math.ceil(gen_data.file_len / gen_data.batch_size)
+        # length-bucketed batches prepared in the background
+        sampler = BucketBatchSampler(gen_data)
+        num_batches = sampler.num_batches
         n_epochs = math.ceil(n_iters / num_batches)
         grad_stats = GradStats(model, beta=0.)
 
@@ -157,7 +173,7 @@ class IreleasePretrain(Trainer):
                 # with TBMeanTracker(tb_writer, 10) as tracker:
                 with grad_stats:
                     for b in trange(0, num_batches, desc=f'{phase} in progress...'):
-                        inputs, labels = gen_data.random_training_set()
+                        inputs, labels = next(sampler)
                         batch_size, seq_len = inputs.shape[:2]
                         optimizer.zero_grad()
 
@@ -229,10 +245,13 @@ class IreleasePretrain(Trainer):
                                                                                           num_samples=1)
                                                                                       ))
                     IreleasePretrain.save_model(model, './model_dir/', name=f'irelease-pretrained_stack-rnn_gru_'
-                                                                            f'{date_label}_epoch_{epoch}')
+                                                                            f'{date_label}_epoch_{epoch}',
+                                                vocab=gen_data.vocab)
                 # End of mini=batch iterations.
         except RuntimeError as e:
             print(str(e))
+        finally:
+            sampler.close()
 
         duration = time.time() - start
         print('\nModel training duration: {:.0f}m {:.0f}s'.format(duration // 60, duration % 60))
@@ -244,31 +263,12 @@ class IreleasePretrain(Trainer):
         start = time.time()
         model.eval()
 
-        # Samples SMILES
-        samples = []
-        step = 100
-        count = 0
-        for _ in range(int(num_smiles / step)):
-            samples.extend(generate_smiles(generator=model, gen_data=gen_data, init_args=rnn_args,
-                                           num_samples=step, is_train=False, verbose=True))
-            count += step
-        res = num_smiles - count
-        if res > 0:
-            samples.extend(generate_smiles(generator=model, gen_data=gen_data, init_args=rnn_args,
-                                           num_samples=res, is_train=False, verbose=True))
-        smiles, valid_vec = canonical_smiles(samples)
-        valid_smiles = []
-        invalid_smiles = []
-        for idx, sm in enumerate(smiles):
-            if len(sm) > 0:
-                valid_smiles.append(sm)
-            else:
-                invalid_smiles.append(samples[idx])
-        v = len(valid_smiles)
-        valid_smiles = list(set(valid_smiles))
-        print(f'Percentage of valid SMILES = {float(len(valid_smiles)) / float(len(samples)):.2f}, '
-              f'Num. samples = {len(samples)}, Num. valid = {len(valid_smiles)}, '
-              f'Num. requested = {num_smiles}, Num. dups = {v - len(valid_smiles)}')
+        # Samples SMILES until num_smiles unique, valid SMILES are collected
+        res = sample_unique(model, gen_data, rnn_args, num_smiles, batch_size=100)
+        valid_smiles, invalid_smiles = res.smiles, res.invalid
+        print(f'Percentage of valid SMILES = {float(res.num_valid) / float(res.num_samples):.2f}, '
+              f'Num. samples = {res.num_samples}, Num. unique valid = {len(valid_smiles)}, '
+              f'Num. requested = {num_smiles}, Num. dups = {res.num_duplicates}, Stopped early = {res.aborted}')
 
         # sub-nodes of sim data resource
         smiles_node = DataNode(label="valid_smiles", data=valid_smiles)
@@ -282,10 +282,12 @@ class IreleasePretrain(Trainer):
         print('\nModel evaluation duration: {:.0f}m {:.0f}s'.format(duration // 60, duration % 60))
 
     @staticmethod
-    def save_model(model, path, name):
+    def save_model(model, path, name, vocab=None):
         os.makedirs(path, exist_ok=True)
         file = os.path.join(path, name + ".mod")
         torch.save(model.state_dict(), file)
+        if vocab is not None:
+            save_vocabulary(vocab, vocabulary_file(file))
 
     @staticmethod
     def load_model(path, name):
@@ -381,7 +383,8 @@ def main(flags):
                                         tb_writer=summary_writer_creator)
                 trainer.save_model(results['model'], flags.model_dir,
                                    name=f'irelease-pretrained_stack-rnn_{hyper_params["unit_type"]}_'
-                                        f'{date_label}_{results["score"]}_{results["epoch"]}')
+                                        f'{date_label}_{results["score"]}_{results["epoch"]}',
+                                   vocab=gen_data.vocab)
 
     # save simulation data resource tree to file.
     sim_data.to_json(path="./analysis/")
@@ -396,6 +399,7 @@ def default_hparams(args):
         'stack_width': 1500,
         'stack_depth': 200,
         'batch_size': 1,
+        'fused_rnn': args.fused_rnn,
 
         # optimizer params
         'optimizer': 'adadelta',
@@ -428,6 +432,8 @@ if __name__ == '__main__':
                         type=str,
                         dest='data_file',
                         help='Train data file')
+    parser.add_argument('--corpus', type=str, default=None,
+                        help='Pre-tokenized corpus directory (see build_token_corpus.py). Used instead of --data.')
     parser.add_argument('--model_dir',
                         type=str,
                         default='./model_dir',
@@ -452,6 +458,12 @@ if __name__ == '__main__':
     parser.add_argument("--init_model", help="Initial model weights")
     parser.add_argument('--num_smiles', type=int, default=10000,
                         help='Number of SMILES to sample from a generator in eval mode', )
+    parser.add_argument('--tokenizer', type=str, default='char', choices=['char', 'regex'],
+                        help='char: one token per SMILES character. regex: atom-level tokens, e.g. Cl, [nH], %%10. '
+                             'The vocabulary is saved next to the model and reloaded with it.')
+    parser.add_argument('--fused_rnn', action='store_true',
+                        help='Uses the TorchScript stack-RNN layer (FusedStackRNN) for teacher forcing. '
+                             'Checkpoints are interchangeable with the default layer.')
 
     args = parser.parse_args()
     flags = Flags()
@@ -28,14 +28,14 @@ from tqdm import tqdm
 from irelease.data import GeneratorData
 from irelease.env import MoleculeEnv
 from irelease.model import Encoder, StackRNN, RNNLinearOut, \
-    RewardNetRNN, StackedRNNDropout, StackedRNNLayerNorm
+    RewardNetRNN, StackedRNNDropout, StackedRNNLayerNorm, fuse_stack_rnn_layers
 from irelease.mol_metrics import verify_sequence, get_mol_metrics
-from irelease.predictor import get_drd2_activity_reward, RNNPredictor
+from irelease.predictor import get_drd2_activity_reward, RNNPredictor, InstrumentedPredictor
 from irelease.reward import RewardFunction
 from irelease.rl import MolEnvProbabilityActionSelector, PolicyAgent, GuidedRewardLearningIRL, \
     StateActionProbRegistry, Trajectory, EpisodeStep, REINFORCE
-from irelease.utils import Flags, get_default_tokens, parse_optimizer, seq2tensor, init_hidden, init_cell, init_stack, \
-    time_since, generate_smiles, ExpAverage, DummyException
+from irelease.utils import Flags, get_default_tokens, parse_optimizer, seq2tensor, \
+    time_since, generate_smiles, ExpAverage, DummyException, smiles_cache, state_pool
 
 currentDT = dt.now()
 date_label = currentDT.strftime("%Y_%m_%d__%H_%M_%S")
@@ -58,15 +58,7 @@ def agent_net_hidden_states_func(batch_size, num_layers, hidden_size, stack_dept
 
 
 def get_initial_states(batch_size, hidden_size, num_layers, stack_depth, stack_width, unit_type):
-    hidden = init_hidden(num_layers=num_layers, batch_size=batch_size, hidden_size=hidden_size, num_dir=1,
-                         dvc=device)
-    if unit_type == 'lstm':
-        cell = init_cell(num_layers=num_layers, batch_size=batch_size, hidden_size=hidden_size, num_dir=1,
-                         dvc=device)
-    else:
-        cell = None
-    stack = init_stack(batch_size, stack_width, stack_depth, dvc=device)
-    return hidden, cell, stack
+    return state_pool.states(batch_size, hidden_size, num_layers, stack_depth, stack_width, unit_type, dvc=device)
 
 
 class IReLeaSE(Trainer):
@@ -99,6 +91,8 @@ class IReLeaSE(Trainer):
                                                hidden_size=hparams['d_model'],
                                                bidirectional=False,
                                                bias=True))
+        if hparams.get('fused_rnn', False):
+            agent_net = fuse_stack_rnn_layers(agent_net)
         with contextlib.suppress(Exception):
             agent_net = agent_net.to(device)
         optimizer_agent_net = parse_optimizer(hparams['agent_params'], agent_net)
@@ -141,7 +135,7 @@ class IReLeaSE(Trainer):
                                                 use_smiles_validity_flag=hparams['reward_params']['use_validity_flag']))
         with contextlib.suppress(Exception):
             reward_net = reward_net.to(device)
-        expert_model = RNNPredictor(hparams['expert_model_params'], device, True)
+        expert_model = InstrumentedPredictor(RNNPredictor(hparams['expert_model_params'], device, True))
         reward_function = RewardFunction(reward_net, mc_policy=agent, actions=demo_data_gen.all_characters,
                                          device=device, use_mc=hparams['use_monte_carlo_sim'],
                                          mc_max_sims=hparams['monte_carlo_N'],
@@ -311,6 +305,10 @@ class IReLeaSE(Trainer):
                         tb_writer.add_scalars('qsar_score', {'sampled': mean_preds,
                                                              'baseline': baseline_score,
                                                              'demo_data': demo_score}, step_idx)
+                        expert_model.stats.write_to_tensorboard(tb_writer, step_idx)
+                        smiles_cache.write_to_tensorboard(tb_writer, step_idx)
+                        state_pool.write_to_tensorboard(tb_writer, step_idx)
+                        expert_model.stats.reset()
                         tb_writer.add_scalars('SMILES stats', {'per. of valid': per_valid,
                                                                'per. of actives': per_active},
                                               step_idx)
@@ -483,6 +481,7 @@ def main(flags):
 def default_hparams(args):
     return {'d_model': 1500,
             'dropout': 0.0,
+            'fused_rnn': args.fused_rnn,
             'monte_carlo_N': 5,
             'use_monte_carlo_sim': False,
             'no_mc_fill_val': 0.0,
@@ -596,6 +595,9 @@ if __name__ == '__main__':
                              'This requires that the explicit reward function is given.')
     parser.add_argument('--no_smiles_validity_flag', action='store_true',
                         help='If True, smiles validity flag would not be passed to the reward net')
+    parser.add_argument('--fused_rnn', action='store_true',
+                        help='Uses the TorchScript stack-RNN layer (FusedStackRNN) for the teacher-forced passes of '
+                             'the policy updates. Checkpoints are interchangeable with the default layer.')
 
     args = parser.parse_args()
     flags = Flags()
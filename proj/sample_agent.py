@@ -0,0 +1,212 @@
+# Author: bbrighttaer
+# Project: IReLeaSE
+# Date: 10/19/2026
+# Time: 5:20 PM
+# File: sample_agent.py
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import time
+
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from irelease.data import GeneratorData
+from irelease.model import Encoder, StackRNN, StackedRNNDropout, StackedRNNLayerNorm, RNNLinearOut
+from irelease.sampling import iter_smiles, SmilesWriter
+from irelease.utils import get_default_tokens, load_vocabulary
+
+# Per-process agent, loaded once by ::func::init_worker
+_worker_state = {}
+
+
+class TokenData(object):
+    """The vocabulary attributes of ::class::irelease.data.GeneratorData needed for sampling."""
+
+    def __init__(self, tokens, pad_symbol=' '):
+        self.all_characters = list(tokens)
+        self.n_characters = len(self.all_characters)
+        self.pad_symbol = pad_symbol
+        self.char2idx = dict((token, i) for i, token in enumerate(self.all_characters))
+
+
+def build_agent(hparams, gen_data, device):
+    """Creates the stack-RNN agent of the RL drivers (e.g. ppo_rl_drd2.py) and its generation arguments."""
+    encoder = Encoder(vocab_size=gen_data.n_characters, d_model=hparams['d_model'],
+                      padding_idx=gen_data.char2idx[gen_data.pad_symbol],
+                      dropout=hparams['dropout'], return_tuple=True)
+    rnn_layers = []
+    for i in range(1, hparams['num_layers'] + 1):
+        rnn_layers.append(StackRNN(layer_index=i,
+                                   input_size=hparams['d_model'],
+                                   hidden_size=hparams['d_model'],
+                                   has_stack=True,
+                                   unit_type=hparams['unit_type'],
+                                   stack_width=hparams['stack_width'],
+                                   stack_depth=hparams['stack_depth'],
+                                   k_mask_func=encoder.k_padding_mask))
+        if hparams['num_layers'] > 1:
+            rnn_layers.append(StackedRNNDropout(hparams['dropout']))
+            rnn_layers.append(StackedRNNLayerNorm(hparams['d_model']))
+    agent_net = nn.Sequential(encoder,
+                              *rnn_layers,
+                              RNNLinearOut(out_dim=gen_data.n_characters,
+                                           hidden_size=hparams['d_model'],
+                                           bidirectional=False,
+                                           bias=True))
+    gen_args = {'num_layers': hparams['num_layers'],
+                'hidden_size': hparams['d_model'],
+                'num_dir': 1,
+                'stack_depth': hparams['stack_depth'],
+                'stack_width': hparams['stack_width'],
+                'has_stack': True,
+                'has_cell': hparams['unit_type'] == 'lstm',
+                'device': device}
+    return agent_net.to(device), gen_args
+
+
+def worker_device(device):
+    """Spreads the workers over the visible GPUs when `device` is 'cuda'."""
+    if device != 'cuda':
+        return device
+    identity = mp.current_process()._identity
+    worker_idx = identity[0] - 1 if identity else 0
+    return f'cuda:{worker_idx % torch.cuda.device_count()}'
+
+
+def init_worker(checkpoint, tokens, hparams, device, threads_per_worker):
+    torch.set_num_threads(threads_per_worker)
+    device = worker_device(device)
+    gen_data = TokenData(tokens)
+    agent_net, gen_args = build_agent(hparams, gen_data, device)
+    agent_net.load_state_dict(torch.load(checkpoint, map_location=torch.device(device)))
+    agent_net.eval()
+    _worker_state.update({'agent': agent_net, 'gen_data': gen_data, 'gen_args': gen_args})
+
+
+def sample_shard(job):
+    """
+    Samples a seeded shard with the worker's agent.
+
+    :return: tuple
+        [0] shard index
+        [1] unique canonical SMILES of the valid samples of the shard
+        [2] shard statistics
+    """
+    shard_idx, seed, num_samples, batch_size, max_len, syntax_mask = job
+    torch.manual_seed(seed)
+    start = time.time()
+    canonical, num_valid = [], 0
+    for batch in iter_smiles(_worker_state['agent'], _worker_state['gen_data'], _worker_state['gen_args'],
+                             num_samples, batch_size, max_len, canonicalize=True, syntax_mask=syntax_mask):
+        for sm, valid in zip(batch.canonical, batch.valid):
+            if valid and len(sm) > 0:
+                canonical.append(sm)
+                num_valid += 1
+    unique = list(dict.fromkeys(canonical))
+    return shard_idx, unique, {'seed': seed, 'samples': num_samples, 'valid': num_valid,
+                               'seconds': time.time() - start}
+
+
+def smiles_hash(smiles):
+    """64-bit digest of a SMILES, used to keep the cross-shard set of seen molecules compact."""
+    return int.from_bytes(hashlib.blake2b(smiles.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def sharded_sampling(args, tokens, hparams):
+    os.makedirs(args.output_dir, exist_ok=True)
+    num_shards = (args.num_samples + args.shard_size - 1) // args.shard_size
+    jobs = [(i, args.seed + i, min(args.shard_size, args.num_samples - i * args.shard_size), args.batch_size,
+             args.max_len, args.syntax_mask) for i in range(num_shards)]
+    manifest = {'checkpoint': os.path.abspath(args.checkpoint),
+                'hparams': hparams,
+                'num_samples': args.num_samples,
+                'shard_size': args.shard_size,
+                'seed': args.seed,
+                'format': args.format,
+                'syntax_mask': args.syntax_mask,
+                'shards': []}
+    seen = set()
+    start = time.time()
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(args.num_workers, initializer=init_worker,
+                  initargs=(args.checkpoint, tokens, hparams, args.device, args.threads_per_worker)) as pool:
+        with tqdm(total=args.num_samples, desc='Sampling...') as pbar:
+            # Shards are deduplicated in shard order, so the output is the same for the same seeds
+            for shard_idx, unique, stats in pool.imap(sample_shard, jobs):
+                new_smiles = []
+                for sm in unique:
+                    h = smiles_hash(sm)
+                    if h not in seen:
+                        seen.add(h)
+                        new_smiles.append(sm)
+                shard_file = f'shard_{shard_idx:05d}.{args.format}'
+                with SmilesWriter(os.path.join(args.output_dir, shard_file), columns=['smiles']) as writer:
+                    writer.write([(sm,) for sm in new_smiles])
+                stats.update({'shard': shard_idx, 'file': shard_file, 'unique': len(unique),
+                              'written': len(new_smiles), 'cross_shard_duplicates': len(unique) - len(new_smiles)})
+                manifest['shards'].append(stats)
+                pbar.update(stats['samples'])
+    duration = time.time() - start
+    manifest['shards'].sort(key=lambda s: s['shard'])
+    manifest.update({'valid': sum(s['valid'] for s in manifest['shards']),
+                     'written': len(seen),
+                     'seconds': duration,
+                     'molecules_per_sec': args.num_samples / max(duration, 1e-9)})
+    with open(os.path.join(args.output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Samples unique, valid SMILES from a saved RL agent with a pool of processes')
+    parser.add_argument('--checkpoint', type=str, help='Agent checkpoint, e.g. a *_ppo_agent_*.mod file')
+    parser.add_argument('--output_dir', type=str, help='Directory of the shard files and manifest.json')
+    parser.add_argument('--num_samples', type=int, default=100000)
+    parser.add_argument('--shard_size', type=int, default=5000, help='Number of samples per shard')
+    parser.add_argument('--batch_size', type=int, default=500, help='Number of sequences sampled together')
+    parser.add_argument('--max_len', type=int, default=100)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='torch threads of each worker')
+    parser.add_argument('--device', type=str, default='cpu', help='cpu, cuda (workers spread over GPUs) or cuda:i')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the first shard. Shard i uses seed + i.')
+    parser.add_argument('--format', type=str, default='smi', choices=['smi', 'csv', 'parquet'])
+    parser.add_argument('--syntax_mask', action='store_true',
+                        help='Masks the tokens that would make the sampled SMILES syntactically invalid')
+    parser.add_argument('--vocab', type=str, default=None, help='Vocabulary file saved with the checkpoint')
+    parser.add_argument('--demo_file', type=str, default=None,
+                        help='Demonstrations file the agent was trained with. Used for the vocabulary when --vocab '
+                             'is not given.')
+    parser.add_argument('--delimiter', type=str, default=',', help='Delimiter of the demonstrations file')
+    parser.add_argument('--keep_header', action='store_true', help='Whether the first row is data and not a header')
+    parser.add_argument('--d_model', type=int, default=1500)
+    parser.add_argument('--dropout', type=float, default=0.)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--unit_type', type=str, default='gru', choices=['gru', 'lstm'])
+    parser.add_argument('--stack_width', type=int, default=1500)
+    parser.add_argument('--stack_depth', type=int, default=200)
+    args = parser.parse_args()
+
+    assert os.path.isfile(args.checkpoint)
+    assert args.vocab or args.demo_file, 'Either --vocab or --demo_file is required for the agent vocabulary'
+    if args.vocab:
+        tokens = list(load_vocabulary(args.vocab).tokens)
+    else:
+        tokens = GeneratorData(training_data_path=args.demo_file, delimiter=args.delimiter, cols_to_read=[0],
+                               keep_header=args.keep_header, pad_symbol=' ', max_len=120,
+                               tokens=get_default_tokens()).all_characters
+    hparams = {'d_model': args.d_model,
+               'dropout': args.dropout,
+               'num_layers': args.num_layers,
+               'unit_type': args.unit_type,
+               'stack_width': args.stack_width,
+               'stack_depth': args.stack_depth}
+    results = sharded_sampling(args, tokens, hparams)
+    print(f'{results["written"]} unique valid SMILES out of {results["num_samples"]} samples written to '
+          f'{args.output_dir} in {results["seconds"]:.1f}s ({results["molecules_per_sec"]:.1f} molecules/sec)')
@@ -6,17 +6,20 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import argparse
+import contextlib
 import json
+import multiprocessing as mp
 import os
+import time
 
 import numpy as np
 import pandas as pd
 import torch
-from tqdm import trange
+from tqdm import tqdm
 
-from irelease.data import GeneratorData
 from irelease.predictor import RNNPredictor, XGBPredictor
-from irelease.utils import get_default_tokens
+from irelease.utils import smiles_info
 
 if torch.cuda.is_available():
     dvc_id = 3
@@ -80,52 +83,156 @@ def batch_eval(out_dict, smiles, evaluator, batch_size=500):
         out_dict['prediction'].extend(np.array(preds).ravel().tolist())
 
 
+# Predictors of a scoring worker process, loaded once per experiment label.
+_worker_evaluators = {}
+
+
+def score_chunk(job):
+    """
+    Scores one chunk of SMILES in a worker process.
+
+    :param job: tuple
+        (output csv file, experiment label, offset of the chunk in the file's SMILES list, SMILES of the chunk)
+    :return: tuple
+        (output csv file, offset, number of input SMILES, scored input SMILES, predictions)
+    """
+    out_file, lbl, offset, smiles = job
+    if lbl not in _worker_evaluators:
+        _worker_evaluators[lbl] = eval_func[lbl]()
+    scored_smiles, preds, _ = _worker_evaluators[lbl](smiles)
+    # The predictors return the canonical forms of the SMILES they could parse, in input order. The input SMILES
+    # are written, as in the sequential scoring.
+    scored_input = []
+    for sm in smiles:
+        canon, valid, _ = smiles_info(sm, sanitize=False)
+        if valid and len(canon) > 0:
+            scored_input.append(sm)
+    assert len(scored_input) == len(scored_smiles)
+    return out_file, offset, len(smiles), scored_input, np.array(preds).ravel().tolist()
+
+
+def _progress_file(out_file):
+    return out_file + '.progress'
+
+
+def _partial_file(out_file):
+    return out_file + '.part'
+
+
+def _restart(out_file):
+    for f in [_partial_file(out_file), _progress_file(out_file)]:
+        if os.path.exists(f):
+            os.remove(f)
+    return 0
+
+
+def num_scored(out_file):
+    """
+    Returns the number of input SMILES of `out_file` that were scored and recorded before an interruption. Rows that
+    were appended to the partial output after the last progress record are truncated, so they are not written twice.
+    """
+    part, progress = _partial_file(out_file), _progress_file(out_file)
+    if not os.path.exists(part) or not os.path.exists(progress):
+        return _restart(out_file)
+    with open(progress, 'r') as f:
+        state = json.load(f)
+    if os.path.getsize(part) < state['part_size']:
+        return _restart(out_file)
+    with open(part, 'r+b') as f:
+        f.truncate(state['part_size'])
+    return state['consumed']
+
+
+def append_scores(out_file, consumed, smiles, preds):
+    """
+    Appends scored rows to the partial output of `out_file`, then records how many input SMILES are done and the size
+    of the partial output. The record is replaced atomically, so an interruption never leaves it truncated.
+    """
+    part, progress = _partial_file(out_file), _progress_file(out_file)
+    write_header = not os.path.exists(part)
+    with open(part, 'a', newline='') as f:
+        pd.DataFrame({'SMILES': smiles, 'prediction': preds}).to_csv(f, header=write_header, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp = progress + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'consumed': consumed, 'part_size': os.path.getsize(part)}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, progress)
+
+
+def finalize_scores(out_file):
+    part = _partial_file(out_file)
+    if not os.path.exists(part):
+        pd.DataFrame({'SMILES': [], 'prediction': []}).to_csv(part, index=False)
+    os.replace(part, out_file)
+    with contextlib.suppress(FileNotFoundError):  # files without SMILES never record progress
+        os.remove(_progress_file(out_file))
+
+
+def sharded_eval(analysis_dir, num_workers, batch_size=500, overwrite=False):
+    """
+    Scores the valid SMILES of every `*eval.json` file in `analysis_dir` with a pool of worker processes.
+
+    The chunks of all files are distributed over the pool and every worker loads each predictor once. Results are
+    appended to `<file>.csv.part` in input order as chunks complete, and the number of scored input SMILES is kept in
+    `<file>.csv.progress`, so an interrupted run resumes from where it stopped. Completed files are skipped unless
+    `overwrite` is set.
+    """
+    eval_files = sorted(f for f in os.listdir(analysis_dir) if f.endswith('eval.json'))
+    jobs, totals, consumed = [], {}, {}
+    for file in eval_files:
+        out_file = os.path.join(analysis_dir, file.replace('json', 'csv'))
+        if os.path.exists(out_file) and not overwrite:
+            continue
+        if overwrite:
+            _restart(out_file)
+        valid_smiles, _, metadata = smiles_from_json_data(os.path.join(analysis_dir, file))
+        lbl = metadata['exp']
+        start = num_scored(out_file)
+        totals[out_file] = len(valid_smiles)
+        consumed[out_file] = start
+        if start >= len(valid_smiles):
+            finalize_scores(out_file)
+            continue
+        jobs.extend([(out_file, lbl, j, valid_smiles[j:j + batch_size])
+                     for j in range(start, len(valid_smiles), batch_size)])
+    if not jobs:
+        print('Nothing to score.')
+        return
+
+    num_mols = 0
+    start_time = time.time()
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(processes=num_workers) as pool:
+        # imap keeps the chunks in submission order, so the rows of every output file are appended in input order
+        with tqdm(total=sum(len(j[3]) for j in jobs), desc='Scoring SMILES...') as pbar:
+            for out_file, offset, n_input, smiles, preds in pool.imap(score_chunk, jobs):
+                consumed[out_file] = offset + n_input
+                append_scores(out_file, consumed[out_file], smiles, preds)
+                if consumed[out_file] >= totals[out_file]:
+                    finalize_scores(out_file)
+                num_mols += n_input
+                pbar.update(n_input)
+                pbar.set_postfix(mols_per_sec=f'{num_mols / (time.time() - start_time):.1f}')
+    duration = time.time() - start_time
+    print(f'Scored {num_mols} molecules in {duration:.1f}s ({num_mols / duration:.1f} molecules/sec) '
+          f'with {num_workers} workers')
+
+
+eval_func = {'drd2': get_drd2_evaluator,
+             'logp': get_logp_evaluator,
+             'jak2_max': get_jak2_evaluator,
+             'jak2_min': get_jak2_evaluator}
+
 if __name__ == '__main__':
-    eval_files = [f for f in os.listdir('./analysis/') if 'eval.json' in f]
-    eval_func = {'drd2': get_drd2_evaluator,
-                 'logp': get_logp_evaluator,
-                 'jak2_max': get_jak2_evaluator,
-                 'jak2_min': get_jak2_evaluator}
-    unbiased_smiles_file = '../data/unbiased_smiles.smi'
-    biased_smiles_file_dict = {'drd2': '../data/drd2_active_filtered.smi',
-                               'logp': '../data/logp_smiles_biased.smi',
-                               'jak2_min': '../data/jak2_min_smiles_biased.smi',
-                               'jak2_max': '../data/jak2_max_smiles_biased.smi'}
-    for i in trange(len(eval_files), desc='Processing SMILES...'):
-        file = eval_files[i]
-        valid_smiles, invalid_smiles, metadata = smiles_from_json_data('./analysis/stack_rnn_tl_baseline/' + file)
-        eval_dict = {'SMILES': [], 'prediction': []}
-        lbl = metadata['exp']  # file.split('_')[0].lower()
-        evaluator = eval_func[lbl]()
-        batch_eval(eval_dict, valid_smiles, evaluator)
-        pd.DataFrame(eval_dict).to_csv('./analysis/stack_rnn_tl_baseline/' + file.replace('json', 'csv'), index=False)
-
-        # # Unbiased SMILES
-        # unbiased_data_gen = GeneratorData(training_data_path=unbiased_smiles_file,
-        #                                   delimiter='\t',
-        #                                   cols_to_read=[0],
-        #                                   keep_header=True,
-        #                                   pad_symbol=' ',
-        #                                   max_len=120,
-        #                                   tokens=get_default_tokens(),
-        #                                   use_cuda=use_cuda)
-        # unbiased_smiles = unbiased_data_gen.random_training_set_smiles(10000)
-        # unb_eval_dict = {'SMILES': [], 'prediction': []}
-        # batch_eval(unb_eval_dict, unbiased_smiles, evaluator)
-        # pd.DataFrame(unb_eval_dict).to_csv(f'./analysis/{lbl}_unbiased.csv', index=False)
-        #
-        # # Biased SMILES
-        # if lbl == 'jak2':
-        #     lbl += '_' + file.split('_')[1]
-        # biased_data_gen = GeneratorData(training_data_path=biased_smiles_file_dict[lbl],
-        #                                 delimiter='\t',
-        #                                 cols_to_read=[0],
-        #                                 keep_header=True,
-        #                                 pad_symbol=' ',
-        #                                 max_len=120,
-        #                                 tokens=get_default_tokens(),
-        #                                 use_cuda=use_cuda)
-        # biased_smiles = biased_data_gen.random_training_set_smiles(10000)
-        # b_eval_dict = {'SMILES': [], 'prediction': []}
-        # batch_eval(b_eval_dict, biased_smiles, evaluator)
-        # pd.DataFrame(b_eval_dict).to_csv(f'./analysis/{lbl}_biased.csv', index=False)
+    parser = argparse.ArgumentParser('Scores the generated SMILES of the *eval.json files with the expert models')
+    parser.add_argument('--analysis_dir', type=str, default='./analysis/stack_rnn_tl_baseline/',
+                        help='Directory containing the *eval.json files. The CSV files are written there as well.')
+    parser.add_argument('--num_workers', type=int, default=max(1, mp.cpu_count() - 1),
+                        help='Number of scoring processes')
+    parser.add_argument('--batch_size', type=int, default=500, help='Number of SMILES scored per chunk')
+    parser.add_argument('--overwrite', action='store_true', help='Re-scores files whose CSV already exists')
+    args = parser.parse_args()
+    sharded_eval(args.analysis_dir, args.num_workers, args.batch_size, args.overwrite)
@@ -8,7 +8,6 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import argparse
 import copy
-import math
 import os
 import random
 import time
@@ -24,12 +23,13 @@ from soek.template import Trainer
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import trange
 
-from irelease.data import GeneratorData
+from irelease.data import GeneratorData, BucketBatchSampler
 from irelease.model import RNNLinearOut, Encoder, StackRNN, StackedRNNDropout, StackedRNNLayerNorm
 from irelease.mol_metrics import verify_sequence, get_mol_metrics
 from irelease.predictor import RNNPredictor, XGBPredictor, DummyPredictor
+from irelease.sampling import sample_unique
 from irelease.utils import Flags, parse_optimizer, ExpAverage, GradStats, Count, generate_smiles, time_since, \
-    get_default_tokens, canonical_smiles, init_hidden, init_cell, init_stack
+    get_default_tokens, init_hidden, init_cell, init_stack
 
 currentDT = dt.now()
 date_label = currentDT.strftime("%Y_%m_%d__%H_%M_%S")
@@ -158,11 +158,6 @@ class StackRNNBaseline(Trainer):
         score_exp_avg = ExpAverage(beta=0.6)
         exp_type = rnn_args['exp_type']
 
-        if is_pretraining:
-            num_batches = math.ceil(prior_data_gen.file_len / prior_data_gen.batch_size)
-        else:
-            num_batches = math.ceil(demo_data_gen.file_len / demo_data_gen.batch_size)
-        n_epochs = math.ceil(n_iters / num_batches)
         grad_stats = GradStats(generator, beta=0.)
 
         # learning rate decay schedulers
@@ -194,11 +189,15 @@ class StackRNNBaseline(Trainer):
             print('Pretrained model loaded successfully!')
 
         start = time.time()
+        sampler = None
         try:
             demo_score = np.mean(expert_model(demo_data_gen.random_training_set_smiles(1000))[1])
             baseline_score = np.mean(expert_model(unbiased_data_gen.random_training_set_smiles(1000))[1])
             step_idx = Count()
             gen_data = prior_data_gen if is_pretraining else demo_data_gen
+            # length-bucketed batches prepared in the background
+            sampler = BucketBatchSampler(gen_data)
+            num_batches = sampler.num_batches
             n_epochs = 2
             with TBMeanTracker(tb_writer, 1) as tracker:
                 mode = 'Pretraining' if is_pretraining else 'Fine tuning'
@@ -208,7 +207,7 @@ class StackRNNBaseline(Trainer):
                     epoch_per_valid = []
                     with grad_stats:
                         for b in trange(0, num_batches, desc=f'Epoch {epoch + 1}/{n_epochs}, {mode} in progress...'):
-                            inputs, labels = gen_data.random_training_set()
+                            inputs, labels = next(sampler)
                             inputs = inputs.to(device)
                             labels = labels.to(device)
                             batch_size, seq_len = inputs.shape[:2]
@@ -313,6 +312,9 @@ class StackRNNBaseline(Trainer):
 
         except ValueError as e:
             print(str(e))
+        finally:
+            if sampler is not None:
+                sampler.close()
 
         duration = time.time() - start
         print('Model training duration: {:.0f}m {:.0f}s'.format(duration // 60, duration % 60))
@@ -325,31 +327,12 @@ class StackRNNBaseline(Trainer):
         start = time.time()
         model.eval()
 
-        # Samples SMILES
-        samples = []
-        step = 100
-        count = 0
-        for _ in range(int(num_smiles / step)):
-            samples.extend(generate_smiles(generator=model, gen_data=gen_data, init_args=rnn_args,
-                                           num_samples=step, is_train=False, verbose=True))
-            count += step
-        res = num_smiles - count
-        if res > 0:
-            samples.extend(generate_smiles(generator=model, gen_data=gen_data, init_args=rnn_args,
-                                           num_samples=res, is_train=False, verbose=True))
-        smiles, valid_vec = canonical_smiles(samples)
-        valid_smiles = []
-        invalid_smiles = []
-        for idx, sm in enumerate(smiles):
-            if len(sm) > 0:
-                valid_smiles.append(sm)
-            else:
-                invalid_smiles.append(samples[idx])
-        v = len(valid_smiles)
-        valid_smiles = list(set(valid_smiles))
-        print(f'Percentage of valid SMILES = {float(len(valid_smiles)) / float(len(samples)):.2f}, '
-              f'Num. samples = {len(samples)}, Num. valid = {len(valid_smiles)}, '
-              f'Num. requested = {num_smiles}, Num. dups = {v - len(valid_smiles)}')
+        # Samples SMILES until num_smiles unique, valid SMILES are collected
+        res = sample_unique(model, gen_data, rnn_args, num_smiles, batch_size=100)
+        valid_smiles, invalid_smiles = res.smiles, res.invalid
+        print(f'Percentage of valid SMILES = {float(res.num_valid) / float(res.num_samples):.2f}, '
+              f'Num. samples = {res.num_samples}, Num. unique valid = {len(valid_smiles)}, '
+              f'Num. requested = {num_smiles}, Num. dups = {res.num_duplicates}, Stopped early = {res.aborted}')
 
         # sub-nodes of sim data resource
         smiles_node = DataNode(label="valid_smiles", data=valid_smiles)
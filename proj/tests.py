@@ -7,12 +7,18 @@ from tqdm import tqdm
 
 from irelease.data import GeneratorData
 from irelease.env import MoleculeEnv
-from irelease.model import Encoder, PositionalEncoding, StackDecoderLayer, LinearOut, StackRNN, RNNLinearOut, RewardNetRNN
+from irelease.model import Encoder, PositionalEncoding, StackDecoderLayer, LinearOut, StackRNN, RNNLinearOut, \
+    RewardNetRNN, FusedStackRNN
 from irelease.reward import RewardFunction
 from irelease.rl import PolicyAgent, MolEnvProbabilityActionSelector, REINFORCE, GuidedRewardLearningIRL, \
     StateActionProbRegistry
 from irelease.stackrnn import StackRNNCell
-from irelease.utils import init_hidden, init_stack, get_default_tokens, init_hidden_2d, init_stack_2d, init_cell, seq2tensor
+from irelease.utils import init_hidden, init_stack, get_default_tokens, init_hidden_2d, init_stack_2d, init_cell, \
+    seq2tensor, Vocabulary, SmilesTokenizer, get_desc, normalize_desc, GradStats, sample_active_set, select_batch_states
+from irelease.smiles_syntax import SmilesSyntaxMask
+from irelease.sampling import BloomFilter, UniqueCollector
+from irelease.predictor import SVREnsemble, RNNPredictor, export_rnn_predictor, compare_predictors
+from irelease.dataloader import IndexedSplit, _pack_splits, _unpack_splits
 
 gen_data_path = '../data/chembl_xsmall.smi'
 tokens = get_default_tokens()
@@ -29,6 +35,208 @@ class MyTestCase(unittest.TestCase):
         batch = gen_data.random_training_set(batch_size=bz)
         assert (len(batch[0]) == bz and len(batch[1]) == bz)
 
+    def test_vocabulary(self):
+        smiles = ['<CC(=O)Nc1ccc(O)cc1>', '<c1ccccc1Br>  ']
+        vocab = Vocabulary(tokens)
+        x = vocab.encode(smiles)
+        assert x.shape == (2, len(smiles[0]))
+        assert x[1, -1] == tokens.index(' ')
+        assert vocab.decode(x)[0] == smiles[0]
+        assert vocab.decode(vocab.encode(smiles, flip=True), flip=True) == [s.ljust(x.shape[1]) for s in smiles]
+        with self.assertRaises(ValueError):
+            Vocabulary(tokens, strict=True).encode(['<C$C>'])
+
+    def test_smiles_tokenizer(self):
+        smiles = ['<CC(Cl)c1ccc[nH]1>', '<C%10CC[C@@H]%10Br>']
+        tokenizer = SmilesTokenizer.from_smiles(smiles)
+        assert tokenizer.tokenize(smiles[1]) == ['<', 'C', '%10', 'C', 'C', '[C@@H]', '%10', 'Br', '>']
+        x = tokenizer.encode(smiles)
+        assert x.shape == (2, 14)
+        assert tokenizer.decode(x) == [smiles[0], smiles[1] + ' ' * 5]
+
+    def test_select_batch_states(self):
+        ids = torch.arange(4).float()
+        states = [(ids.view(1, -1, 1).repeat(1, 1, 3), None, ids.view(-1, 1, 1).repeat(1, 5, 2))]
+        index = torch.tensor([3, 0, 2])
+        hidden, cell, stack = select_batch_states(states, index)[0]
+        assert cell is None
+        assert hidden.shape == (1, 3, 3) and stack.shape == (3, 5, 2)
+        assert (hidden[0, :, 0] == index.float()).all() and (stack[:, 0, 0] == index.float()).all()
+
+    def test_sample_active_set(self):
+        vocab = Vocabulary(tokens)
+        targets = ['CCO', 'c1ccccc1', '', 'N', 'CC(=O)N', 'Br', 'C' * 20]
+        max_len = 10
+
+        class ScriptedGenerator(torch.nn.Module):
+            """Emits targets[i] then the end token for sequence i, identified by its hidden, cell and stack rows."""
+
+            def forward(self, inp):
+                x, (hidden, cell, stack) = inp
+                ids, t = hidden[0, :, 0].long(), int(hidden[0, 0, 1])
+                # The states of every remaining sequence must still be aligned with each other and with its input
+                assert (cell[0, :, 0].long() == ids).all()
+                assert (stack.view(len(ids), -1).long() == ids.view(-1, 1)).all()
+                prev = ['<' if t == 0 else targets[i][t - 1] for i in ids.tolist()]
+                assert x.view(-1).tolist() == [vocab.index(c) for c in prev]
+                nxt = [targets[i][t] if t < len(targets[i]) else '>' for i in ids.tolist()]
+                logits = torch.full((1, len(ids), len(vocab)), -1e4)
+                logits[0, list(range(len(ids))), [vocab.index(c) for c in nxt]] = 0.
+                hidden = torch.stack([hidden[..., 0], hidden[..., 1] + 1], dim=-1)
+                return [logits, (hidden, cell, stack)]
+
+        torch.manual_seed(1)
+        n = len(targets)
+        ids = torch.arange(n).float()
+        states = [(torch.stack([ids, torch.zeros(n)], dim=-1).unsqueeze(0), ids.view(1, -1, 1),
+                   ids.view(-1, 1, 1).repeat(1, 4, 3))]
+        prime = torch.tensor([[vocab.index('<')]] * n)
+        smiles = sample_active_set(ScriptedGenerator(), states, prime, vocab, end_token='>', max_len=max_len)
+        assert smiles == [s[:max_len - 1] for s in targets]
+
+    def test_smiles_syntax_mask(self):
+        syntax = SmilesSyntaxMask(tokens)
+        end = tokens.index('>')
+        assert syntax.prefix_mask('<Cc1ccccc1')[end]
+        assert not syntax.prefix_mask('<CC(C')[end]
+        assert not syntax.prefix_mask('<c1ccc')[end]
+        assert not syntax.prefix_mask('<')[tokens.index(')')]
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f'C{i}')
+        assert all(f'C{i}' in bloom for i in range(1000))
+        false_positives = sum(f'N{i}' in bloom for i in range(10000))
+        assert false_positives < 300
+
+    def test_unique_collector(self):
+        smiles = [f'C{i}' for i in range(100)]
+        collector = UniqueCollector(num_unique=100, window=50)
+        collector.add(smiles[:98], smiles[:98], [True] * 98)
+        # A duplicate in a small tail batch must not be taken for a collapse
+        collector.add(['C0'], ['C0'], [True])
+        assert not collector.collapsed and not collector.done
+        collector.add(smiles[98:] + ['CC('], smiles[98:] + [''], [True, True, False])
+        assert collector.done and collector.unique == smiles and collector.invalid == ['CC(']
+        assert collector.num_duplicates == 1
+        collector = UniqueCollector(num_unique=100, window=50)
+        collector.add(['C'] * 60, ['C'] * 60, [True] * 60)
+        assert collector.collapsed and collector.duplicate_rate() > 0.95
+
+    def test_svr_ensemble(self):
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+        from sklearn.svm import SVR
+        rng = np.random.RandomState(1)
+        x, y = rng.rand(200, 16), rng.rand(200)
+        models = []
+        for i, kernel in enumerate(['rbf', 'rbf', 'poly', 'linear']):
+            idx = rng.choice(200, 150, replace=False)
+            models.append(make_pipeline(StandardScaler(), SVR(kernel=kernel)).fit(x[idx], y[idx]))
+        models.append(SVR().fit(x, y))
+        x_test = rng.rand(50, 16)
+        expected = np.stack([m.predict(x_test) for m in models])
+        preds = SVREnsemble(models, chunk_size=16).decision_functions(x_test)
+        assert np.allclose(preds, expected, atol=1e-8)
+        assert np.allclose(preds.mean(axis=0), expected.mean(axis=0), atol=1e-8)
+
+    def test_split_cache(self):
+        import io
+        import joblib
+        X, y = np.array(['C', 'CC', 'CCC', 'CCCC']), np.arange(4.).reshape(-1, 1)
+        data_dict = {'fold_0': {'train': IndexedSplit(X, y, [0, 1, 2]), 'test': IndexedSplit(X, y, [3])},
+                     'fold_1': {'train': IndexedSplit(X, y, [1, 2, 3]), 'test': IndexedSplit(X, y, [0])}}
+        buf = io.BytesIO()
+        joblib.dump(_pack_splits(data_dict), buf)
+        buf.seek(0)
+        loaded = _unpack_splits(joblib.load(buf))
+        assert loaded['fold_0']['train'].y_all is loaded['fold_1']['test'].y_all
+        for fold in data_dict:
+            for part in data_dict[fold]:
+                x_ref, y_ref = data_dict[fold][part]
+                x_, y_ = loaded[fold][part]
+                assert (x_ == x_ref).all() and (y_ == y_ref).all()
+
+    def test_descriptors(self):
+        from rdkit import Chem
+        from rdkit.Chem import Descriptors
+
+        def calc(mol):
+            return [mol.GetNumAtoms(), Descriptors.MolLogP(mol), float('inf') if mol.GetNumAtoms() > 3 else 1.]
+
+        smiles = ['CCO', 'C1CC', 'c1ccccc1O', 'CC(=O)N', 'not a smiles']
+        # Reference: the loop-based featurization and normalization the vectorized functions replace
+        ref_desc, ref_valid = [], []
+        for i, sm in enumerate(smiles):
+            try:
+                ref_desc.append(np.array(calc(Chem.MolFromSmiles(sm))))
+                ref_valid.append(i)
+            except Exception:
+                pass
+        ref_desc = np.array(ref_desc)
+        ref_norm = ref_desc.copy()
+        ind = np.isfinite(ref_norm)
+        for i in range(ref_norm.shape[0]):
+            for j in range(ref_norm.shape[1]):
+                if not ind[i, j]:
+                    ref_norm[i, j] = 0
+        ref_mean = np.mean(ref_norm, axis=0)
+        for i in range(ref_norm.shape[0]):
+            for j in range(ref_norm.shape[1]):
+                if not ind[i, j]:
+                    ref_norm[i, j] = ref_mean[j]
+
+        desc, valid, invalid = get_desc(smiles, calc, n_jobs=1)
+        assert valid == ref_valid and invalid == [1, 4]
+        assert np.allclose(desc, ref_desc.astype(np.float32), equal_nan=True)
+        norm, mean = normalize_desc(desc)
+        assert np.allclose(mean, ref_mean, rtol=1e-5) and np.allclose(norm, ref_norm, rtol=1e-5)
+
+    def test_grad_stats(self):
+        torch.manual_seed(1)
+        net = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Tanh(), torch.nn.Linear(8, 3), torch.nn.Linear(3, 2))
+        net[3].weight.requires_grad_(False)
+        net(torch.randn(5, 4)).pow(2).sum().backward()
+        grad_stats = GradStats(net, beta=0., per_layer=True)
+        grad_stats.stats()
+
+        # Reference: the statistics of all the gradients concatenated on the host
+        def ref_stats(params):
+            grads = np.concatenate([p.grad.data.cpu().numpy().flatten() for p in params if p.grad is not None])
+            return np.sqrt(np.mean(np.square(grads))), np.max(np.abs(grads)), np.var(grads)
+
+        for value, ref in zip([grad_stats.l2, grad_stats.max, grad_stats.var], ref_stats(net.parameters())):
+            assert np.isclose(value, ref, rtol=1e-5)
+        for layer in ['0', '2', '3']:
+            ref = ref_stats(getattr(net, layer).parameters())
+            stats = grad_stats.layer_stats[layer]
+            assert np.allclose([stats['l2'], stats['max'], stats['var']], ref, rtol=1e-5)
+
+    def test_export_rnn_predictor(self):
+        import os
+        import tempfile
+        import joblib
+        from sklearn.preprocessing import StandardScaler
+        from irelease.model import RNNPredictorModel
+        model_dir = tempfile.mkdtemp()
+        hparams = {'model_dir': model_dir, 'd_model': 16, 'rnn_num_layers': 1, 'dropout': 0.,
+                   'is_bidirectional': False, 'unit_type': 'lstm'}
+        for fold in range(2):
+            model = RNNPredictorModel(16, tokens, num_layers=1, unit_type='lstm')
+            torch.save(model.state_dict(), os.path.join(model_dir, f'fold_{fold}.mod'))
+        # A transformer fit without scaling has scale_ = None
+        joblib.dump(StandardScaler(with_std=False).fit(np.random.rand(20, 1)),
+                    os.path.join(model_dir, 'transformer.joblib'))
+        smiles = ['CCO', 'c1ccccc1O', 'CC(=O)Nc1ccc(O)cc1', 'CCN(CC)CC']
+        eager = RNNPredictor(hparams, 'cpu')
+        for quantize, tol in [(False, 1e-5), (True, 0.1)]:
+            path = os.path.join(tempfile.mkdtemp(), f'expert_{quantize}.pt')
+            export_rnn_predictor(hparams, path, quantize=quantize)
+            scripted = RNNPredictor(dict(hparams, script_model=path), 'cpu')
+            results = compare_predictors(eager, scripted, smiles)
+            assert results['num_molecules'] == len(smiles) and results['max_abs_diff'] < tol
+
     def test_embeddings(self):
         x, y = gen_data.random_training_set(batch_size=bz)
         encoder = Encoder(gen_data.n_characters, 128, gen_data.char2idx[gen_data.pad_symbol])
@@ -140,6 +348,25 @@ class MyTestCase(unittest.TestCase):
         x = linear(outputs)
         print(x[0].shape)
 
+    def test_fused_stack_rnn(self):
+        x, y = gen_data.random_training_set(batch_size=bz)
+        d_model, hidden_size, stack_width, stack_depth = 12, 16, 10, 20
+        encoder = Encoder(gen_data.n_characters, d_model, gen_data.char2idx[gen_data.pad_symbol])
+        x = encoder(x).detach()
+        for unit_type in ['gru', 'lstm']:
+            layer = StackRNN(1, d_model, hidden_size, True, unit_type, stack_width, stack_depth)
+            fused = FusedStackRNN.from_layer(layer)
+            states = get_initial_states(bz, hidden_size, 1, stack_depth, stack_width, unit_type)
+            out = layer([x, states])
+            out_fused = fused([x, states])
+            assert torch.allclose(out[0], out_fused[0], atol=1e-5)
+            for s, s_fused in zip(out[1], out_fused[1]):
+                assert s is None or torch.allclose(s, s_fused, atol=1e-5)
+            out[0].sum().backward()
+            out_fused[0].sum().backward()
+            for p, p_fused in zip(layer.parameters(), fused.parameters()):
+                assert torch.allclose(p.grad, p_fused.grad, atol=1e-4)
+
     def test_mol_env(self):
         d_model = 8
         hidden_size = 16